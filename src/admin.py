@@ -0,0 +1,78 @@
+#!/usr/lib/mongofs/environment/bin/python
+
+from sys import argv, exit
+
+from src.core.Configuration import Configuration
+from src.core.GenericFile import GenericFile
+from src.core.Mongo import Mongo
+
+"""
+    Maintenance commands for an existing file system. They can be run while the file system is mounted.
+"""
+class MongoFSAdmin:
+    def __init__(self):
+        self.configuration = Configuration()
+        self.mongo = Mongo()
+
+        # Additional setup
+        GenericFile.mongo = self.mongo
+        GenericFile.configuration = self.configuration
+
+    """
+        Store the materialized path of every generic file. Must be run once after enabling "mongo.materialized_paths"
+        on an existing file system.
+    """
+    def backfill_paths(self):
+        updated = self.mongo.backfill_materialized_paths()
+        print('Materialized path updated for ' + str(updated) + ' generic files.')
+
+    """
+        Fix the counters of files of every directory, for example after a crash of a mount.
+    """
+    def repair_counters(self):
+        repaired = self.mongo.repair_directory_counters()
+        print('Counters fixed for ' + str(repaired) + ' directories.')
+
+    """
+        Fold the extents of every log-structured file into its chunks, for example if the background compaction is
+        deactivated.
+    """
+    def compact(self):
+        compacted = self.mongo.compact_all_extents()
+        print('Extents compacted for ' + str(compacted) + ' files.')
+
+    """
+        Delete the chunks of the deleted files (see "reaper" in the configuration), for example if no file system is
+        mounted to do it in background.
+    """
+    def reap(self):
+        deleted = self.mongo.reap_all_tombstones()
+        print(str(deleted) + ' chunks of deleted files removed.')
+
+    """
+        Rewrite the files whose chunk size does not follow the chunk size policy anymore (see "chunk_size_policy" in
+        the configuration).
+    """
+    def rechunk(self):
+        rechunked = self.mongo.rechunk_files()
+        print('Chunks rewritten for ' + str(rechunked) + ' files.')
+
+
+if __name__ == '__main__':
+    commands = {
+        'backfill-paths': MongoFSAdmin.backfill_paths,
+        'compact': MongoFSAdmin.compact,
+        'reap': MongoFSAdmin.reap,
+        'rechunk': MongoFSAdmin.rechunk,
+        'repair-counters': MongoFSAdmin.repair_counters
+    }
+
+    if len(argv) < 2 or argv[-1] not in commands:
+        print('usage: %s (<configuration_filepath>) <command>' % argv[0])
+        print('available commands: ' + ', '.join(sorted(commands.keys())))
+        exit(1)
+
+    if len(argv) >= 3:
+        Configuration.FILEPATH = argv[1]
+
+    commands[argv[-1]](MongoFSAdmin())
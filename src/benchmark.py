@@ -0,0 +1,150 @@
+#!/usr/lib/mongofs/environment/bin/python
+
+import time
+import gridfs
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from sys import argv, exit
+
+from src.core.Configuration import Configuration
+from src.core.GenericFile import GenericFile
+from src.core.Mongo import Mongo
+from src.core.MongoCache import MongoCache
+
+"""
+    Compare the throughput of the reads of an existing file, with a single query per read, and with the chunks loaded
+    in parallel (see "parallel_reads" in the configuration). The data cache is emptied before every run, and the
+    read-ahead is deactivated, so we only measure the queries to MongoDB.
+    It can also measure the operations on the metadata (creation, getattr, utimens, unlink) of many small files.
+"""
+class MongoFSBenchmark:
+    # Size of every read, FUSE sends 128KB reads by default, but we want to see reads over several chunks
+    READ_SIZES = [128 * 1024, 8 * 1024 * 1024]
+    RUNS = 3
+    # Number of files created by the benchmark of the metadata, and number of threads of its parallel run
+    FILES = 1000
+    THREADS = 8
+
+    def __init__(self):
+        self.configuration = Configuration()
+        self.mongo = Mongo()
+        self.mongo.read_ahead.max_chunks = 0
+
+        # Additional setup
+        GenericFile.mongo = self.mongo
+        GenericFile.configuration = self.configuration
+
+    """
+        Read a file entirely, by blocks of read_size bytes. Return the throughput in MB/s.
+    """
+    def read_file(self, file, read_size):
+        MongoCache.data_cache.clear()
+        st = time.time()
+        offset = 0
+        while offset < file.length:
+            offset += len(self.mongo.read_data(file=file, offset=offset, size=read_size))
+        dt = max(time.time() - st, 0.000001)
+        return file.length / (1024 * 1024) / dt
+
+    """
+        Run the benchmark for the given file, and display the best result of every configuration
+    """
+    def run(self, filepath):
+        file = self.mongo.get_generic_file(filepath=filepath)
+        if file is None or not file.is_file():
+            print('No file found for ' + filepath)
+            exit(1)
+
+        threads = max(self.configuration.parallel_reads_threads(), 4)
+        executors = [('single query', None), ('parallel (' + str(threads) + ' threads)', ThreadPoolExecutor(max_workers=threads))]
+        print('File of ' + str(file.length) + ' bytes, chunks of ' + str(file.chunkSize) + ' bytes, '
+              + str(self.configuration.parallel_reads_chunks_per_query()) + ' chunk(s) per parallel query.')
+        for read_size in MongoFSBenchmark.READ_SIZES:
+            for name, executor in executors:
+                MongoCache.chunks_executor = executor
+                throughput = max(self.read_file(file, read_size) for i in range(0, MongoFSBenchmark.RUNS))
+                print('Reads of ' + str(read_size // 1024) + 'KB, ' + name + ': ' + str(round(throughput, 1)) + ' MB/s')
+
+    """
+        Run an operation for every number of range(0, FILES), with the given number of threads. Return the number of
+        operations per second.
+    """
+    def operations_per_second(self, operation, threads):
+        st = time.time()
+        if threads <= 1:
+            for i in range(0, MongoFSBenchmark.FILES):
+                operation(i)
+        else:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(operation, range(0, MongoFSBenchmark.FILES)))
+        dt = max(time.time() - st, 0.000001)
+        return MongoFSBenchmark.FILES / dt
+
+    """
+        Run the benchmark of the metadata operations in a new directory below the given one, and display the number of
+        operations per second. The insertion of the document of a new file through gridfs (as done by the previous
+        versions) is compared with the direct insertion.
+    """
+    def run_metadata(self, directory_path):
+        directory = self.mongo.get_generic_file(filepath=directory_path)
+        if directory is None or not directory.is_dir():
+            print('No directory found for ' + directory_path)
+            exit(1)
+
+        base = directory_path.rstrip('/') + '/mongofs-benchmark-' + str(ObjectId())
+        GenericFile.new_generic_file(filepath=base, mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        template = GenericFile.new_generic_file(filepath=base + '/template', mode=0o644, file_type=GenericFile.FILE_TYPE)
+
+        # Insertion of the same documents, without the other queries of a creation
+        grid = gridfs.GridFS(self.mongo.cache.database, self.configuration.mongo_prefix() + 'files')
+        def insert_gridfs(i):
+            grid.new_file(**dict(template.json, _id=ObjectId(), filename='gridfs-' + str(i))).close()
+        def insert_direct(i):
+            json = dict(template.json, _id=ObjectId(), filename='direct-' + str(i))
+            self.mongo.cache.insert_one(self.mongo.files_coll, self.mongo.new_file_document(json))
+        print('Insertion of ' + str(MongoFSBenchmark.FILES) + ' documents through gridfs: '
+              + str(round(self.operations_per_second(insert_gridfs, 1))) + ' files/s')
+        print('Insertion of ' + str(MongoFSBenchmark.FILES) + ' documents with a single insert: '
+              + str(round(self.operations_per_second(insert_direct, 1))) + ' files/s')
+        self.mongo.cache.delete_many(self.mongo.files_coll, {'directory_id': template.directory_id, '_id': {'$ne': template._id}})
+
+        # Operations as done by FUSE, one after the other, then in parallel
+        for threads in [1, MongoFSBenchmark.THREADS]:
+            prefix = base + '/' + str(threads) + '-'
+            def create(i):
+                GenericFile.new_generic_file(filepath=prefix + str(i), mode=0o644, file_type=GenericFile.FILE_TYPE)
+            def get_attributes(i):
+                self.mongo.get_generic_file(filepath=prefix + str(i))
+            def utimens(i):
+                file = self.mongo.get_generic_file(filepath=prefix + str(i))
+                file.metadata['st_mtime'] = time.time()
+                file.basic_save()
+            def unlink(i):
+                self.mongo.remove_generic_file(generic_file=self.mongo.get_generic_file(filepath=prefix + str(i)))
+
+            results = []
+            for name, operation in [('create', create), ('getattr', get_attributes), ('utimens', utimens), ('unlink', unlink)]:
+                # The metadata cache is emptied, so every operation needs its queries
+                self.mongo.cache.reset_cache()
+                results.append(name + ': ' + str(round(self.operations_per_second(operation, threads))) + '/s')
+            print(str(threads) + ' thread(s), ' + ', '.join(results))
+
+        self.mongo.remove_generic_file(generic_file=template)
+        self.mongo.directory_counters.flush()
+        self.mongo.remove_generic_file(generic_file=self.mongo.get_generic_file(filepath=base))
+
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print('usage: %s (<configuration_filepath>) [metadata] <filepath>' % argv[0])
+        exit(1)
+
+    metadata = 'metadata' in argv[1:-1]
+    arguments = [argument for argument in argv[1:-1] if argument != 'metadata']
+    if len(arguments) >= 1:
+        Configuration.FILEPATH = arguments[0]
+
+    if metadata:
+        MongoFSBenchmark().run_metadata(argv[-1])
+    else:
+        MongoFSBenchmark().run(argv[-1])
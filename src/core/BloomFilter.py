@@ -0,0 +1,43 @@
+#!/usr/lib/mongofs/environment/bin/python
+import hashlib
+import threading
+from math import ceil, log
+
+"""
+    Simple Bloom filter for filenames. It can tell us that a filename is definitely not in a set (so we do not need to
+    contact MongoDB to know it), or that it might be in it.
+    Elements can only be added, never removed: a deleted filename will simply stay a false positive.
+"""
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * log(2))))
+        self.bits = bytearray(int(ceil(self.size / 8)))
+        self.lock = threading.Lock()
+
+    """
+        Compute the positions of the bits of a filename, with the double hashing technique.
+    """
+    def positions(self, filename):
+        digest = hashlib.sha1(filename.encode('utf-8', 'surrogateescape')).digest()
+        h1 = int.from_bytes(digest[0:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(0, self.hashes)]
+
+    """
+        Add a filename to the filter
+    """
+    def add(self, filename):
+        with self.lock:
+            for position in self.positions(filename):
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    """
+        Return False if the filename is definitely not in the filter, True if it might be.
+    """
+    def __contains__(self, filename):
+        for position in self.positions(filename):
+            if self.bits[position >> 3] & (1 << (position & 7)) == 0:
+                return False
+        return True
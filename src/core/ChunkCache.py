@@ -0,0 +1,111 @@
+#!/usr/lib/mongofs/environment/bin/python
+import time
+import threading
+from collections import OrderedDict
+
+"""
+    Cache of the data of the chunks, limited by its total size in bytes (and not by a number of entries, as one chunk
+    can be up to 15MB). Each chunk is stored once, indexed by (files_id, n), with the version of the file it was read
+    for. A chunk read for another version of the file is considered missing. The least recently used chunks are evicted
+    first.
+"""
+class ChunkCache:
+    def __init__(self, max_bytes, timeout):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.clear()
+
+    """
+        Return the data of a chunk, or None if we do not have it for the given version.
+    """
+    def get(self, files_id, n, version):
+        key = (files_id, n)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            entry_version, data, dt = entry
+            if entry_version != version or (self.timeout > 0 and dt + self.timeout < time.time()):
+                self.remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    """
+        Store the data of a chunk for the given version of the file. Chunks bigger than the whole cache are not kept.
+    """
+    def put(self, files_id, n, version, data):
+        if len(data) > self.max_bytes or self.timeout <= 0:
+            return
+
+        key = (files_id, n)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (version, data, time.time())
+            self.files.setdefault(files_id, set()).add(n)
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    """
+        Remove one chunk of a file from the cache, or all of them if "n" is None
+    """
+    def invalidate(self, files_id, n=None):
+        with self.lock:
+            if n is not None:
+                self.remove((files_id, n))
+                return
+
+            for chunk_n in list(self.files.get(files_id, [])):
+                self.remove((files_id, chunk_n))
+
+    """
+        Keep the chunks of a file read for a given version valid for its new version, once we modified it ourselves
+        (the modified chunks must be invalidated separately).
+    """
+    def update_version(self, files_id, version, new_version):
+        with self.lock:
+            for n in self.files.get(files_id, []):
+                entry_version, data, dt = self.entries[(files_id, n)]
+                if entry_version == version:
+                    self.entries[(files_id, n)] = (new_version, data, dt)
+
+    """
+        Remove an entry from the cache. The lock must already be taken.
+    """
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        self.size -= len(entry[1])
+        files_id, n = key
+        numbers = self.files[files_id]
+        numbers.discard(n)
+        if len(numbers) == 0:
+            del self.files[files_id]
+
+    """
+        Drop every chunk and reset the statistics
+    """
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.files = {}
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    """
+        Some statistics about the cache usage
+    """
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'chunks': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes}
@@ -0,0 +1,125 @@
+#!/usr/lib/mongofs/environment/bin/python
+import lzma
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from math import log
+
+# Optional codecs, faster than the ones of the standard library
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+    Compression of the chunks, before sending them to MongoDB. Every chunk is stored with the name of its codec in its
+    "codec" field, a chunk without it is not compressed (every chunk written by older versions), so we can change the
+    codec at any time and still read the existing chunks.
+"""
+class ChunkCodec:
+    # Above that entropy (in bits per byte), the data is most likely already compressed (images, archives, ...)
+    MAX_ENTROPY = 7.5
+    # Size of the samples used to compute the entropy of a chunk
+    SAMPLE_SIZE = 4096
+    # We only keep the compressed data if it saves at least 10%
+    MIN_RATIO = 0.9
+
+    def __init__(self, codec, level, threads):
+        if codec not in ChunkCodec.available_codecs():
+            if codec not in (None, 'none'):
+                print('Compression codec "' + str(codec) + '" not available, the chunks will not be compressed.')
+            codec = None
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+        self.executor = None
+
+    """
+        Names of the codecs we can use to compress data. The optional ones are only available if their python package
+        is installed.
+    """
+    @staticmethod
+    def available_codecs():
+        codecs = ['zlib', 'lzma']
+        if lz4 is not None:
+            codecs.append('lz4')
+        if zstandard is not None:
+            codecs.append('zstd')
+        return codecs
+
+    """
+        Indicate if the data of a chunk is most likely already compressed, from the entropy of a few samples of it.
+    """
+    @staticmethod
+    def is_incompressible(data):
+        if len(data) <= 2 * ChunkCodec.SAMPLE_SIZE:
+            sample = data
+        else:
+            middle = len(data) // 2
+            sample = bytes(data[0:ChunkCodec.SAMPLE_SIZE]) + bytes(data[middle:middle + ChunkCodec.SAMPLE_SIZE])
+        if len(sample) == 0:
+            return False
+
+        entropy = 0.0
+        for count in Counter(sample).values():
+            probability = count / len(sample)
+            entropy -= probability * log(probability, 2)
+        return entropy > ChunkCodec.MAX_ENTROPY
+
+    """
+        Compress the data of a chunk. Return a tuple (codec, data), with codec None if we decided to keep the data
+        uncompressed.
+    """
+    def encode(self, data):
+        if self.codec is None or len(data) == 0 or ChunkCodec.is_incompressible(data):
+            return None, data
+
+        if self.codec == 'zlib':
+            compressed = zlib.compress(data, self.level)
+        elif self.codec == 'lzma':
+            compressed = lzma.compress(data, preset=min(self.level, 9))
+        elif self.codec == 'lz4':
+            compressed = lz4.frame.compress(data, compression_level=self.level)
+        else:
+            compressed = zstandard.ZstdCompressor(level=self.level).compress(data)
+
+        if len(compressed) > len(data) * ChunkCodec.MIN_RATIO:
+            return None, data
+        return self.codec, compressed
+
+    """
+        Compress the data of several chunks given as a dictionary {n: data}, in parallel if we can.
+        Return a dictionary {n: (codec, data)}.
+    """
+    def encode_all(self, chunks):
+        if self.codec is None:
+            return {n: (None, data) for n, data in chunks.items()}
+
+        if self.threads <= 0 or len(chunks) <= 1:
+            return {n: self.encode(data) for n, data in chunks.items()}
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        numbers = list(chunks.keys())
+        return dict(zip(numbers, self.executor.map(self.encode, [chunks[n] for n in numbers])))
+
+    """
+        Decompress the data of a chunk stored with the given codec (None if it is not compressed)
+    """
+    @staticmethod
+    def decode(codec, data):
+        if codec is None:
+            return data
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        if codec == 'lzma':
+            return lzma.decompress(data)
+        if codec == 'lz4' and lz4 is not None:
+            return lz4.frame.decompress(data)
+        if codec == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(data)
+        raise ValueError('Impossible to read a chunk compressed with the unavailable codec "' + str(codec) + '"')
@@ -0,0 +1,65 @@
+#!/usr/lib/mongofs/environment/bin/python
+import time
+import threading
+
+"""
+    Background deletion of the chunks of the deleted files. Deleting a big file only removes its document and leaves a
+    tombstone, so an unlink (or a rm -rf) does not wait for the deletion of thousands of chunks. A background thread
+    then deletes the chunks of the tombstones by batches, limited to a number of chunks per second so it does not slow
+    down the other queries.
+"""
+class ChunkReaper:
+    # Maximum number of chunks deleted by one batch
+    MAX_BATCH = 1000
+
+    def __init__(self, reap, chunks_per_second, interval):
+        # Function deleting at most a given number of chunks of the tombstones, and returning how many it deleted:
+        # reap(max_chunks)
+        self.reap = reap
+        self.chunks_per_second = chunks_per_second
+        # Time (in seconds) we wait before looking for new tombstones, once there is nothing left to delete
+        self.interval = interval
+        self.thread = None
+        self.lock = threading.Lock()
+
+    """
+        Indicate if the chunks are deleted in background, otherwise they are directly deleted with their file.
+    """
+    def enabled(self):
+        return self.chunks_per_second > 0
+
+    """
+        Number of chunks deleted by every batch
+    """
+    def batch_size(self):
+        return max(1, min(ChunkReaper.MAX_BATCH, int(self.chunks_per_second)))
+
+    """
+        Start the background thread, if it is not already running
+    """
+    def start(self):
+        if not self.enabled():
+            return
+
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    """
+        Background thread deleting the chunks batch after batch, without going above the rate limit
+    """
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                deleted = self.reap(self.batch_size())
+            except Exception as e:
+                print('Problem to delete the chunks of the deleted files: ' + str(e))
+                deleted = 0
+
+            if deleted > 0:
+                time.sleep(max(0, deleted / self.chunks_per_second - (time.time() - started)))
+            else:
+                time.sleep(self.interval)
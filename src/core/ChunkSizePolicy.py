@@ -0,0 +1,62 @@
+#!/usr/lib/mongofs/environment/bin/python
+import threading
+from fnmatch import fnmatch
+from expiringdict import ExpiringDict
+
+"""
+    Choose the chunk size of every file. Big chunks are better to stream big files, but a small read or write in a file
+    moves a whole chunk between MongoDB and us, so the files read or written at random places need smaller chunks.
+    The chunk size of a new file only depends on the path rules, as we do not know its size yet. The "rechunk" admin
+    command uses the size of the existing files, and the access pattern we observed, to find the badly sized ones.
+"""
+class ChunkSizePolicy:
+    # Number of accesses far from the previous one (more than a chunk away) before considering that a file is
+    # accessed randomly
+    RANDOM_ACCESSES = 16
+
+    def __init__(self, default_chunk_size, rules, size_classes, random_access_chunk_size):
+        self.default_chunk_size = default_chunk_size
+        # List of {'path': glob pattern, 'chunk_size': bytes}, the first matching rule is used
+        self.rules = rules
+        # List of {'max_length': bytes, 'chunk_size': bytes}, the smallest matching class is used
+        self.size_classes = sorted(size_classes, key=lambda size_class: size_class['max_length'])
+        self.random_access_chunk_size = random_access_chunk_size
+        self.accesses = ExpiringDict(max_len=10000, max_age_seconds=600)
+        self.lock = threading.Lock()
+
+    """
+        Return the chunk size to use for a file. Its length is None for a new file.
+    """
+    def chunk_size(self, filepath, length=None, random_access=False):
+        for rule in self.rules:
+            if fnmatch(filepath, rule['path']):
+                return rule['chunk_size']
+
+        if random_access and self.random_access_chunk_size > 0:
+            return self.random_access_chunk_size
+
+        if length is not None:
+            for size_class in self.size_classes:
+                if length <= size_class['max_length']:
+                    return size_class['chunk_size']
+        return self.default_chunk_size
+
+    """
+        Register a read or a write on a file. Return True the first time we detect that the file is accessed randomly
+        and its chunks are too big for that, so the caller can remember it in the file document.
+    """
+    def record_access(self, file, offset, size):
+        if self.random_access_chunk_size <= 0 or file.chunkSize <= self.random_access_chunk_size:
+            return False
+        if file.json.get('random_access', False):
+            return False
+
+        with self.lock:
+            access = self.accesses.get(file._id)
+            if access is None:
+                access = {'next_offset': 0, 'random': 0}
+            if abs(offset - access['next_offset']) > file.chunkSize:
+                access['random'] += 1
+            access['next_offset'] = offset + size
+            self.accesses[file._id] = access
+            return access['random'] == ChunkSizePolicy.RANDOM_ACCESSES
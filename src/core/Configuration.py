@@ -61,6 +61,52 @@ class Configuration:
     def mongo_write_j(self):
         return self.conf['mongo']['write_j']
 
+    """
+        Return the write acknowledgement of the data (chunks, payloads, extents). It can be lower than the one of the
+        metadata, as the data is confirmed by a fsync. By default, it is the same as the metadata. Not used on a sharded
+        cluster, where a fsync cannot confirm the data of the other shards.
+    """
+    def durability_data_write_acknowledgement(self):
+        w = self.conf.get('durability', {}).get('data_write_acknowledgement', self.mongo_write_acknowledgement())
+        if w == 0:
+            raise ValueError('Invalid data write acknowledgement, the writes of data must be acknowledged.')
+        return w
+
+    """
+        If set to True, wait for the MongoDB journaling to acknowledge the writes of data. By default, it is the same as
+        the metadata.
+    """
+    def durability_data_write_j(self):
+        return self.conf.get('durability', {}).get('data_write_j', self.mongo_write_j())
+
+    """
+        Return the write acknowledgement used to confirm every previous write of a file when it is fsync-ed. Can be
+        "majority".
+    """
+    def durability_fsync_write_acknowledgement(self):
+        return self.conf.get('durability', {}).get('fsync_write_acknowledgement', 'majority')
+
+    """
+        If set to True, a fsync also waits for the MongoDB journaling
+    """
+    def durability_fsync_write_j(self):
+        return self.conf.get('durability', {}).get('fsync_write_j', True)
+
+    """
+        If set to True, store the full path of each generic file in its document (with an index on it), to resolve any
+        path with a single query. Run the "backfill-paths" admin command before enabling it on an existing file system.
+    """
+    def mongo_materialized_paths(self):
+        return self.conf['mongo'].get('materialized_paths', False)
+
+    """
+        If set to True, the data of every chunk is stored once in the "files.payloads" collection, identified by its
+        hash, and the chunks only reference it. Identical chunks of different files (or of the same file) are then only
+        stored once.
+    """
+    def mongo_deduplication(self):
+        return self.conf['mongo'].get('deduplication', False)
+
     """
         Return the maximum amount of time (in seconds) we can allow a lock to be set on a file without any operation on it. If the timeout
         happens, we release the lock (to avoid locking file eternity if there is a problem).
@@ -101,6 +147,38 @@ class Configuration:
             return 0
         return self.conf['cache']['max_elements']
 
+    """
+        Return the maximum amount of time (in seconds) we can remember that a file does not exist. Files created by the
+        current host are directly removed from that cache, so the value only matters for files created by other hosts.
+        Value <= 0 means disabled.
+    """
+    def negative_cache_timeout(self):
+        timeout = self.conf.get('negative_cache', {}).get('timeout_s', 0)
+        if timeout <= 0:
+            return 0
+        return timeout
+
+    """
+        Return the maximum number of missing files we can remember.
+    """
+    def negative_cache_max_elements(self):
+        max_elements = self.conf.get('negative_cache', {}).get('max_elements', 10000)
+        if max_elements <= 0:
+            return 0
+        return max_elements
+
+    """
+        Return the maximum number of directories for which we keep a Bloom filter of their filenames (built when they
+        are listed), to know if a file is missing without contacting MongoDB. They are kept as long as the entries of
+        the negative cache.
+        Value <= 0 means disabled.
+    """
+    def negative_cache_bloom_filters(self):
+        bloom_filters = self.conf.get('negative_cache', {}).get('bloom_filters', 0)
+        if bloom_filters <= 0:
+            return 0
+        return bloom_filters
+
     """ 
         Return the maximum amount of time (in seconds) we can keep the data cache for a file. Only used for the data 
         themselves, so should not be too big.
@@ -112,12 +190,189 @@ class Configuration:
         return self.conf['data_cache']['timeout_s']
 
     """
-        Return the maximum number of entries we can keep in the data cache.
+        Return the maximum size (in bytes) of the chunks we can keep in the data cache. The configurations written
+        before "data_cache.max_bytes" only have "data_cache.max_elements", we then keep that number of chunks.
+    """
+    def data_cache_max_bytes(self):
+        data_cache = self.conf.get('data_cache', {})
+        if 'max_bytes' in data_cache:
+            max_bytes = data_cache['max_bytes']
+        elif 'max_elements' in data_cache:
+            max_bytes = data_cache['max_elements'] * self.chunk_size()
+        else:
+            max_bytes = 256 * 1024 * 1024
+        if max_bytes <= 0:
+            return 0
+        return max_bytes
+
+    """
+        Return the maximum number of directories we can keep in the path-resolution cache. Those entries are updated
+        on every mkdir / rmdir / rename done by the current host, so they do not rely on "cache.timeout_s".
+        Value <= 0 means disabled.
+    """
+    def directory_cache_max_elements(self):
+        max_elements = self.conf.get('directory_cache', {}).get('max_elements', 100000)
+        if max_elements <= 0:
+            return 0
+        return max_elements
+
+    """
+        Return the maximum amount of time (in seconds) we can keep a directory in the path-resolution cache. Only useful
+        if other hosts can rename / delete directories, as they will not update our cache. By default, the same as the
+        cache of the generic files.
+        Value <= 0 means infinity.
+    """
+    def directory_cache_timeout(self):
+        timeout = self.conf.get('directory_cache', {}).get('timeout_s', self.cache_timeout())
+        if timeout <= 0:
+            return 0
+        return timeout
+
+    """
+        If set to True, readdir() also returns the attributes of every file, like a getattr() would do.
+    """
+    def readdir_attributes(self):
+        return self.conf.get('readdir_attributes', False)
+
+    """
+        Return the maximum number of chunks we can load in advance for a file read sequentially. Their total size is
+        also limited to a quarter of the data cache.
+        Value <= 0 means disabled.
+    """
+    def read_ahead_max_chunks(self):
+        max_chunks = self.conf.get('read_ahead', {}).get('max_chunks', 0)
+        if max_chunks <= 0:
+            return 0
+        return max_chunks
+
+    """
+        Return the number of threads used to load the chunks in advance.
+    """
+    def read_ahead_threads(self):
+        return self.conf.get('read_ahead', {}).get('threads', 2)
+
+    """
+        Return the number of threads used to load the missing chunks of a read in parallel, with one query per range
+        of chunks. Useful on a sharded cluster, where the chunks of a file can be on different shards.
+        Value <= 0 means disabled, a single query is done for the whole read.
+    """
+    def parallel_reads_threads(self):
+        threads = self.conf.get('parallel_reads', {}).get('threads', 0)
+        if threads <= 0:
+            return 0
+        return threads
+
+    """
+        Return the maximum number of chunks loaded by one query when we load them in parallel.
+    """
+    def parallel_reads_chunks_per_query(self):
+        return max(1, self.conf.get('parallel_reads', {}).get('chunks_per_query', 1))
+
+    """
+        Return the maximum size (in bytes) of the data written to the files but not yet sent to MongoDB. Above it, the
+        writes wait for the background threads.
+        Value <= 0 means disabled, every write is directly sent to MongoDB.
     """
-    def data_cache_max_elements(self):
-        if self.conf['data_cache']['max_elements'] <= 0:
+    def write_buffer_max_bytes(self):
+        max_bytes = self.conf.get('write_buffer', {}).get('max_bytes', 64 * 1024 * 1024)
+        if max_bytes <= 0:
             return 0
-        return self.conf['data_cache']['max_elements']
+        return max_bytes
+
+    """
+        Return the maximum amount of time (in seconds) we can keep written data before sending it to MongoDB.
+    """
+    def write_buffer_flush_interval(self):
+        return max(0, self.conf.get('write_buffer', {}).get('flush_interval_s', 5))
+
+    """
+        Return the number of threads sending the written data to MongoDB in background.
+    """
+    def write_buffer_threads(self):
+        return self.conf.get('write_buffer', {}).get('threads', 2)
+
+    """
+        Return the codec used to compress the chunks (zlib, lzma, and lz4 or zstd if their package is installed), or
+        None if they are not compressed.
+    """
+    def compression_codec(self):
+        codec = self.conf.get('compression', {}).get('codec', 'none')
+        if codec == 'none':
+            return None
+        return codec
+
+    """
+        Return the compression level, its meaning depends on the codec
+    """
+    def compression_level(self):
+        return self.conf.get('compression', {}).get('level', 6)
+
+    """
+        Return the number of threads used to compress the chunks of a flush in parallel.
+        Value <= 0 means the chunks are compressed by the thread writing them.
+    """
+    def compression_threads(self):
+        return self.conf.get('compression', {}).get('threads', 2)
+
+    """
+        Return the maximum size (in bytes) of the files whose data is stored in their own document, instead of chunks.
+        Reading such a file does not need any other query. It cannot be bigger than the chunk size of the file.
+        Value <= 0 means disabled.
+    """
+    def inline_data_max_bytes(self):
+        max_bytes = self.conf.get('inline_data', {}).get('max_bytes', 0)
+        if max_bytes <= 0:
+            return 0
+        return max_bytes
+
+    """
+        Return the number of extents of a log-structured file above which they are folded into its chunks, in
+        background.
+        Value <= 0 means disabled, the extents are only compacted by the "compact" admin command.
+    """
+    def log_structured_compaction_extents(self):
+        return self.conf.get('log_structured', {}).get('compaction_extents', 64)
+
+    """
+        Return the number of threads compacting the extents of the log-structured files
+    """
+    def log_structured_compaction_threads(self):
+        return self.conf.get('log_structured', {}).get('compaction_threads', 1)
+
+    """
+        Return the time (in seconds) the writes wait for the ones of other threads, to send them together. The
+        configuration is in milliseconds.
+        Value <= 0 means disabled, every write is sent directly.
+    """
+    def group_commit_window(self):
+        return max(0, self.conf.get('group_commit', {}).get('window_ms', 0)) / 1000.0
+
+    """
+        Return the maximum number of writes sent together, a batch is sent as soon as it has that many writes.
+    """
+    def group_commit_max_operations(self):
+        return self.conf.get('group_commit', {}).get('max_operations', 1000)
+
+    """
+        Return the maximum amount of time (in seconds) we can keep the increments of the counters of the directories
+        (number of files, st_nlink) before sending them to MongoDB.
+        Value <= 0 means disabled, every increment is directly sent.
+    """
+    def directory_counters_flush_interval(self):
+        return max(0, self.conf.get('directory_counters', {}).get('flush_interval_s', 0))
+
+    """
+        Return the maximum number of chunks of the deleted files deleted every second, in background.
+        Value <= 0 means disabled, the chunks of a file are directly deleted with it.
+    """
+    def reaper_chunks_per_second(self):
+        return max(0, self.conf.get('reaper', {}).get('chunks_per_second', 0))
+
+    """
+        Return the time (in seconds) between two looks for new deleted files, once every chunk is deleted.
+    """
+    def reaper_interval(self):
+        return max(1, self.conf.get('reaper', {}).get('interval_s', 10))
 
     """
         Return the hostname of the current server
@@ -135,11 +390,46 @@ class Configuration:
         The chunk size in gridfs. Value must be between 1 and 15MB maximum (to allow overhead of other fields)
     """
     def chunk_size(self):
-        chunk_size = self.conf['mongo']['chunk_size']
+        return self.check_chunk_size(self.conf['mongo']['chunk_size'])
+
+    """
+        Return the given chunk size if it is valid, otherwise raise a ValueError
+    """
+    def check_chunk_size(self, chunk_size):
         if chunk_size < 1 or chunk_size > 15 * 1024 * 1024:
             raise ValueError('Invalid chunk size, must be between 1 and ' + str(15 * 1024 * 1024) + ' bytes.')
         return chunk_size
 
+    """
+        Return the rules giving the chunk size of the files by path, as a list of {'path': glob pattern,
+        'chunk_size': bytes}. The first matching rule is used, even for new files.
+    """
+    def chunk_size_rules(self):
+        rules = self.conf.get('chunk_size_policy', {}).get('rules', [])
+        for rule in rules:
+            self.check_chunk_size(rule['chunk_size'])
+        return rules
+
+    """
+        Return the chunk size of the files by size class, as a list of {'max_length': bytes, 'chunk_size': bytes}.
+        Only used to re-chunk the existing files, as we do not know the size of a new file.
+    """
+    def chunk_size_classes(self):
+        size_classes = self.conf.get('chunk_size_policy', {}).get('size_classes', [])
+        for size_class in size_classes:
+            self.check_chunk_size(size_class['chunk_size'])
+        return size_classes
+
+    """
+        Return the chunk size of the files we saw accessed at random places.
+        Value <= 0 means disabled, their chunk size only depends on their size.
+    """
+    def random_access_chunk_size(self):
+        chunk_size = self.conf.get('chunk_size_policy', {}).get('random_access_chunk_size', 0)
+        if chunk_size <= 0:
+            return 0
+        return self.check_chunk_size(chunk_size)
+
     """
         Sets the default mode of the root node in mongofs
     """
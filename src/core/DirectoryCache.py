@@ -0,0 +1,118 @@
+#!/usr/lib/mongofs/environment/bin/python
+import time
+import threading
+from collections import OrderedDict
+
+"""
+    In-process trie of the directory hierarchy, used to resolve a filepath to the _id of its last directory without
+    contacting MongoDB.
+    Every node of the trie is a directory, identified by its _id. Every edge is indexed by (parent directory _id, name),
+    so renaming a directory only changes one edge, its sub-directories are still reachable through their own edges.
+    The edge of the root directory (None, '') is pinned, the other edges are evicted in LRU order.
+"""
+class DirectoryCache:
+    def __init__(self, max_elements, timeout):
+        self.max_elements = max_elements
+        self.timeout = timeout
+        self.root_id = None
+        self.edges = OrderedDict()
+        self.lock = threading.Lock()
+
+    """
+        Follow the given directory names from the root of the file system, as long as we know them.
+        Return a tuple (directory_id, resolved) with "resolved" the number of names we were able to follow, and
+        "directory_id" the _id of the last directory we reached (None if we could not resolve anything).
+    """
+    def resolve(self, names):
+        directory_id = None
+        resolved = 0
+        with self.lock:
+            for name in names:
+                if directory_id is None and name == '' and self.root_id is not None:
+                    directory_id = self.root_id
+                    resolved += 1
+                    continue
+
+                key = (directory_id, name)
+                if key not in self.edges:
+                    break
+
+                child_id, dt = self.edges[key]
+                if self.timeout > 0 and dt + self.timeout < time.time():
+                    del self.edges[key]
+                    break
+
+                self.edges.move_to_end(key)
+                directory_id = child_id
+                resolved += 1
+
+        return directory_id, resolved
+
+    """
+        Add a directory to the trie, directly under its parent.
+    """
+    def add(self, parent_id, name, directory_id):
+        if self.max_elements <= 0:
+            return
+
+        with self.lock:
+            if parent_id is None and name == '':
+                self.root_id = directory_id
+                return
+
+            key = (parent_id, name)
+            self.edges[key] = (directory_id, time.time())
+            self.edges.move_to_end(key)
+            while len(self.edges) > self.max_elements:
+                self.edges.popitem(last=False)
+
+    """
+        Remove a directory from the trie. The edges of its children become unreachable, and will be evicted by the LRU
+        once they are not needed anymore.
+    """
+    def remove(self, parent_id, name):
+        with self.lock:
+            if parent_id is None and name == '':
+                self.root_id = None
+                return
+            self.edges.pop((parent_id, name), None)
+
+    """
+        Remove the edges followed by the given directory names that were added more than "min_age" seconds ago, as
+        one of them might lead to a directory deleted (and maybe created again) by another host. Return True if we
+        removed any.
+    """
+    def invalidate(self, names, min_age=0):
+        removed = False
+        directory_id = None
+        with self.lock:
+            for name in names:
+                if directory_id is None and name == '' and self.root_id is not None:
+                    directory_id = self.root_id
+                    continue
+
+                key = (directory_id, name)
+                if key not in self.edges:
+                    break
+
+                child_id, dt = self.edges[key]
+                if dt + min_age <= time.time():
+                    del self.edges[key]
+                    removed = True
+                directory_id = child_id
+        return removed
+
+    """
+        Move a directory to another parent and / or name. Its whole subtree stays valid.
+    """
+    def rename(self, parent_id, name, destination_parent_id, destination_name, directory_id):
+        self.remove(parent_id=parent_id, name=name)
+        self.add(parent_id=destination_parent_id, name=destination_name, directory_id=directory_id)
+
+    """
+        Drop every entry, the root included
+    """
+    def clear(self):
+        with self.lock:
+            self.root_id = None
+            self.edges = OrderedDict()
@@ -0,0 +1,99 @@
+#!/usr/lib/mongofs/environment/bin/python
+import time
+import threading
+
+"""
+    Delayed increments of the counters of the directories (their number of files, and st_nlink). Every creation in a
+    directory increases them in the document of the directory, which becomes a write hotspot when a lot of files are
+    created in the same directory. The increments are accumulated locally, and sent periodically with a single $inc by
+    directory.
+    The counters must never be bigger than the real number of files, so the decrements are never delayed: they first
+    cancel the local increments of the directory (the file was created by us, and its increment not sent yet), and the
+    remaining part is sent directly by the caller.
+"""
+class DirectoryCounters:
+    def __init__(self, send, flush_interval):
+        # Function sending the increments of several directories: send({directory_id: value})
+        self.send = send
+        self.flush_interval = flush_interval
+        self.deltas = {}
+        self.flusher = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    """
+        Indicate if the increments are delayed, otherwise every increment is directly sent to MongoDB.
+    """
+    def enabled(self):
+        return self.flush_interval > 0
+
+    """
+        Increase the counters of a directory, they will be sent later
+    """
+    def add(self, directory_id, value):
+        with self.lock:
+            self.deltas[directory_id] = self.deltas.get(directory_id, 0) + value
+        self.start_flusher()
+
+    """
+        Decrease the counters of a directory, by cancelling the increments not sent yet. Return the part of the value
+        we could not cancel, the caller must send it.
+    """
+    def cancel(self, directory_id, value):
+        with self.lock:
+            delta = self.deltas.get(directory_id, 0)
+            cancelled = min(delta, value)
+            if cancelled <= 0:
+                return value
+            if delta == cancelled:
+                del self.deltas[directory_id]
+            else:
+                self.deltas[directory_id] = delta - cancelled
+            return value - cancelled
+
+    """
+        Return the increments of a directory not sent yet
+    """
+    def pending(self, directory_id):
+        with self.lock:
+            return self.deltas.get(directory_id, 0)
+
+    """
+        Send the increments of every directory. If it fails, they are kept for the next flush.
+    """
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                deltas = self.deltas
+                self.deltas = {}
+            if len(deltas) == 0:
+                return
+
+            try:
+                self.send(deltas)
+            except Exception:
+                with self.lock:
+                    for directory_id, value in deltas.items():
+                        self.deltas[directory_id] = self.deltas.get(directory_id, 0) + value
+                raise
+
+    """
+        Background thread sending the increments periodically
+    """
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+
+        def flusher():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print('Problem to update the counters of the directories: ' + str(e))
+
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=flusher, daemon=True)
+        self.flusher.start()
@@ -0,0 +1,51 @@
+#!/usr/lib/mongofs/environment/bin/python
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+    Background compaction of the log-structured files. Every flush of such a file only inserts small extent documents,
+    which the reads need to merge with the chunks. Once a file has too many of them, a background thread folds them
+    into its chunks.
+"""
+class ExtentCompactor:
+    def __init__(self, compact, max_extents, threads):
+        # Function folding the extents of a file into its chunks: compact(file)
+        self.compact = compact
+        self.max_extents = max_extents
+        self.threads = threads
+        self.executor = None
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    """
+        Indicate if the extents are compacted in background
+    """
+    def enabled(self):
+        return self.max_extents > 0 and self.threads > 0
+
+    """
+        Register new extents for a file, and compact them in background if there are too many.
+    """
+    def notify(self, file):
+        if not self.enabled() or file.json.get('extents', 0) < self.max_extents:
+            return
+
+        with self.lock:
+            if file._id in self.pending:
+                return
+            self.pending.add(file._id)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.executor.submit(self.run, file)
+
+    """
+        Background job compacting the extents of a file
+    """
+    def run(self, file):
+        with self.lock:
+            self.pending.discard(file._id)
+
+        try:
+            self.compact(file)
+        except Exception as e:
+            print('Problem to compact the extents of the file ' + str(file._id) + ': ' + str(e))
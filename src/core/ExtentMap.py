@@ -0,0 +1,125 @@
+#!/usr/lib/mongofs/environment/bin/python
+import bisect
+
+"""
+    Interval map of the dirty data of a file. Every extent is a range of bytes [start, start + len(data)), the extents
+    are sorted, and never overlap nor touch each other: a write overlapping or adjacent to existing extents is merged
+    with them, the most recent data replacing the previous one.
+"""
+class ExtentMap:
+    def __init__(self):
+        # Start of every extent, to find them with a bisect
+        self.starts = []
+        # List of [start, bytearray], in the same order
+        self.extents = []
+        self.size = 0
+
+    """
+        Add data written at a given offset
+    """
+    def add(self, offset, data):
+        if len(data) == 0:
+            return
+        end = offset + len(data)
+
+        # Extents touching [offset, end]
+        i = bisect.bisect_left(self.starts, offset)
+        if i > 0 and self.extents[i - 1][0] + len(self.extents[i - 1][1]) >= offset:
+            i -= 1
+        j = i
+        while j < len(self.extents) and self.extents[j][0] <= end:
+            j += 1
+
+        touched = self.extents[i:j]
+        previous_size = sum(len(extent[1]) for extent in touched)
+        if len(touched) == 1 and touched[0][0] <= offset:
+            # Most common case (sequential writes): we directly extend the existing extent
+            start, buffer = touched[0]
+            buffer[offset - start:end - start] = data
+            extent = touched[0]
+        else:
+            start = min([offset] + [extent[0] for extent in touched])
+            last = max([end] + [extent[0] + len(extent[1]) for extent in touched])
+            buffer = bytearray(last - start)
+            for extent_start, extent_data in touched:
+                buffer[extent_start - start:extent_start - start + len(extent_data)] = extent_data
+            buffer[offset - start:end - start] = data
+            extent = [start, buffer]
+
+        self.extents[i:j] = [extent]
+        self.starts[i:j] = [extent[0]]
+        self.size += len(extent[1]) - previous_size
+
+    """
+        Return the parts of the extents between offset and offset + size, as a list of (position, bytes).
+    """
+    def read(self, offset, size):
+        end = offset + size
+        parts = []
+        i = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while i < len(self.extents) and self.extents[i][0] < end:
+            start, data = self.extents[i]
+            first = max(start, offset)
+            last = min(start + len(data), end)
+            if first < last:
+                parts.append((first, bytes(data[first - start:last - start])))
+            i += 1
+        return parts
+
+    """
+        Remove the range [offset, end) from the extents, and return what was removed as a list of (position, bytes)
+    """
+    def remove(self, offset, end):
+        removed = self.read(offset, end - offset)
+
+        first = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        i = first
+        kept = []
+        while i < len(self.extents) and self.extents[i][0] < end:
+            start, data = self.extents[i]
+            if start + len(data) <= offset:
+                kept.append(self.extents[i])
+            else:
+                if start < offset:
+                    kept.append([start, data[0:offset - start]])
+                if start + len(data) > end:
+                    kept.append([end, data[end - start:]])
+            i += 1
+        self.extents[first:i] = kept
+        self.starts[first:i] = [extent[0] for extent in kept]
+        self.size -= sum(len(data) for position, data in removed)
+        return removed
+
+    """
+        Return the numbers of the chunks entirely covered by the extents
+    """
+    def full_chunks(self, chunk_size):
+        chunks = []
+        for start, data in self.extents:
+            chunks.extend(range((start + chunk_size - 1) // chunk_size, (start + len(data)) // chunk_size))
+        return chunks
+
+    """
+        Split the extents by chunk, as a dictionary {n: [(start, bytes), ...]} with "start" the position of the data
+        in the chunk n.
+    """
+    def chunks(self, chunk_size):
+        chunks = {}
+        for offset, data in self.extents:
+            data = memoryview(data)
+            while len(data) > 0:
+                n = offset // chunk_size
+                start = offset - n * chunk_size
+                piece = data[0:chunk_size - start]
+                chunks.setdefault(n, []).append((start, bytes(piece)))
+                data = data[len(piece):]
+                offset += len(piece)
+        return chunks
+
+    """
+        End of the last extent
+    """
+    def end(self):
+        if len(self.extents) == 0:
+            return 0
+        return self.extents[-1][0] + len(self.extents[-1][1])
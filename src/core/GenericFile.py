@@ -44,6 +44,9 @@ class GenericFile:
     LOCK_WRITE = LOCK_EXCLUSIVE  # fcntl.F_WRLCK
     LOCK_UNLOCK = 2             # fcntl.F_UNLCK
 
+    # Special attribute activating the log-structured mode of a file, or of the new files of a directory
+    LOG_STRUCTURED_XATTR = 'user.mongofs.log_structured'
+
     # Link to the mongo instance, created at startup
     mongo = None
     configuration = None
@@ -81,6 +84,13 @@ class GenericFile:
         GenericFile.mongo.basic_save(generic_file=self, metadata=self.metadata,
                                      attrs=self.attrs, host=self.host, uname=self.uname, gname=self.gname)
 
+    """
+        Indicates if the data written to the file is appended as extents (see Mongo.append_extents), or if it is the
+        default for the new files of a directory. Activated by setting the special attribute to "1".
+    """
+    def is_log_structured(self):
+        return self.attrs.get(GenericFile.LOG_STRUCTURED_XATTR) in (b'1', '1')
+
     """
         Indicates if the current GenericFile is in fact a directory
     """
@@ -126,7 +136,8 @@ class GenericFile:
     def new_generic_file(filepath, mode, file_type, target=None):
         directory_id = None
 
-        if not GenericFile.is_generic_filepath_available(filepath=filepath):
+        # With the unique index, the insert itself tells us if the generic file already exists
+        if not GenericFile.mongo.unique_filenames and not GenericFile.is_generic_filepath_available(filepath=filepath):
             print('GenericFile not available for ' + filepath)
             raise FuseOSError(errno.ENOENT)
 
@@ -136,6 +147,8 @@ class GenericFile:
 
         if filepath != '/':
             directory = GenericFile.get_directory(filepath=filepath)
+            if directory is None:
+                raise FuseOSError(errno.ENOENT)
             directory_id = directory._id
 
             if not GenericFile.has_user_access_right(directory, GenericFile.WRITE_RIGHTS, current_user):
@@ -148,8 +161,6 @@ class GenericFile:
                 if file_type == GenericFile.DIRECTORY_TYPE:
                     mode |= S_ISGID
 
-            GenericFile.mongo.add_nlink_directory(directory_id=directory._id, value=1)
-
         # Basic structure of the document to create in MongoDB
         filename = filepath.split('/')[-1]
         dt = time.time()
@@ -169,19 +180,27 @@ class GenericFile:
             'uname': current_user['uname'],
             'gname': GenericFile.mongo.get_groupname(gid),
             'host': GenericFile.mongo.configuration.hostname(),
-            'chunkSize': GenericFile.mongo.configuration.chunk_size(),  # gridfs field name, we need to keep it that way
+            'chunkSize': GenericFile.mongo.chunk_size_policy.chunk_size(filepath),  # gridfs field name, we need to keep it that way
             'length': 0
         }
+        if GenericFile.mongo.configuration.mongo_materialized_paths():
+            struct['path'] = filepath
+
+        # The new files of a log-structured directory are log-structured too
+        if directory_id is not None and directory.is_log_structured():
+            struct['attrs'] = {GenericFile.LOG_STRUCTURED_XATTR: directory.attrs[GenericFile.LOG_STRUCTURED_XATTR]}
 
         if file_type == GenericFile.FILE_TYPE:
             struct['metadata']['st_nlink'] = 1
             struct['metadata']['st_mode'] = (S_IFREG | mode)
             struct['metadata']['st_blocks'] = 0
+            struct['allocated_chunks'] = 0
         elif file_type == GenericFile.DIRECTORY_TYPE:
             # If this is a directory, the default value st_nlink must be 2, to be sure to have a non-zero value if there is no
             # referenced file in the directory
             struct['metadata']['st_nlink'] = 2
             struct['metadata']['st_mode'] = (S_IFDIR | mode)
+            struct['children'] = 0
         elif file_type == GenericFile.SYMBOLIC_LINK_TYPE:
             struct['metadata']['st_nlink'] = 1
             struct['metadata']['st_mode'] = (S_IFLNK | mode)
@@ -197,6 +216,11 @@ class GenericFile:
         f = GenericFile(json=struct)
         GenericFile.mongo.create_generic_file(f)
 
+        # The counter of the directory is only increased once the file exists, so it can never be bigger than the real
+        # number of files in it, even if we crash in-between.
+        if directory_id is not None:
+            GenericFile.mongo.add_nlink_directory(directory_id=directory_id, value=1)
+
         return f
 
     """
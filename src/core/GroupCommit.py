@@ -0,0 +1,117 @@
+#!/usr/lib/mongofs/environment/bin/python
+import threading
+import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+"""
+    Group commit of the small writes done by concurrent threads: the creation of many small files at the same time
+    (untar, checkout, ...) sends a few operations per file, each waiting for a round-trip to MongoDB. The writes
+    received during a short window are sent together, with a single unordered bulk_write per collection. Every caller
+    still waits until its own writes are done, and receives its own errors, so nothing changes for it, except a few
+    milliseconds of latency.
+"""
+class GroupCommit:
+    # Error code of MongoDB for a duplicate key
+    DUPLICATE_KEY = 11000
+
+    def __init__(self, bulk_write, window, max_operations):
+        # Function sending a list of requests to a collection: bulk_write(coll, requests)
+        self.bulk_write = bulk_write
+        # Time (in seconds) we wait for other writes before sending a batch
+        self.window = window
+        self.max_operations = max_operations
+        # Batch currently waiting for other writes, None if there is no such batch
+        self.batch = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    """
+        Indicate if the writes are grouped, otherwise every caller sends its own writes
+    """
+    def enabled(self):
+        return self.window > 0 and self.max_operations > 1
+
+    """
+        Send some requests (InsertOne, UpdateOne, ...) to a collection with the writes of the other threads, and wait
+        for them. Return a dictionary with the number of documents created by the requests (inserted or upserted).
+        We do not know which updates matched a document, so the updates whose caller needs it are not sent here.
+        Raise DuplicateKeyError or OperationFailure if one of the requests failed.
+    """
+    def submit(self, coll, requests):
+        entry = {'coll': coll, 'requests': requests, 'result': None, 'error': None}
+        with self.condition:
+            batch = self.batch
+            leader = batch is None
+            if leader:
+                batch = {'entries': [], 'operations': 0, 'done': threading.Event()}
+                self.batch = batch
+            batch['entries'].append(entry)
+            batch['operations'] += len(requests)
+            full = batch['operations'] >= self.max_operations
+            if full:
+                self.batch = None
+                self.condition.notify_all()
+
+        if full:
+            self.commit(batch)
+        elif leader:
+            # The first writer of a batch waits for the others, then sends it, except if it was filled in-between
+            with self.condition:
+                self.condition.wait_for(lambda: self.batch is not batch, timeout=self.window)
+                send = self.batch is batch
+                if send:
+                    self.batch = None
+            if send:
+                self.commit(batch)
+
+        batch['done'].wait()
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+    """
+        Send the requests of a batch, one bulk_write by collection, and give its result to every caller
+    """
+    def commit(self, batch):
+        try:
+            collections = {}
+            for entry in batch['entries']:
+                collections.setdefault(entry['coll'], []).append(entry)
+            for coll, entries in collections.items():
+                self.commit_collection(coll, entries)
+        except Exception as e:
+            for entry in batch['entries']:
+                if entry['result'] is None and entry['error'] is None:
+                    entry['error'] = e
+        finally:
+            batch['done'].set()
+
+    """
+        Send the requests of several callers to the same collection, and split the result between them
+    """
+    def commit_collection(self, coll, entries):
+        requests = [request for entry in entries for request in entry['requests']]
+        try:
+            result = self.bulk_write(coll, requests)
+            errors = []
+            upserted = set(result.upserted_ids.keys())
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            upserted = set(upsert['index'] for upsert in e.details.get('upserted', []))
+
+        first = 0
+        for entry in entries:
+            last = first + len(entry['requests'])
+            failed = [error for error in errors if first <= error['index'] < last]
+            if len(failed) > 0:
+                error = failed[0]
+                if error.get('code') == GroupCommit.DUPLICATE_KEY:
+                    entry['error'] = DuplicateKeyError(error.get('errmsg', ''), error.get('code'))
+                else:
+                    entry['error'] = OperationFailure(error.get('errmsg', ''), error.get('code'))
+            else:
+                inserted = len([request for request in entry['requests'] if isinstance(request, pymongo.InsertOne)])
+                entry['result'] = {
+                    'created': inserted + len([n for n in range(first, last) if n in upserted])
+                }
+            first = last
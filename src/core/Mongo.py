@@ -1,18 +1,34 @@
 #!/usr/lib/mongofs/environment/bin/python
 import errno
+import hashlib
 import grp
 import pwd
 import os
+import re
 from math import floor, ceil
 import time
+import datetime
+import threading
 import pymongo
 import logging
+from collections import Counter
 from expiringdict import ExpiringDict
+from bson.objectid import ObjectId
 from fuse import FuseOSError, fuse_get_context
 from stat import S_IFDIR
 
 from src.core.Configuration import Configuration
 from src.core.MongoCache import MongoCache
+from src.core.DirectoryCache import DirectoryCache
+from src.core.ReadAhead import ReadAhead
+from src.core.WriteBuffer import WriteBuffer
+from src.core.ChunkCodec import ChunkCodec
+from src.core.ChunkSizePolicy import ChunkSizePolicy
+from src.core.ExtentMap import ExtentMap
+from src.core.ExtentCompactor import ExtentCompactor
+from src.core.GroupCommit import GroupCommit
+from src.core.DirectoryCounters import DirectoryCounters
+from src.core.ChunkReaper import ChunkReaper
 from src.core.GenericFile import GenericFile
 from src.core.File import File
 from src.core.Directory import Directory
@@ -26,6 +42,18 @@ class Mongo:
     LOCKED_FILE = 1
     FILE_NOT_FOUND = 2
 
+    # Maximum number of operations sent in one bulk_write
+    BULK_SIZE = 1000
+
+    # Age (in seconds) of a tombstone before its chunks can be deleted, so the document of its file is deleted
+    TOMBSTONE_DELAY = 5
+    # Time (in seconds) after which the tombstone claimed by a mount can be claimed by another one (it crashed)
+    TOMBSTONE_LEASE = 600
+    # Time (in seconds) after which the compaction of a file claimed by a mount can be claimed by another one
+    COMPACTION_LEASE = 60
+    # Locks serializing the compactions of the current process, a file always uses the same one
+    compaction_locks = [threading.Lock() for i in range(0, 64)]
+
     # The do_clean_up argument is useful if we want to remove all entries from the db without taking care on wrong data in it (useful for test)
     def __init__(self, do_clean_up = False):
         # We reuse the same connexion
@@ -36,6 +64,13 @@ class Mongo:
         self.gridfs_coll = Mongo.configuration.mongo_prefix() + 'files'
         self.files_coll = Mongo.configuration.mongo_prefix() + 'files.files'
         self.chunks_coll = Mongo.configuration.mongo_prefix() + 'files.chunks'
+        self.payloads_coll = Mongo.configuration.mongo_prefix() + 'files.payloads'
+        self.extents_coll = Mongo.configuration.mongo_prefix() + 'files.extents'
+        self.tombstones_coll = Mongo.configuration.mongo_prefix() + 'files.tombstones'
+
+        # Trie of the known directories, to resolve a path without contacting MongoDB
+        self.directory_cache = DirectoryCache(max_elements=Mongo.configuration.directory_cache_max_elements(),
+                                              timeout=Mongo.configuration.directory_cache_timeout())
 
         if do_clean_up is True:
             self.clean_database()
@@ -43,8 +78,44 @@ class Mongo:
         # Create the initial indexes
         self.create_indexes()
 
-        # Temporary cache for the file data
-        self.data_cache = {}
+        # Chunk size of every file
+        self.chunk_size_policy = ChunkSizePolicy(default_chunk_size=Mongo.configuration.chunk_size(),
+                                                 rules=Mongo.configuration.chunk_size_rules(),
+                                                 size_classes=Mongo.configuration.chunk_size_classes(),
+                                                 random_access_chunk_size=Mongo.configuration.random_access_chunk_size())
+
+        # Compression of the chunks we write
+        self.codec = ChunkCodec(codec=Mongo.configuration.compression_codec(), level=Mongo.configuration.compression_level(),
+                                threads=Mongo.configuration.compression_threads())
+
+        # Data written to the files, not yet sent to MongoDB
+        self.write_buffer = WriteBuffer(write=self.write_chunks, max_bytes=Mongo.configuration.write_buffer_max_bytes(),
+                                        flush_interval=Mongo.configuration.write_buffer_flush_interval(),
+                                        threads=Mongo.configuration.write_buffer_threads(), reload=self.reload_file)
+
+        # Fold the extents of the log-structured files into their chunks
+        self.compactor = ExtentCompactor(compact=self.compact_extents,
+                                         max_extents=Mongo.configuration.log_structured_compaction_extents(),
+                                         threads=Mongo.configuration.log_structured_compaction_threads())
+
+        # Small writes of concurrent threads sent together
+        self.group_commit = GroupCommit(bulk_write=Mongo.cache.bulk_write, window=Mongo.configuration.group_commit_window(),
+                                        max_operations=Mongo.configuration.group_commit_max_operations())
+
+        # Increments of the counters of the directories, sent periodically
+        self.directory_counters = DirectoryCounters(send=self.send_directory_counters,
+                                                    flush_interval=Mongo.configuration.directory_counters_flush_interval())
+
+        # Delete the chunks of the deleted files in background
+        self.chunk_reaper = ChunkReaper(reap=self.reap_tombstones, chunks_per_second=Mongo.configuration.reaper_chunks_per_second(),
+                                        interval=Mongo.configuration.reaper_interval())
+        if self.chunk_reaper.enabled() and Mongo.cache.find_one(self.tombstones_coll, {}) is not None:
+            self.chunk_reaper.start()
+
+        # Load the next chunks of the files read sequentially
+        self.read_ahead = ReadAhead(fetch=self.load_chunks, max_chunks=Mongo.configuration.read_ahead_max_chunks(),
+                                    max_bytes=Mongo.configuration.data_cache_max_bytes() // 4,
+                                    threads=Mongo.configuration.read_ahead_threads())
 
         # Temporary cache for user information
         self.user_cache = ExpiringDict(max_len=1000, max_age_seconds=2)
@@ -67,9 +138,84 @@ class Mongo:
         Create various indexes if they do not exist. Only called at startup
     """
     def create_indexes(self):
-        Mongo.cache.create_index(self.files_coll, [("directory_id", pymongo.ASCENDING), ("filename", pymongo.ASCENDING)])
-        # Gridfs drivers will automatically add {filename:1, uploadDate:1} as index too, see: https://docs.mongodb.com/manual/core/gridfs/#the-files-index
+        self.unique_filenames = self.create_filename_index()
+        if Mongo.configuration.mongo_materialized_paths():
+            # Every generic file for the renames, but only one directory by path for the lookups
+            Mongo.cache.create_index(self.files_coll, [("path", pymongo.ASCENDING)])
+            # (on other keys, as MongoDB refuses two indexes on the same keys with different options)
+            self.create_unique_index(self.files_coll, [("path", pymongo.ASCENDING), ("generic_file_type", pymongo.ASCENDING)], name='path_directories',
+                                     partialFilterExpression={'generic_file_type': GenericFile.DIRECTORY_TYPE, 'path': {'$exists': True}})
+        Mongo.cache.create_index(self.extents_coll, [("files_id", pymongo.ASCENDING), ("n", pymongo.ASCENDING)])
+        # Same index as the one created by the gridfs drivers for the chunks, see: https://docs.mongodb.com/manual/core/gridfs/#the-chunks-index
+        # We do not need their {filename:1, uploadDate:1} index on the files, as we never look for a filename alone.
+        Mongo.cache.create_index(self.chunks_coll, [("files_id", pymongo.ASCENDING), ("n", pymongo.ASCENDING)], unique=True)
+
+
+    """
+        Create a unique index on the given keys, if it does not exist yet. MongoDB refuses two indexes on the same keys
+        with different options, so the previous non-unique index is dropped just before, once we checked that no
+        documents have the same keys. Otherwise, we log them, keep (or create) a non-unique index, and return False.
+    """
+    def create_unique_index(self, coll, keys, **options):
+        indexes = Mongo.cache.index_information(coll)
+        if any(self.same_index_keys(index, keys) and index.get('unique', False) for index in indexes.values()):
+            return True
+
+        duplicates = self.find_duplicate_keys(coll, keys, options.get('partialFilterExpression'))
+        if len(duplicates) > 0:
+            Mongo.logger.warning('Some documents of ' + coll + ' have the same keys, impossible to create a unique index on them: ' + ', '.join(str(duplicate) for duplicate in duplicates))
+            Mongo.cache.create_index(coll, keys, background=True)
+            return False
+
+        for name, index in indexes.items():
+            if self.same_index_keys(index, keys):
+                try:
+                    Mongo.cache.drop_index(coll, name)
+                except pymongo.errors.OperationFailure:
+                    # Already dropped by another mount
+                    pass
+        try:
+            Mongo.cache.create_index(coll, keys, unique=True, background=True, **options)
+        except pymongo.errors.OperationFailure as e:
+            if any(self.same_index_keys(index, keys) and index.get('unique', False) for index in Mongo.cache.index_information(coll).values()):
+                # Built by another mount in the meantime
+                return True
+            # Some documents with the same keys were inserted in the meantime by an older mount
+            Mongo.logger.warning('Impossible to create a unique index on ' + coll + ': ' + str(e))
+            Mongo.cache.create_index(coll, keys, background=True)
+            return False
+        return True
+
+    """
+        Indicate if an index (from index_information()) is on the given keys
+    """
+    @staticmethod
+    def same_index_keys(index, keys):
+        return [(field, int(direction)) for field, direction in index['key']] == keys
+
+    """
+        Return the first values of the given keys shared by several documents of a collection (among the ones matching
+        the partial filter of the index, if any).
+    """
+    def find_duplicate_keys(self, coll, keys, partial_filter=None, limit=10):
+        pipeline = []
+        if partial_filter is not None:
+            pipeline.append({'$match': partial_filter})
+        pipeline.extend([
+            {'$group': {'_id': {field: '$' + field for field, direction in keys}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+            {'$limit': limit}
+        ])
+        return [result['_id'] for result in Mongo.cache.aggregate(coll, pipeline)]
 
+    """
+        Create the unique index on (directory_id, filename), so a generic file can be created with a single insert,
+        without checking before if it already exists. The file systems created by older versions have a non-unique
+        index, which we replace, except if some files have the same name in a directory: we then keep the slower
+        creation. Return True if the index is unique.
+    """
+    def create_filename_index(self):
+        return self.create_unique_index(self.files_coll, [("directory_id", pymongo.ASCENDING), ("filename", pymongo.ASCENDING)])
 
     """
         Load the appropriate object for the given json. Should never return a GenericFile, but rather a child class.
@@ -183,10 +329,46 @@ class Mongo:
         return lock_id
 
     """
-        Create a generic file in gridfs. No need to return it.
+        Create a generic file, with a document compatible with gridfs. No need to return it. Raise EEXIST if there is
+        already a generic file with the same name in the directory (only detected with the unique index).
     """
     def create_generic_file(self, generic_file):
-        Mongo.cache.gridfs_new_file(generic_file.json)
+        # We choose the _id ourselves to be able to reference a new directory in the directory cache directly
+        if generic_file._id is None:
+            generic_file._id = ObjectId()
+            generic_file.json['_id'] = generic_file._id
+        try:
+            self.insert_generic_file(generic_file)
+        except pymongo.errors.DuplicateKeyError:
+            # The insert might be retried after a disconnection, even if it was already done
+            if Mongo.cache.find_one(self.files_coll, {'_id': generic_file._id}) is not None:
+                pass
+            elif Mongo.cache.count(self.files_coll, {'directory_id': generic_file.directory_id, 'filename': generic_file.filename}) > 0:
+                raise FuseOSError(errno.EEXIST)
+            elif 'path' in generic_file.json and self.release_materialized_path(generic_file.json['path'], generic_file._id):
+                self.insert_generic_file(generic_file)
+            else:
+                raise FuseOSError(errno.EEXIST)
+        Mongo.cache.add_filename(directory_id=generic_file.directory_id, filename=generic_file.filename)
+
+        if generic_file.generic_file_type == GenericFile.DIRECTORY_TYPE:
+            self.directory_cache.add(parent_id=generic_file.directory_id, name=generic_file.filename, directory_id=generic_file._id)
+
+    """
+        Insert the document of a new generic file
+    """
+    def insert_generic_file(self, generic_file):
+        if self.group_commit.enabled():
+            self.group_commit.submit(self.files_coll, [pymongo.InsertOne(self.new_file_document(generic_file.json))])
+        else:
+            Mongo.cache.insert_one(self.files_coll, self.new_file_document(generic_file.json))
+
+    """
+        Document of a new generic file, with the same fields as the one inserted by gridfs (it is empty, so we already
+        know its md5). We insert it directly, gridfs would need more queries for the same result.
+    """
+    def new_file_document(self, json):
+        return dict(json, uploadDate=datetime.datetime.utcnow(), md5=hashlib.md5().hexdigest())
 
     """
         Remove a generic file. No need to verify if the file already exists, the check is done by FUSE.
@@ -197,15 +379,197 @@ class Mongo:
 
         # We cannot directly remove every sub-file in the directory (permissions check to do, ...), but we need to
         # be sure the directory is empty.
+        if generic_file.is_dir() and not self.is_directory_empty(generic_file):
+            raise FuseOSError(errno.ENOTEMPTY)
+
+        # We decrease the number of link in the directory above it before deleting the file, so the counter of its
+        # files can never be bigger than the real number of files, even if we crash in-between.
+        self.add_nlink_directory(directory_id=generic_file.directory_id, value=-1)
+
+        if self.chunk_reaper.enabled():
+            self.delete_generic_file_later(generic_file)
+            return
+
+        # Then we delete the file (metadata + chunks), and the payloads only referenced by its chunks. Only the cached
+        # document of the generic file is removed.
+        if generic_file.is_file():
+            self.write_buffer.discard(generic_file)
+        Mongo.cache.delete_one(self.files_coll, {'_id': generic_file._id})
+        Mongo.cache.invalidate(directory_id=generic_file.directory_id, filename=generic_file.filename)
+        if generic_file.is_file():
+            ids = self.file_chunks_ids(generic_file._id, self.chunks_id(generic_file))
+            while self.delete_file_chunks(ids, Mongo.BULK_SIZE) == Mongo.BULK_SIZE:
+                pass
+        if generic_file.json.get('extents', 0) > 0:
+            Mongo.cache.delete_many(self.extents_coll, {'files_id': self.chunks_id(generic_file)})
         if generic_file.is_dir():
-            if Mongo.cache.find(self.files_coll, {'directory_id': generic_file._id}).count() != 0:
-                raise FuseOSError(errno.ENOTEMPTY)
+            self.directory_cache.remove(parent_id=generic_file.directory_id, name=generic_file.filename)
 
-        # First we delete the file (metadata + chunks)
-        Mongo.cache.gridfs_delete(generic_file._id)
+    """
+        Delete the document of a generic file, and leave a tombstone for its chunks, deleted later by the reaper. The
+        tombstone keeps both the id of the file and the one of its chunks (different for a re-chunked file), as
+        chunks might be stored with each of them. It is inserted first: if we crash in-between, the reaper finds the document still there, and only
+        deletes the tombstone. Only the cached document of the generic file is removed.
+    """
+    def delete_generic_file_later(self, generic_file):
+        tombstone = None
+        if generic_file.is_file():
+            self.write_buffer.discard(generic_file)
+            extents = generic_file.json.get('extents', 0) > 0
+            if extents or generic_file.json.get('allocated_chunks', 1) > 0 or self.chunks_id(generic_file) != generic_file._id:
+                tombstone = {'files_id': generic_file._id, 'chunks_id': self.chunks_id(generic_file),
+                             'extents': extents, 'date': time.time()}
+                Mongo.cache.insert_one(self.tombstones_coll, tombstone)
+
+        Mongo.cache.delete_one(self.files_coll, {'_id': generic_file._id})
+        Mongo.cache.invalidate(directory_id=generic_file.directory_id, filename=generic_file.filename)
+        if generic_file.is_file():
+            Mongo.cache.data_cache.invalidate(self.chunks_id(generic_file))
+        if generic_file.is_dir():
+            self.directory_cache.remove(parent_id=generic_file.directory_id, name=generic_file.filename)
+        if tombstone is not None:
+            self.chunk_reaper.start()
 
-        # Then we decrease the number of link in the directory above it
-        self.add_nlink_directory(directory_id=generic_file.directory_id, value=-1)
+    """
+        Delete at most max_chunks chunks of the deleted files, tombstone after tombstone. Return the number of deleted
+        chunks.
+    """
+    def reap_tombstones(self, max_chunks):
+        deleted = 0
+        while deleted < max_chunks:
+            tombstone = self.claim_tombstone()
+            if tombstone is None:
+                break
+            deleted += self.reap_tombstone(tombstone, max_chunks - deleted)
+        return deleted
+
+    """
+        Claim a tombstone old enough, so no other mount deletes its chunks at the same time (they would release the
+        payloads of the deduplicated chunks twice). We first take back the tombstone we were working on.
+    """
+    def claim_tombstone(self):
+        now = time.time()
+        owner = str(os.getpid()) + ';' + Mongo.configuration.hostname()
+        return Mongo.cache.find_one_and_update(self.tombstones_coll, {
+            'date': {'$lte': now - Mongo.TOMBSTONE_DELAY},
+            '$or': [{'owner': owner}, {'lease': {'$exists': False}}, {'lease': {'$lt': now - Mongo.TOMBSTONE_LEASE}}]
+        }, {'$set': {'owner': owner, 'lease': now}})
+
+    """
+        Delete at most max_chunks chunks of a claimed tombstone, and the tombstone itself once all its chunks are
+        deleted. Return the number of deleted chunks.
+    """
+    def reap_tombstone(self, tombstone, max_chunks):
+        if Mongo.cache.find_one(self.files_coll, {'_id': tombstone['files_id']}) is not None:
+            # We crashed before deleting the document, the file still exists
+            Mongo.cache.delete_one(self.tombstones_coll, {'_id': tombstone['_id']})
+            return 0
+
+        deleted = self.delete_file_chunks(self.file_chunks_ids(tombstone['files_id'], tombstone['chunks_id']), max_chunks)
+        if deleted == max_chunks:
+            # There might be other chunks, we keep the tombstone for the next batch
+            return deleted
+
+        if tombstone.get('extents', False):
+            Mongo.cache.delete_many(self.extents_coll, {'files_id': tombstone['chunks_id']})
+        Mongo.cache.delete_one(self.tombstones_coll, {'_id': tombstone['_id']})
+        return deleted
+
+    """
+        Ids with which the chunks of a removed file might be stored: the chunks of a re-chunked file are stored with
+        another id, and the previous ones (stored with the id of the file) might still exist.
+    """
+    @staticmethod
+    def file_chunks_ids(files_id, chunks_id):
+        if chunks_id == files_id:
+            return [files_id]
+        return [chunks_id, files_id]
+
+    """
+        Delete at most max_chunks chunks of a removed file, stored with the given ids, and release the payloads they
+        referenced. Return the number of deleted chunks.
+    """
+    def delete_file_chunks(self, ids, max_chunks):
+        chunks = list(Mongo.cache.find(self.chunks_coll, {'files_id': {'$in': ids}}, {'hash': 1}, limit=max_chunks))
+        if len(chunks) > 0:
+            Mongo.cache.delete_many(self.chunks_coll, {'_id': {'$in': [chunk['_id'] for chunk in chunks]}})
+            self.release_payloads([chunk['hash'] for chunk in chunks if 'hash' in chunk])
+        return len(chunks)
+
+    """
+        Delete the chunks of every tombstone old enough, for example if no mount is running. Return the number of
+        deleted chunks.
+    """
+    def reap_all_tombstones(self):
+        deleted = 0
+        while True:
+            reaped = self.reap_tombstones(Mongo.BULK_SIZE)
+            if reaped == 0:
+                return deleted
+            deleted += reaped
+
+    """
+        Indicate if a directory is empty, without counting every file in it. The "children" counter is never bigger
+        than the real number of files, so we can trust it if it is positive. Otherwise, we only need to check if there
+        is at least one file (the directory might come from an older version, or we crashed in the middle of an update).
+    """
+    def is_directory_empty(self, directory):
+        if directory.json.get('children', 0) + self.directory_counters.pending(directory._id) > 0:
+            return False
+        return Mongo.cache.find_one(self.files_coll, {'directory_id': directory._id}) is None
+
+    """
+        Return the number of files in a directory, without listing it.
+    """
+    def count_generic_files_in_directory(self, directory):
+        children = directory.json.get('children', -1)
+        if children >= 0:
+            return children + self.directory_counters.pending(directory._id)
+
+        # Directory created by an older version, or the counter is wrong. We need to count its files once.
+        return self.repair_directory_counter(directory_id=directory._id)
+
+    """
+        Count the real number of files in a directory, and fix its counters accordingly (the number of files and the
+        st_nlink). Return the number of files.
+    """
+    def repair_directory_counter(self, directory_id):
+        # Our increments not sent yet are already in the count, they must not be added afterwards
+        self.directory_counters.flush()
+        children = Mongo.cache.count(self.files_coll, {'directory_id': directory_id})
+        Mongo.cache.find_one_and_update(self.files_coll, {'_id': directory_id},
+                                        {'$set': {'children': children, 'metadata.st_nlink': 2 + children}})
+        return children
+
+    """
+        Fix the counters of every directory of the file system, for example after a crash. Return the number of
+        directories with a wrong counter.
+    """
+    def repair_directory_counters(self):
+        self.directory_counters.flush()
+        counts = {}
+        for elem in Mongo.cache.aggregate(self.files_coll, [{'$group': {'_id': '$directory_id', 'children': {'$sum': 1}}}]):
+            counts[elem['_id']] = elem['children']
+
+        repaired = 0
+        requests = []
+        projection = {'children': True, 'metadata.st_nlink': True}
+        for elem in Mongo.cache.find(self.files_coll, {'generic_file_type': GenericFile.DIRECTORY_TYPE}, projection):
+            children = counts.get(elem['_id'], 0)
+            if elem.get('children', None) != children or elem['metadata']['st_nlink'] != 2 + children:
+                requests.append(pymongo.UpdateOne({'_id': elem['_id']}, {'$set': {'children': children, 'metadata.st_nlink': 2 + children}}))
+                repaired += 1
+
+            if len(requests) >= Mongo.BULK_SIZE:
+                Mongo.cache.bulk_write(self.files_coll, requests)
+                requests = []
+
+        if len(requests) > 0:
+            Mongo.cache.bulk_write(self.files_coll, requests)
+
+        # The cached directories have the old counters
+        Mongo.cache.reset_cache()
+        return repaired
 
     """
         List files in a given directory. 
@@ -216,11 +580,75 @@ class Mongo:
         if not GenericFile.has_user_access_right(dir, GenericFile.EXECUTE_RIGHTS):
             raise FuseOSError(errno.EACCES)
 
+        # Listing a directory is generally followed by a getattr() on every file (ls -l, find, rsync, ...), so we keep
+        # the loaded documents in the cache.
+        created = Mongo.cache.start_listing(directory_id=dir._id)
         files = []
-        for elem in Mongo.cache.find(self.files_coll, {'directory_id':dir._id}):
-            files.append(Mongo.load_generic_file(elem))
+        try:
+            for elem in Mongo.cache.find(self.files_coll, {'directory_id':dir._id}):
+                Mongo.cache.add_document(elem)
+                files.append(Mongo.load_generic_file(elem))
+
+            # We know every filename of the directory, so we can easily answer if any other file is missing
+            Mongo.cache.add_bloom_filter(directory_id=dir._id, filenames=[file.filename for file in files], created=created)
+        finally:
+            Mongo.cache.end_listing(directory_id=dir._id, created=created)
         return files
 
+    """
+        Iterate over the documents of every generic file in a given directory, sorted by filename (thanks to the
+        (directory_id, filename) index), without loading them all at once. We can resume a listing after a given filename.
+        The first documents are entirely loaded and kept in the cache, as a listing is generally followed by a getattr()
+        on every file. Once we loaded as many documents as the cache can keep, we only load the filename and type of
+        the next ones.
+        The Bloom filter of the directory is only built if the listing starts from the beginning and the generator is
+        entirely consumed. A readdir() stopped by the kernel once its buffer is full, and resumed after a filename,
+        does not build it.
+    """
+    def iterate_generic_files_in_directory(self, filepath, after=None):
+        dir = self.get_generic_file(filepath=filepath)
+        if not GenericFile.has_user_access_right(dir, GenericFile.EXECUTE_RIGHTS):
+            raise FuseOSError(errno.EACCES)
+
+        # Bloom filter only possible if we list the whole directory
+        filenames = [] if after is None and Mongo.cache.use_bloom_filters() else None
+        created = Mongo.cache.start_listing(directory_id=dir._id) if filenames is not None else None
+        try:
+            yield from self.iterate_directory_documents(dir, after, filenames)
+            if filenames is not None:
+                Mongo.cache.add_bloom_filter(directory_id=dir._id, filenames=filenames, created=created)
+        finally:
+            if created is not None:
+                Mongo.cache.end_listing(directory_id=dir._id, created=created)
+
+    """
+        Iterate over the documents of a directory for iterate_generic_files_in_directory(), and collect their
+        filenames if "filenames" is not None.
+    """
+    def iterate_directory_documents(self, dir, after, filenames):
+        query = {'directory_id': dir._id}
+        if after is not None:
+            query['filename'] = {'$gt': after}
+        sort = [('filename', pymongo.ASCENDING)]
+
+        max_documents = Mongo.configuration.cache_max_elements() if Mongo.configuration.cache_timeout() > 0 else 0
+        documents = 0
+        if max_documents > 0:
+            for elem in Mongo.cache.find(self.files_coll, query, sort=sort, limit=max_documents):
+                Mongo.cache.add_document(elem)
+                documents += 1
+                if filenames is not None and len(filenames) <= MongoCache.BLOOM_FILTER_MAX_ELEMENTS:
+                    filenames.append(elem['filename'])
+                yield elem
+                query['filename'] = {'$gt': elem['filename']}
+
+        if max_documents == 0 or documents == max_documents:
+            projection = {'filename': True, 'generic_file_type': True}
+            for elem in Mongo.cache.find(self.files_coll, query, projection, sort=sort):
+                if filenames is not None and len(filenames) <= MongoCache.BLOOM_FILTER_MAX_ELEMENTS:
+                    filenames.append(elem['filename'])
+                yield elem
+
     """
         Indicate if the generic file exists or not. 
     """
@@ -253,8 +681,20 @@ class Mongo:
                 # Wait 1s before checking the lock again
                 time.sleep(1)
             elif gf == Mongo.FILE_NOT_FOUND:
-                return None
+                # Another host might have deleted (and created again) a directory of the path we have in the
+                # path-resolution cache, so we resolve it again from MongoDB before saying the file does not exist
+                names = filepath.split('/')[:-1]
+                if not self.directory_cache.invalidate(names, min_age=Mongo.configuration.cache_timeout()):
+                    return None
+                current_id = self.get_last_directory_id_for_filepath(filepath=filepath)
+                if current_id is None or current_id == directory_id:
+                    return None
+                directory_id = current_id
+                gf = Mongo.LOCKED_FILE
             else:
+                if gf.is_dir():
+                    # The directory we loaded replaces the one we might have under the same name
+                    self.directory_cache.add(parent_id=gf.directory_id, name=gf.filename, directory_id=gf._id)
                 return gf
 
         # It means the file is still locked
@@ -389,33 +829,99 @@ class Mongo:
 
     """
         Return the last directory_id for a given filepath. Return None if none are found.
+        We first follow the directories we already know in the directory cache, then we load the missing ones from
+        MongoDB and store them in the directory cache for the next calls. With materialized paths, the last directory
+        is loaded in one query, otherwise we need one query per level.
     """
-    def get_last_directory_id_for_filepath(self, filepath, previous_directory_id=None):
+    def get_last_directory_id_for_filepath(self, filepath):
         if filepath == '/': # Exception for '/' path as it generates a ['',''] list.
-            elems = ['']
-        else:
-            elems = filepath.split('/')
+            return None
+
+        # The last element is the filename itself, we only need to resolve the directories above it
+        names = filepath.split('/')[:-1]
+        directory_id, resolved = self.directory_cache.resolve(names)
+        if resolved == len(names):
+            return directory_id
 
-        first_directory_name = elems[0]
-        if len(elems) == 1:
-            # We are at the last iteration, so in reality we would be testing the filename itself (not the goal),
-            # we can directly return the directory_id
-            return previous_directory_id
+        if Mongo.configuration.mongo_materialized_paths():
+            directory_id, resolved = self.resolve_materialized_paths(names, directory_id, resolved)
+            if resolved == len(names):
+                return directory_id
+            # The path might not be backfilled yet (or be wrong), so we still need to follow the hierarchy to be sure
 
         # We should ideally check on the generic_file_type to be a DIR, not sure though are handled the symbolic link...
         # Did we receive directly the path correctly redirected? Or did we receive the path with the symbolic link in it? TODO: Verify it.
-        dir = Mongo.cache.find_one(self.files_coll, {'directory_id':previous_directory_id,'filename':first_directory_name,'generic_file_type': GenericFile.DIRECTORY_TYPE})
-        if dir is not None:
-            return self.get_last_directory_id_for_filepath(filepath='/'.join(elems[1:]), previous_directory_id=dir['_id'])
+        for name in names[resolved:]:
+            dir = Mongo.cache.find_one(self.files_coll, {'directory_id':directory_id,'filename':name,'generic_file_type': GenericFile.DIRECTORY_TYPE})
+            if dir is None:
+                return None
+            self.directory_cache.add(parent_id=directory_id, name=name, directory_id=dir['_id'])
+            directory_id = dir['_id']
+
+        return directory_id
 
-        return None
+    """
+        Load the missing directories of a path with their materialized paths, in a single query. A path can be wrong
+        during the rename of a directory above it (or after a crash in the middle of it), so every directory must be
+        the child of the previous one. Return a tuple (directory_id, resolved) as DirectoryCache.resolve(), with the
+        directories we could verify.
+    """
+    def resolve_materialized_paths(self, names, directory_id, resolved):
+        paths = ['/'.join(names[0:i + 1]) or '/' for i in range(resolved, len(names))]
+        query = {'path': {'$in': paths}, 'generic_file_type': GenericFile.DIRECTORY_TYPE}
+        if resolved == 0:
+            # The root directory does not always have its path
+            query = {'$or': [query, {'directory_id': None, 'filename': ''}]}
+        directories = {}
+        for dir in Mongo.cache.find(self.files_coll, query, {'directory_id': True, 'filename': True, 'path': True}):
+            if dir['directory_id'] is None:
+                directories['/'] = dir
+            else:
+                directories[dir.get('path')] = dir
+
+        for name, path in zip(names[resolved:], paths):
+            dir = directories.get(path)
+            if dir is None or dir['directory_id'] != directory_id or dir['filename'] != name:
+                break
+            self.directory_cache.add(parent_id=directory_id, name=name, directory_id=dir['_id'])
+            directory_id = dir['_id']
+            resolved += 1
+        return directory_id, resolved
+
+    """
+        Remove the materialized path of a directory still having it while it is not its real path anymore (we crashed
+        in the middle of the rename of a directory above it), so another directory can take it. The "backfill-paths"
+        command fixes it afterwards. Return True if there was such a directory.
+    """
+    def release_materialized_path(self, path, _id):
+        query = {'path': path, 'generic_file_type': GenericFile.DIRECTORY_TYPE, '_id': {'$ne': _id}}
+        return Mongo.cache.find_one_and_update(self.files_coll, query, {'$unset': {'path': ''}}) is not None
 
     """
-        Increment/reduce the number of links for a directory 
+        Increment/reduce the number of links for a directory, and the number of files in it. The increments can be
+        delayed (see DirectoryCounters), the decrements are always sent directly.
     """
     def add_nlink_directory(self, directory_id, value):
+        if self.directory_counters.enabled():
+            if value > 0:
+                self.directory_counters.add(directory_id, value)
+                return
+            value = -self.directory_counters.cancel(directory_id, -value)
+            if value == 0:
+                return
+
         # You cannot update directly the object from gridfs, you need to do a MongoDB query instead
-        Mongo.cache.find_one_and_update(self.files_coll, {'_id':directory_id}, {'$inc':{'metadata.st_nlink':value}})
+        Mongo.cache.find_one_and_update(self.files_coll, {'_id':directory_id}, {'$inc':{'metadata.st_nlink':value, 'children':value}})
+
+    """
+        Send the delayed increments of the counters of several directories, given as {directory_id: value}. The cached
+        documents of the directories are not updated, their counters can only be lower than the real ones.
+    """
+    def send_directory_counters(self, deltas):
+        requests = [pymongo.UpdateOne({'_id': directory_id}, {'$inc': {'metadata.st_nlink': value, 'children': value}})
+                    for directory_id, value in deltas.items() if value != 0]
+        for i in range(0, len(requests), Mongo.BULK_SIZE):
+            Mongo.cache.bulk_write(self.files_coll, requests[i:i + Mongo.BULK_SIZE])
 
 
     """
@@ -426,126 +932,608 @@ class Mongo:
         Return bytes array
     """
     def read_data(self, file, offset, size):
+        # The data written by the current host must be visible, even if it is not in MongoDB yet. We take it before
+        # reading the chunks, so it cannot be written in-between without us seeing it.
+        length, dirty = self.write_buffer.read(file, offset, size)
+        if length is None:
+            length = file.length
+
+        # We never read after the end of the file
+        size = min(size, length - offset)
+        if size <= 0:
+            return b''
+        self.record_access(file, offset, size)
+
         # We get the chunks we are interested in
         chunk_size = file.chunkSize
-        starting_chunk = int(floor(offset / chunk_size))
-        ending_chunk = int(floor((offset + size) / chunk_size))
+        starting_chunk = offset // chunk_size
+        ending_chunk = (offset + size - 1) // chunk_size
+        self.read_ahead.wait(file, starting_chunk, ending_chunk)
+        chunks = self.load_chunks(file, starting_chunk, ending_chunk)
+        self.read_ahead.read(file, offset, size)
 
-        starting_offset = offset % chunk_size
-        data = b''
-        for chunk in Mongo.cache.find(self.chunks_coll, {'files_id':file._id,'n':{'$gte':starting_chunk,'$lte':ending_chunk}}):
-            ending_size = min(starting_offset + size, chunk_size)
-            data += chunk['data'][starting_offset:ending_size]
+        # The chunks can be big (up to 15MB), so we only take views on the part we need, and copy them once in the
+        # final bytes object
+        if len(dirty) > 0:
+            return self.overlay_data(chunks, dirty, offset, size, chunk_size)
 
-            size -= (ending_size - starting_offset)
+        starting_offset = offset % chunk_size
+        remaining = size
+        parts = []
+        for n in range(starting_chunk, ending_chunk + 1):
+            expected = min(remaining, chunk_size - starting_offset)
+            part = memoryview(chunks.get(n, b''))[starting_offset:starting_offset + expected]
+            parts.append(part)
+
+            # A missing chunk (or the end of a chunk) is a hole in a sparse file, it must be read as zeros
+            if len(part) < expected:
+                parts.append(bytes(expected - len(part)))
+            remaining -= expected
             starting_offset = 0
-        return data
+
+        if len(parts) == 1:
+            return parts[0].tobytes()
+        return b''.join(parts)
+
+    """
+        Build the data read by read_data() when some of it was not written to MongoDB yet: the chunks are copied in a
+        single buffer (initialized with zeros for the holes), then the data not yet written replaces them.
+    """
+    def overlay_data(self, chunks, dirty, offset, size, chunk_size):
+        data = bytearray(size)
+        view = memoryview(data)
+        for n, chunk in chunks.items():
+            start = max(offset, n * chunk_size)
+            end = min(offset + size, n * chunk_size + len(chunk))
+            if start < end:
+                view[start - offset:end - offset] = memoryview(chunk)[start - n * chunk_size:end - n * chunk_size]
+
+        for position, part in dirty:
+            start = max(offset, position)
+            end = min(offset + size, position + len(part))
+            if start < end:
+                view[start - offset:end - offset] = memoryview(part)[start - position:end - position]
+        view.release()
+        return bytes(data)
+
+    """
+        Load some chunks of a file, from the data cache if possible. Return them as a dictionary {n: data}.
+    """
+    def load_chunks(self, file, starting_chunk, ending_chunk):
+        # The data of a small file is directly in its document, as its first and only chunk
+        if 'data' in file.json:
+            return {0: file.json['data']} if starting_chunk == 0 else {}
+        chunks = Mongo.cache.find_chunks(self.chunks_coll, self.chunks_id(file), starting_chunk, ending_chunk, self.file_version(file))
+
+        # The data appended to a log-structured file is in its extents until they are compacted
+        if file.json.get('extents', 0) > 0:
+            chunks = dict(chunks)
+            query = {'files_id': self.chunks_id(file), 'n': {'$gte': starting_chunk, '$lte': ending_chunk}}
+            merged = {}
+            for extent in Mongo.cache.find(self.extents_coll, query, sort=[('_id', pymongo.ASCENDING)]):
+                self.apply_extent(merged.setdefault(extent['n'], bytearray(chunks.get(extent['n'], b''))), extent)
+            chunks.update({n: bytes(data) for n, data in merged.items()})
+        return chunks
+
+    """
+        Write the data of an extent in the data of its chunk, given as a bytearray
+    """
+    def apply_extent(self, data, extent):
+        start = extent['start']
+        if len(data) < start:
+            data.extend(bytes(start - len(data)))
+        data[start:start + len(extent['data'])] = extent['data']
+
+    """
+        Return the id used as "files_id" by the chunks of a file. It is the id of the file, except if it was re-chunked.
+    """
+    def chunks_id(self, file):
+        return file.json.get('chunks_id', file._id)
+
+    """
+        Return a value identifying the current content of a file, to know if the chunks we have in cache are still
+        valid, even if the file was modified by another host.
+    """
+    def file_version(self, file):
+        return file.length, file.metadata['st_mtime'], file.json.get('compactions', 0)
+
+    """
+        Remember in the document of a file that it is accessed at random places, once the chunk size policy detects
+        it, so the "rechunk" admin command can give it smaller chunks.
+    """
+    def record_access(self, file, offset, size):
+        if self.chunk_size_policy.record_access(file, offset, size):
+            Mongo.cache.update_one(self.files_coll, {'_id': file._id}, {'$set': {'random_access': True}})
+            file.json = dict(file.json, random_access=True)
+            Mongo.cache.update_document(file.json)
 
     """
         Add data to a file. 
          file: Instance of a "File" type object.
          data: bytes 
-         use_cache: True by default, can only be set to "False" if called by add_data_to_write
+         use_cache: True by default, the data is then written in background. If set to "False", it is directly
+         written to MongoDB.
     """
     def add_data(self, file, data, offset, use_cache=True):
-        # Normally, we should not update a gridfs document, but re-write everything. I don't see any specific reason
-        # to do that, so we will try to update it anyway. But we will only rewrite the last chunks of it, or add information
-        # to them, while keeping the limitation of ~255KB/chunk
+        self.record_access(file, offset, len(data))
+        self.write_buffer.add(file=file, data=data, offset=offset)
+        if use_cache is False:
+            self.write_buffer.flush(file)
+        return True
 
-        # We try to cache data
-        if use_cache is True:
-            return self.add_data_to_write(file=file, data=data, offset=offset)
+    """
+        Write some chunks of a file to MongoDB, and update its length. Every chunk is given as a list of
+        (start, data), with "data" replacing the existing bytes of the chunk from "start". Every chunk is only written
+        once. "created" is the number of chunks already created by a previous attempt of the same write.
+    """
+    def write_chunks(self, file, chunks, length, created=0):
+        chunk_size = file.chunkSize
+        chunks_id = self.chunks_id(file)
+        version = self.file_version(file)
+        inline = file.json.get('data')
+
+        if inline is None and file.is_log_structured():
+            self.append_extents(file, chunks, length)
+            return
+        if file.json.get('extents', 0) > 0:
+            # The file is not log-structured anymore, its extents must be in its chunks before we modify them
+            self.compact_extents(file)
+            version = self.file_version(file)
+
+        # We only need the current data of the chunks we partially modify, the others are simply replaced. A small
+        # file does not have any chunk, its data is in its document.
+        existing = {}
+        partial = [n for n, pieces in chunks.items() if len(pieces) > 1 or len(pieces[0][1]) < chunk_size]
+        if inline is not None:
+            existing[0] = inline
+        else:
+            for n in partial:
+                data = Mongo.cache.data_cache.get(chunks_id, n, version)
+                if data is not None:
+                    existing[n] = data
+            missing = [n for n in partial if n not in existing]
+            if len(missing) > 0:
+                query = {'files_id': chunks_id, 'n': {'$in': missing}}
+                for chunk in Mongo.cache.decode_chunks(self.chunks_coll, list(Mongo.cache.find(self.chunks_coll, query))):
+                    existing[chunk['n']] = chunk['data']
+
+        written = {}
+        for n in sorted(chunks.keys()):
+            data = bytearray(existing.get(n, b''))
+            for start, piece in chunks[n]:
+                if len(data) < start:
+                    data.extend(bytes(start - len(data)))
+                data[start:start + len(piece)] = piece
+            written[n] = bytes(data)
+
+        if self.can_inline_data(file, length):
+            # The data stays in the document (the file can only have its first chunk)
+            inline_data = written.get(0, inline or b'')
+            allocated_chunks = 0
+            blocks = GenericFile.size_to_blocks(len(inline_data))
+        else:
+            new = set(n for n in partial if n not in existing)
+            if inline is not None:
+                # The file became too big, its data is moved to the chunks. A previous attempt might have already
+                # created them, so they are upserted.
+                if len(inline) > 0:
+                    written.setdefault(0, inline)
+                new = set()
+            inline_data = None
+            # The chunks of a file written by an older version are counted before we add ours
+            allocated_chunks = self.allocated_chunks(file)
+            created += self.save_chunks(file, written, new)
+            allocated_chunks += created
+            blocks = self.allocated_blocks(file, allocated_chunks, length)
+
+        # We update the total length and its date. Another flush might have written data further in the file in the
+        # meantime, so the length can only increase, and it might have created other chunks, so we only add the ones
+        # we created. If the file was re-chunked in the meantime, our chunks are not used anymore, and we need to
+        # write them again.
+        dt = time.time()
+        update = {
+            '$max': {
+                'length': length,
+                'metadata.st_size': length
+            },
+            '$inc': {
+                'allocated_chunks': created
+            },
+            '$set': {
+                'metadata.st_blocks': blocks,
+                'metadata.st_mtime': dt,
+                'metadata.st_atime': dt,
+                'metadata.st_ctime': dt
+            }
+        }
+        # Another flush (with a more recent instance of the file) might have moved the data of the document to the
+        # chunks, or modified it, since we loaded the file. So we only update the document if it still has the data
+        # we started from, otherwise we write our chunks again on top of its current data.
+        if inline is not None:
+            conditions = {'data': inline}
+        else:
+            conditions = {'data': {'$exists': False}}
+        if inline_data is not None:
+            update['$set']['data'] = inline_data
+            if inline is None:
+                conditions['allocated_chunks'] = 0
+        else:
+            update['$unset'] = {'data': ''}
+        if not self.update_file(file, update, conditions):
+            json = Mongo.cache.find_one(self.files_coll, {'_id': file._id})
+            if json is not None and json.get('chunkSize') == chunk_size and json.get('chunks_id', file._id) == chunks_id:
+                self.refresh_file(file, json)
+                self.write_chunks(file, chunks, length, created)
+            else:
+                self.rewrite_chunks(file, chunks, length)
+            return
+
+        # The cached document is updated without loading it again (as the update, the length can only increase)
+        length = max(length, file.length)
+        metadata = dict(file.metadata)
+        metadata.update({'st_size': length, 'st_blocks': blocks, 'st_mtime': dt, 'st_atime': dt, 'st_ctime': dt})
+        file.length = length
+        file.metadata = metadata
+        file.json = dict(file.json, length=length, metadata=metadata, allocated_chunks=allocated_chunks)
+        if inline_data is not None:
+            file.json['data'] = inline_data
+        else:
+            file.json.pop('data', None)
+        Mongo.cache.update_document(file.json)
 
-        # Final size after the update
-        total_size = offset + len(data)
+        # The chunks we did not modify stay valid in the data cache, and we already know the new ones
+        new_version = self.file_version(file)
+        Mongo.cache.data_cache.update_version(chunks_id, version, new_version)
+        for n, data in written.items():
+            Mongo.cache.data_cache.put(chunks_id, n, new_version, data)
 
-        # Important note: the data that we receive are replacing any existing data from "offset".
-        chunk_size = file.chunkSize
-        total_chunks = int(ceil(file.length / chunk_size))
-        starting_chunk = int(floor(offset / chunk_size))
-        starting_byte = offset - starting_chunk * chunk_size
-        if starting_byte < 0:
-            print('Computation error for offset: '+str(offset))
-        for chunk in Mongo.cache.find(self.chunks_coll, {'files_id':file._id,'n':{'$gte':starting_chunk}}):
-            chunk['data'] = chunk['data'][0:starting_byte] + data[0:chunk_size-starting_byte]
-            Mongo.cache.find_one_and_update(self.chunks_coll, {'_id':chunk['_id']},{'$set':{'data':chunk['data']}})
-
-            # We have written a part of what we wanted, we only need to keep the remaining
-            data = data[chunk_size-starting_byte:]
-
-            # For the next chunks, we start to replace bytes from zero.
-            starting_byte = 0
-
-            # We might not need to go further to write the data
-            if len(data) == 0:
-                break
+    """
+        Update the document of a file after writing its data, only if it was not re-chunked (or deleted) since we
+        loaded it, and if it matches the given conditions. Return False otherwise. It is never sent with the group
+        commit, which cannot tell if our own update matched (checking the document afterwards is wrong, the update
+        might have changed it).
+    """
+    def update_file(self, file, update, conditions=None):
+        query = dict(conditions or {}, _id=file._id, chunkSize=file.chunkSize)
+        return Mongo.cache.update_one(self.files_coll, query, update).matched_count > 0
+
+    """
+        Write again some chunks of a file re-chunked (or deleted) since we loaded it. The chunks we already wrote with
+        its previous chunk size are not used anymore.
+    """
+    def rewrite_chunks(self, file, chunks, length):
+        self.delete_chunks(self.chunks_id(file))
+        Mongo.cache.delete_many(self.extents_coll, {'files_id': self.chunks_id(file)})
+        json = Mongo.cache.find_one(self.files_coll, {'_id': file._id})
+        if json is None:
+            return
+
+        current = Mongo.load_generic_file(json)
+        extents = ExtentMap()
+        for n, pieces in chunks.items():
+            for start, data in pieces:
+                extents.add(n * file.chunkSize + start, data)
+        self.write_chunks(current, extents.chunks(current.chunkSize), length)
+        self.refresh_file(file, current.json)
 
-        # The code above was only to update a document, we might want to add new chunks
-        if len(data) > 0:
-            remaining_chunks = int(ceil(len(data) / chunk_size))
-            chunks = []
-            for i in range(0, remaining_chunks):
-                chunk = {
-                    "files_id": file._id,
-                    "data": data[0:chunk_size],
-                    "n": total_chunks
-                }
-                chunks.append(chunk)
-
-                # We have written a part of what we wanted, we only the keep the remaining
-                data = data[chunk_size:]
-
-                # Next entry
-                total_chunks += 1
-            Mongo.cache.insert_many(self.chunks_coll, chunks)
-
-        # We update the total length and its date and that's it
+    """
+        Update an instance of a file with its current document, if it still exists
+    """
+    def reload_file(self, file):
+        json = Mongo.cache.find_one(self.files_coll, {'_id': file._id})
+        if json is not None:
+            self.refresh_file(file, json)
+
+    """
+        Update an instance of a file with a more recent version of its document
+    """
+    def refresh_file(self, file, json):
+        file.json = json
+        file.chunkSize = json.get('chunkSize', None)
+        file.length = json['length']
+        file.metadata = json['metadata']
+        file.attrs = json.get('attrs', {})
+
+    """
+        Append some chunks of a log-structured file as new extent documents, without loading nor rewriting the
+        existing data. Every chunk is given as a list of (start, data), like for write_chunks.
+    """
+    def append_extents(self, file, chunks, length):
+        chunks_id = self.chunks_id(file)
+        version = self.file_version(file)
+        extents = []
+        for n in sorted(chunks.keys()):
+            for start, data in chunks[n]:
+                extents.append({'files_id': chunks_id, 'n': n, 'start': start, 'data': data})
+        if len(extents) > 0:
+            Mongo.cache.insert_many(self.extents_coll, extents)
+
+        # Same update as write_chunks. We consider that the file is not sparse until the extents are compacted.
         dt = time.time()
-        Mongo.cache.find_one_and_update(self.files_coll, {'_id':file._id},{
-            '$set':{
-                'length':total_size,
-                'metadata.st_size':total_size,
-                'metadata.st_blocks':GenericFile.size_to_blocks(total_size),
+        blocks = GenericFile.size_to_blocks(max(length, file.length))
+        updated = self.update_file(file, {
+            '$max': {
+                'length': length,
+                'metadata.st_size': length
+            },
+            '$inc': {
+                'extents': len(extents)
+            },
+            '$set': {
+                'metadata.st_blocks': blocks,
                 'metadata.st_mtime': dt,
                 'metadata.st_atime': dt,
                 'metadata.st_ctime': dt
             }
         })
+        if not updated:
+            self.rewrite_chunks(file, chunks, length)
+            return
 
-        return True
+        metadata = dict(file.metadata)
+        metadata.update({'st_size': length, 'st_blocks': blocks, 'st_mtime': dt, 'st_atime': dt, 'st_ctime': dt})
+        file.length = length
+        file.metadata = metadata
+        file.json = dict(file.json, length=length, metadata=metadata, extents=file.json.get('extents', 0) + len(extents))
+        Mongo.cache.update_document(file.json)
+
+        # The chunks did not change
+        Mongo.cache.data_cache.update_version(chunks_id, version, self.file_version(file))
+        self.compactor.notify(file)
 
     """
-        Keep a cache to write large chunks of data more efficiently. If the data becomes too big (> 10MB), flush it
-        directly to the file. Otherwise it waits for the appropriate "flush" called at the end of the operation.
+        Fold the extents of a log-structured file into its chunks. The chunks are written before the extents are
+        deleted, and applying an extent twice does not change anything, so the reads are always correct. The extents
+        appended in the meantime are kept for the next compaction. The given file instance is updated.
+        Only one compaction of a file runs at a time: the ones of the current process (background compactor, truncate,
+        write) take the same lock, and the other mounts (or the "compact" command) wait for the lease we take on its
+        document.
     """
-    def add_data_to_write(self, file, data, offset):
-        # The cache used here is not smart at all: We only cache successive data in a file, we do not care about specific
-        # part of the file modified. As soon as the order is not strictly respected, we flush the cache to MongoDB.
-        key = str(file.directory_id) + '/' + file.filename
-        if key not in self.data_cache:
-            self.data_cache[key] = {'offset':offset,'data':bytearray(b'')}
+    def compact_extents(self, file):
+        with Mongo.compaction_locks[hash(file._id) % len(Mongo.compaction_locks)]:
+            json = self.claim_compaction(file._id)
+            if json is None:
+                return
+            lease = json['compaction_lease']
+            try:
+                json = self.compact_claimed_extents(json, lease)
+            finally:
+                if json is None:
+                    # We failed, or our lease expired and another compaction took it (the counters are left as is)
+                    Mongo.cache.update_one(self.files_coll, {'_id': file._id, 'compaction_lease': lease}, {'$unset': {'compaction_lease': ''}})
+        if json is not None:
+            self.refresh_file(file, json)
 
-        # Check if we need to flush the cache
-        max_size = 10*1024*1024
-        if self.data_cache[key]['offset'] + len(self.data_cache[key]['data']) != offset or len(self.data_cache[key]['data']) >= max_size:
-            print('Writting to another part of the file, flush the previous data.')
-            self.add_data(file=file, data=bytes(self.data_cache[key]['data']), offset=self.data_cache[key]['offset'], use_cache=False)
-            # Reset the cache for the new entry we will just add
-            self.data_cache[key] = {'offset':offset,'data':bytearray(b'')}
+    """
+        Take the lease to compact the extents of a file, waiting for the one of another mount to be released (or to
+        expire). Return the document of the file, or None if it does not have any extent anymore.
+    """
+    def claim_compaction(self, file_id):
+        while True:
+            json = Mongo.cache.find_one(self.files_coll, {'_id': file_id})
+            if json is None or json.get('extents', 0) <= 0:
+                return None
 
-        new_data = bytearray(data)
-        self.data_cache[key]['data'] += new_data
+            now = time.time()
+            json = Mongo.cache.find_one_and_update(self.files_coll, {
+                '_id': file_id,
+                '$or': [{'compaction_lease': {'$exists': False}}, {'compaction_lease': {'$lt': now}}]
+            }, {'$set': {'compaction_lease': now + Mongo.COMPACTION_LEASE}})
+            if json is not None:
+                return json
+            time.sleep(0.1)
 
-        return True
+    """
+        Compact the extents of a file once we have its lease, and release it. Return the updated document of the file.
+    """
+    def compact_claimed_extents(self, json, lease):
+        current = Mongo.load_generic_file(json)
+        chunks_id = self.chunks_id(current)
+
+        extents = list(Mongo.cache.find(self.extents_coll, {'files_id': chunks_id}, sort=[('_id', pymongo.ASCENDING)]))
+        numbers = sorted(set(extent['n'] for extent in extents))
+        query = {'files_id': chunks_id, 'n': {'$in': numbers}}
+        existing = {}
+        for chunk in Mongo.cache.decode_chunks(self.chunks_coll, list(Mongo.cache.find(self.chunks_coll, query))):
+            existing[chunk['n']] = chunk['data']
+
+        merged = {}
+        for extent in extents:
+            self.apply_extent(merged.setdefault(extent['n'], bytearray(existing.get(extent['n'], b''))), extent)
+        # A previous compaction might have written the chunks before crashing, so they are upserted
+        created = self.save_chunks(current, {n: bytes(data) for n, data in merged.items()})
+        deleted = 0
+        if len(extents) > 0:
+            deleted = Mongo.cache.delete_many(self.extents_coll, {'_id': {'$in': [extent['_id'] for extent in extents]}}).deleted_count
+
+        # The counter of the extents is increased after their insert, so a mount which crashed in-between left some
+        # extents which were never counted: we never remove more than the ones counted when we took the lease.
+        allocated_chunks = self.allocated_chunks(current) + created
+        json = Mongo.cache.find_one_and_update(self.files_coll, {'_id': current._id, 'compaction_lease': lease}, {
+            '$inc': {
+                'extents': -min(deleted, json.get('extents', 0)),
+                'compactions': 1,
+                'allocated_chunks': created
+            },
+            '$set': {
+                'metadata.st_blocks': self.allocated_blocks(current, allocated_chunks, current.length)
+            },
+            '$unset': {
+                'compaction_lease': ''
+            }
+        })
+        Mongo.cache.data_cache.invalidate(chunks_id)
+        return json
+
+    """
+        Fold the extents of every log-structured file into its chunks. Return the number of compacted files.
+    """
+    def compact_all_extents(self):
+        compacted = 0
+        for json in list(Mongo.cache.find(self.files_coll, {'extents': {'$gt': 0}})):
+            self.compact_extents(Mongo.load_generic_file(json))
+            compacted += 1
+        return compacted
+
+    """
+        Indicate if the data of a file with the given length can be stored in its document. Only small files can, and
+        the ones already having chunks keep them.
+    """
+    def can_inline_data(self, file, length):
+        if length > min(Mongo.configuration.inline_data_max_bytes(), file.chunkSize):
+            return False
+        return 'data' in file.json or self.allocated_chunks(file) == 0
+
+    """
+        Send the data of some chunks of a file, given as a dictionary {n: data}, to MongoDB. The chunks in "new" are
+        known to not exist yet. Return the number of chunks created.
+    """
+    def save_chunks(self, file, chunks, new=()):
+        if Mongo.configuration.mongo_deduplication():
+            return self.save_deduplicated_chunks(file, chunks, new)
+
+        requests = []
+        for n, (codec, data) in sorted(self.codec.encode_all(chunks).items()):
+            if n in new:
+                requests.append(pymongo.InsertOne(self.chunk_document(file, n, codec, data)))
+            else:
+                requests.append(pymongo.UpdateOne({'files_id': self.chunks_id(file), 'n': n}, self.chunk_update(codec, data), upsert=True))
+        return self.bulk_write_chunks(requests)
+
+    """
+        Same as save_chunks, but the chunks only reference their data, stored once in the payloads collection with
+        their hash as _id. The payloads previously referenced by the replaced chunks are released at the end, so they
+        are never deleted while a chunk still needs them.
+    """
+    def save_deduplicated_chunks(self, file, chunks, new=()):
+        hashes = {n: hashlib.sha256(data).hexdigest() for n, data in chunks.items()}
+        replaced = [n for n in chunks if n not in new]
+        previous = self.chunk_hashes(self.chunks_id(file), {'n': {'$in': replaced}}) if len(replaced) > 0 else []
+        self.reference_payloads({hashes[n]: data for n, data in chunks.items()}, Counter(hashes.values()))
+
+        requests = []
+        for n in sorted(chunks.keys()):
+            if n in new:
+                requests.append(pymongo.InsertOne({'files_id': self.chunks_id(file), 'n': n, 'hash': hashes[n]}))
+            else:
+                requests.append(pymongo.UpdateOne({'files_id': self.chunks_id(file), 'n': n}, {
+                    '$set': {'hash': hashes[n]},
+                    '$unset': {'data': '', 'codec': ''}
+                }, upsert=True))
+        created = self.bulk_write_chunks(requests)
+
+        self.release_payloads(previous)
+        return created
+
+    """
+        Send some requests on the chunks by batches, and return the number of chunks created
+    """
+    def bulk_write_chunks(self, requests):
+        if self.group_commit.enabled() and len(requests) < Mongo.BULK_SIZE:
+            return self.group_commit.submit(self.chunks_coll, requests)['created']
+
+        created = 0
+        for i in range(0, len(requests), Mongo.BULK_SIZE):
+            result = Mongo.cache.bulk_write(self.chunks_coll, requests[i:i + Mongo.BULK_SIZE])
+            created += result.inserted_count + result.upserted_count
+        return created
+
+    """
+        Return the hashes of the payloads referenced by the chunks stored with the given id (only by the chunks
+        matching the additional query if given). A chunk referenced twice is listed twice. Without the deduplication,
+        we do not look for them.
+    """
+    def chunk_hashes(self, chunks_id, query=None):
+        if not Mongo.configuration.mongo_deduplication():
+            return []
+        query = dict(query or {}, files_id=chunks_id, hash={'$exists': True})
+        return [chunk['hash'] for chunk in Mongo.cache.find(self.chunks_coll, query, {'hash': 1})]
+
+    """
+        Delete the chunks stored with the given id (only the ones matching the additional query if given), and release
+        their payloads. Return the number of deleted chunks.
+    """
+    def delete_chunks(self, chunks_id, query=None):
+        hashes = self.chunk_hashes(chunks_id, query)
+        result = Mongo.cache.delete_many(self.chunks_coll, dict(query or {}, files_id=chunks_id))
+        self.release_payloads(hashes)
+        return result.deleted_count
+
+    """
+        Add references to some payloads, given as a dictionary {hash: data} with the number of new references of every
+        hash. The data of the payloads already stored is not sent again.
+    """
+    def reference_payloads(self, payloads, references):
+        hashes = list(payloads.keys())
+        known = set(payload['_id'] for payload in Mongo.cache.find(self.payloads_coll, {'_id': {'$in': hashes}}, {'_id': 1}))
+        if len(known) > 0:
+            requests = [pymongo.UpdateOne({'_id': h}, {'$inc': {'refs': references[h]}}) for h in known]
+            matched = 0
+            for i in range(0, len(requests), Mongo.BULK_SIZE):
+                matched += Mongo.cache.bulk_write(self.payloads_coll, requests[i:i + Mongo.BULK_SIZE]).matched_count
+            if matched < len(requests):
+                # Some payloads were deleted in the meantime (no reference anymore), we need to send them again
+                known = set(payload['_id'] for payload in Mongo.cache.find(self.payloads_coll, {'_id': {'$in': list(known)}}, {'_id': 1}))
+
+        requests = []
+        for h, (codec, data) in self.codec.encode_all({h: payloads[h] for h in hashes if h not in known}).items():
+            payload = {'data': data}
+            if codec is not None:
+                payload['codec'] = codec
+            requests.append(pymongo.UpdateOne({'_id': h}, {'$inc': {'refs': references[h]}, '$setOnInsert': payload}, upsert=True))
+        for i in range(0, len(requests), Mongo.BULK_SIZE):
+            Mongo.cache.bulk_write(self.payloads_coll, requests[i:i + Mongo.BULK_SIZE])
 
     """
-        Flush the cache for a specific file
+        Remove one reference to the given payloads (a hash can be given several times), and delete the ones which are
+        not referenced anymore.
+    """
+    def release_payloads(self, hashes):
+        if len(hashes) == 0:
+            return
+
+        references = Counter(hashes)
+        requests = [pymongo.UpdateOne({'_id': h}, {'$inc': {'refs': -count}}) for h, count in references.items()]
+        for i in range(0, len(requests), Mongo.BULK_SIZE):
+            Mongo.cache.bulk_write(self.payloads_coll, requests[i:i + Mongo.BULK_SIZE])
+        Mongo.cache.delete_many(self.payloads_coll, {'_id': {'$in': list(references.keys())}, 'refs': {'$lte': 0}})
+
+    """
+        Document of a chunk, with its data already compressed by the given codec (None if not compressed)
+    """
+    def chunk_document(self, file, n, codec, data):
+        chunk = {'files_id': self.chunks_id(file), 'n': n, 'data': data}
+        if codec is not None:
+            chunk['codec'] = codec
+        return chunk
+
+    """
+        Update replacing the data of an existing chunk, already compressed by the given codec
+    """
+    def chunk_update(self, codec, data):
+        if codec is None:
+            return {'$set': {'data': data}, '$unset': {'codec': '', 'hash': ''}}
+        return {'$set': {'data': data, 'codec': codec}, '$unset': {'hash': ''}}
+
+    """
+        Write the data of a file not yet sent to MongoDB
     """
     def flush_data_to_write(self, file):
-        key = str(file.directory_id) + '/' + file.filename
-        if key in self.data_cache:
-            self.add_data(file=file, data=bytes(self.data_cache[key]['data']), offset=self.data_cache[key]['offset'], use_cache=False)
-            del self.data_cache[key]
+        self.write_buffer.flush(file)
+        return True
+
+    """
+        Make every write of a generic file durable. Its data not yet written is sent first, then a write with the write
+        concern of a fsync confirms it, with every previous write, as MongoDB replicates and journals them in order.
+        That is only true on a replica set: on a sharded cluster, the data was already written with the write concern
+        of a fsync (see MongoCache.load_internal()), the last write only confirms the metadata.
+    """
+    def fsync(self, generic_file):
+        if generic_file.is_file():
+            self.write_buffer.flush(generic_file)
+        elif generic_file.is_dir():
+            self.directory_counters.flush()
+        Mongo.cache.update_one(self.files_coll, {'_id': generic_file._id}, {'$set': {'fsync_time': time.time()}}, fsync=True)
         return True
 
     """
@@ -554,31 +1542,62 @@ class Mongo:
          length: Offset from which we need to truncate the file 
     """
     def truncate(self, file, length):
-        # We drop every unnecessary chunk
+        # The data not written yet might be after the new length, and the extents of a log-structured file too
+        self.write_buffer.flush(file)
+        if file.json.get('extents', 0) > 0:
+            self.compact_extents(file)
+
+        # We drop every unnecessary chunk. Extending a file only changes its length, the new part is a hole.
         chunk_size = file.chunkSize
         maximum_chunks = int(ceil(length / chunk_size))
-        Mongo.cache.delete_many(self.chunks_coll, {'files_id':file._id,'n':{'$gte':maximum_chunks}})
-
-        # We update the last chunk
-        if length % chunk_size != 0:
-            last_chunk = Mongo.cache.find_one(self.chunks_coll, {'files_id':file._id,'n':maximum_chunks-1})
-            last_chunk['data'] = last_chunk['data'][0:length % chunk_size]
-            Mongo.cache.find_one_and_update(self.chunks_coll, {'_id':last_chunk['_id']},{'$set':{'data':last_chunk['data']}})
+        allocated_chunks = self.allocated_chunks(file)
+        deleted = 0
+        fields = {}
+        if 'data' in file.json:
+            # The data of a small file is in its document
+            fields['data'] = file.json['data'][0:length]
+            fields['metadata.st_blocks'] = GenericFile.size_to_blocks(len(fields['data']))
+        elif length < file.length:
+            deleted = self.delete_chunks(self.chunks_id(file), {'n': {'$gte': maximum_chunks}})
+
+            # We update the last chunk, if it exists
+            if length % chunk_size != 0:
+                last_chunk = Mongo.cache.find_chunk_range(self.chunks_coll, self.chunks_id(file), maximum_chunks - 1, maximum_chunks - 1)
+                if len(last_chunk) > 0 and len(last_chunk[0]['data']) > length % chunk_size:
+                    self.save_chunks(file, {maximum_chunks - 1: last_chunk[0]['data'][0:length % chunk_size]})
 
         # We update the total length and that's it
         dt = time.time()
-        Mongo.cache.find_one_and_update(self.files_coll, {'_id':file._id},{
-            '$set': {
-                'length': length,
-                'metadata.st_size': length,
-                'metadata.st_blocks': GenericFile.size_to_blocks(length),
-                'metadata.st_mtime': dt,
-                'metadata.st_atime': dt,
-                'metadata.st_ctime': dt
-            }
+        fields.setdefault('metadata.st_blocks', self.allocated_blocks(file, max(0, allocated_chunks - deleted), length))
+        fields.update({
+            'length': length,
+            'metadata.st_size': length,
+            'metadata.st_mtime': dt,
+            'metadata.st_atime': dt,
+            'metadata.st_ctime': dt
         })
+        # Other hosts might have created chunks in the meantime, so we only remove the ones we deleted
+        Mongo.cache.find_one_and_update(self.files_coll, {'_id':file._id}, {'$set': fields, '$inc': {'allocated_chunks': -deleted}})
         return True
 
+    """
+        Return the number of chunks stored for a file. The files created by older versions do not have that counter,
+        so we count their chunks once and store it, as the counter is then only incremented.
+    """
+    def allocated_chunks(self, file):
+        if 'allocated_chunks' in file.json:
+            return file.json['allocated_chunks']
+        allocated_chunks = Mongo.cache.count(self.chunks_coll, {'files_id': self.chunks_id(file)})
+        Mongo.cache.update_one(self.files_coll, {'_id': file._id, 'allocated_chunks': {'$exists': False}},
+                               {'$set': {'allocated_chunks': allocated_chunks}})
+        return allocated_chunks
+
+    """
+        Return the number of blocks really used by a file, which can be smaller than its size for a sparse file
+    """
+    def allocated_blocks(self, file, allocated_chunks, length):
+        return GenericFile.size_to_blocks(min(length, allocated_chunks * file.chunkSize))
+
     """
         Rename a generic file to another name
          generic_file: Instance of a GenericFile type object
@@ -601,10 +1620,175 @@ class Mongo:
         # We rename it
         destination_directory_id = destination_directory._id
         dest_filename = destination_filepath.split('/')[-1]
-        Mongo.cache.find_one_and_update(self.files_coll, {'_id':generic_file._id},{'$set':{'directory_id':destination_directory_id,'filename':dest_filename}})
+        update = {'directory_id':destination_directory_id,'filename':dest_filename}
+        if Mongo.configuration.mongo_materialized_paths():
+            update['path'] = destination_filepath
+        try:
+            Mongo.cache.find_one_and_update(self.files_coll, {'_id':generic_file._id},{'$set':update})
+        except pymongo.errors.DuplicateKeyError:
+            if 'path' not in update or not self.release_materialized_path(destination_filepath, generic_file._id):
+                raise
+            Mongo.cache.find_one_and_update(self.files_coll, {'_id':generic_file._id},{'$set':update})
+        Mongo.cache.invalidate(directory_id=generic_file.directory_id, filename=generic_file.filename)
+        Mongo.cache.add_filename(directory_id=destination_directory_id, filename=dest_filename)
+        if generic_file.is_dir():
+            self.directory_cache.rename(parent_id=generic_file.directory_id, name=generic_file.filename,
+                                        destination_parent_id=destination_directory_id, destination_name=dest_filename,
+                                        directory_id=generic_file._id)
+            if Mongo.configuration.mongo_materialized_paths():
+                self.rename_materialized_paths(initial_filepath=initial_filepath, destination_filepath=destination_filepath)
 
         # We increase the number of nlink in the final directory
-        self.add_nlink_directory(directory_id=destination_directory_id, value=-1)
+        self.add_nlink_directory(directory_id=destination_directory_id, value=1)
+
+    """
+        Rewrite the materialized path of every generic file below a renamed directory. The documents are found with
+        an anchored regex (which can use the "path" index) and updated with unordered bulk writes.
+    """
+    def rename_materialized_paths(self, initial_filepath, destination_filepath):
+        query = {'path': {'$regex': '^' + re.escape(initial_filepath + '/')}}
+        paths = []
+        for elem in Mongo.cache.find(self.files_coll, query, {'path': True}):
+            paths.append((elem['_id'], destination_filepath + elem['path'][len(initial_filepath):]))
+            if len(paths) >= Mongo.BULK_SIZE:
+                self.update_materialized_paths(paths)
+                paths = []
+        if len(paths) > 0:
+            self.update_materialized_paths(paths)
+
+        # The cached documents still have the old paths
+        Mongo.cache.reset_cache()
+
+    """
+        Set the materialized path of some generic files, given as a list of (_id, path). A directory still having one
+        of those paths from an interrupted rename loses it first.
+    """
+    def update_materialized_paths(self, paths):
+        requests = [pymongo.UpdateOne({'_id': _id}, {'$set': {'path': path}}) for _id, path in paths]
+        try:
+            Mongo.cache.bulk_write(self.files_coll, requests)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') != 11000:
+                    raise
+                _id, path = paths[error['index']]
+                self.release_materialized_path(path, _id)
+                Mongo.cache.update_one(self.files_coll, {'_id': _id}, {'$set': {'path': path}})
+
+    """
+        Store the materialized path of every generic file, by browsing the whole hierarchy from the root. Only the
+        documents with a missing or wrong path are updated, so it can be run again safely while the file system is
+        mounted. Return the number of updated generic files.
+    """
+    def backfill_materialized_paths(self):
+        updated = 0
+        requests = []
+        for path, elem in self.walk_generic_files({'path': True}):
+            if elem.get('path', None) != path:
+                requests.append(pymongo.UpdateOne({'_id': elem['_id']}, {'$set': {'path': path}}))
+
+            if len(requests) >= Mongo.BULK_SIZE:
+                Mongo.cache.bulk_write(self.files_coll, requests)
+                updated += len(requests)
+                requests = []
+
+        if len(requests) > 0:
+            Mongo.cache.bulk_write(self.files_coll, requests)
+            updated += len(requests)
+        return updated
+
+    """
+        Browse the whole hierarchy from the root, and return every generic file with its path, as tuples
+        (path, document). The documents only have the given fields (and the ones we need), or every field if None.
+    """
+    def walk_generic_files(self, projection=None):
+        if projection is not None:
+            projection = dict(projection, filename=True, generic_file_type=True)
+        # The root directory is the only one with a "None" directory_id, and an empty filename
+        directories = [(None, '')]
+        while len(directories) > 0:
+            directory_id, directory_path = directories.pop()
+            for elem in Mongo.cache.find(self.files_coll, {'directory_id': directory_id}, projection):
+                path = directory_path + '/' + elem['filename']
+                if elem['generic_file_type'] == GenericFile.DIRECTORY_TYPE:
+                    directories.append((elem['_id'], path.rstrip('/')))
+                yield path, elem
+
+    """
+        Rewrite the chunks of every file whose chunk size does not follow the chunk size policy. It can be run while
+        the file system is mounted: the previous chunks are only deleted once the other hosts cannot use them anymore
+        (after the cache timeout). Return the number of re-chunked files.
+    """
+    def rechunk_files(self):
+        previous_chunks = []
+        for path, json in self.walk_generic_files():
+            if json['generic_file_type'] != GenericFile.FILE_TYPE or 'data' in json or json['length'] == 0:
+                continue
+            if json.get('extents', 0) > 0:
+                # The extents of a log-structured file must be compacted first
+                continue
+            chunk_size = self.chunk_size_policy.chunk_size(path, json['length'], json.get('random_access', False))
+            if chunk_size == json['chunkSize']:
+                continue
+
+            chunks_id = self.rechunk_file(Mongo.load_generic_file(json), chunk_size)
+            if chunks_id is not None:
+                previous_chunks.append(chunks_id)
+
+        if len(previous_chunks) > 0:
+            time.sleep(Mongo.configuration.cache_timeout())
+            for chunks_id in previous_chunks:
+                self.delete_chunks(chunks_id)
+        return len(previous_chunks)
+
+    """
+        Copy the data of a file to new chunks of the given size, stored with a new id, then switch the file to them if
+        it was not modified in the meantime. Return the id of the previous chunks, which must be deleted by the
+        caller, or None if the file was modified (the new chunks are then deleted).
+    """
+    def rechunk_file(self, file, chunk_size):
+        chunks_id = self.chunks_id(file)
+        target = Mongo.load_generic_file(dict(file.json, chunkSize=chunk_size, chunks_id=ObjectId()))
+
+        # We copy the data by pieces covering whole chunks of both sizes, without loading the whole file in memory.
+        # The holes of a sparse file stay holes.
+        step = int(ceil(max(file.chunkSize, chunk_size) / chunk_size)) * chunk_size
+        allocated_chunks = 0
+        for offset in range(0, file.length, step):
+            extents = ExtentMap()
+            starting_chunk = offset // file.chunkSize
+            ending_chunk = (offset + step - 1) // file.chunkSize
+            for chunk in Mongo.cache.find_chunk_range(self.chunks_coll, chunks_id, starting_chunk, ending_chunk):
+                position = chunk['n'] * file.chunkSize
+                extents.add(max(position, offset), chunk['data'][max(0, offset - position):offset + step - position])
+
+            written = {}
+            for n, pieces in extents.chunks(chunk_size).items():
+                data = bytearray()
+                for start, piece in pieces:
+                    data.extend(bytes(start - len(data)))
+                    data.extend(piece)
+                written[n] = bytes(data)
+            allocated_chunks += self.save_chunks(target, written, new=set(written.keys()))
+
+        result = Mongo.cache.find_one_and_update(self.files_coll, {
+            '_id': file._id,
+            'chunkSize': file.chunkSize,
+            'length': file.length,
+            'metadata.st_mtime': file.metadata['st_mtime']
+        }, {
+            '$set': {
+                'chunkSize': chunk_size,
+                'chunks_id': self.chunks_id(target),
+                'allocated_chunks': allocated_chunks,
+                'metadata.st_blocks': self.allocated_blocks(target, allocated_chunks, file.length)
+            }
+        })
+        if result is None:
+            # The file was modified in the meantime, we keep its current chunks
+            self.delete_chunks(self.chunks_id(target))
+            return None
+        return chunks_id
 
     """
         Remove locks for a generic file 
@@ -619,11 +1803,23 @@ class Mongo:
         Update some arbitrary fields in the general "files" object
     """
     def basic_save(self, generic_file, metadata, attrs, host, uname, gname):
-        Mongo.cache.find_one_and_update(self.files_coll, {'_id': generic_file._id}, {'$set': { 'metadata':metadata, 'attrs':attrs, 'host': host, 'gname': gname, 'uname': uname}})
+        fields = {'metadata': metadata, 'attrs': attrs, 'host': host, 'gname': gname, 'uname': uname}
+        if not self.group_commit.enabled():
+            Mongo.cache.find_one_and_update(self.files_coll, {'_id': generic_file._id}, {'$set': fields})
+            return
+
+        # We do not get the document back, the cached one is updated from ours
+        self.group_commit.submit(self.files_coll, [pymongo.UpdateOne({'_id': generic_file._id}, {'$set': fields})])
+        generic_file.json = dict(generic_file.json, **fields)
+        Mongo.cache.update_document(generic_file.json)
 
     """
         Clean the database, only for development purposes
     """
     def clean_database(self):
+        self.directory_cache.clear()
         Mongo.cache.drop(self.chunks_coll)
+        Mongo.cache.drop(self.payloads_coll)
+        Mongo.cache.drop(self.extents_coll)
+        Mongo.cache.drop(self.tombstones_coll)
         Mongo.cache.drop(self.files_coll)
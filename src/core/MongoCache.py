@@ -1,13 +1,18 @@
 #!/usr/lib/mongofs/environment/bin/python
 import os
 import subprocess
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from expiringdict import ExpiringDict
 
 from pymongo.errors import NetworkTimeout, AutoReconnect, ConnectionFailure
 from pymongo import MongoClient
-import gridfs
+from pymongo.write_concern import WriteConcern
 from src.core.Configuration import Configuration
+from src.core.BloomFilter import BloomFilter
+from src.core.ChunkCache import ChunkCache
+from src.core.ChunkCodec import ChunkCodec
 from pymongo.collection import ReturnDocument
 
 from functools import wraps
@@ -75,23 +80,137 @@ class MongoCache:
     instance = None
     configuration = None
     cache = None
+    data_cache = None
+    # Threads used to load the chunks of a file in parallel, None if disabled
+    chunks_executor = None
+
+    # Expected false positive rate of the Bloom filters of directories
+    BLOOM_FILTER_ERROR_RATE = 0.01
+    # Maximum number of filenames in the Bloom filter of a directory, bigger directories do not have one
+    BLOOM_FILTER_MAX_ELEMENTS = 100000
+    # Filenames created in the directories being listed, for every listing in progress: {directory_id: [set(), ...]}
+    listings = {}
+    listings_lock = threading.RLock()
 
     def __init__(self):
         # We reuse the same connexion
         if MongoCache.instance is None:
             MongoCache.configuration = Configuration()
+            MongoCache.data_cache = ChunkCache(max_bytes=MongoCache.configuration.data_cache_max_bytes(),
+                                               timeout=MongoCache.configuration.data_cache_timeout())
+            if MongoCache.configuration.parallel_reads_threads() > 0:
+                MongoCache.chunks_executor = ThreadPoolExecutor(max_workers=MongoCache.configuration.parallel_reads_threads())
             self.reset_cache()
             retry_connection(self.connect())
         retry_connection(self.load_internal())
 
     """
-        Reset the cache completely. This should be done every time we delete / update more than 1 thing to avoid problems.
+        Reset the cache of the generic files completely. This should be done every time we delete / update more than
+        1 thing to avoid problems. The data cache is not concerned, its chunks are invalidated one by one.
     """
     def reset_cache(self):
         MongoCache.cache = ExpiringDict(max_len=MongoCache.configuration.cache_max_elements(),
                                         max_age_seconds=MongoCache.configuration.cache_timeout())
-        MongoCache.data_cache = ExpiringDict(max_len=MongoCache.configuration.data_cache_max_elements(
-        ), max_age_seconds=MongoCache.configuration.data_cache_timeout())
+        MongoCache.negative_cache = ExpiringDict(max_len=MongoCache.configuration.negative_cache_max_elements(),
+                                                 max_age_seconds=MongoCache.configuration.negative_cache_timeout())
+        MongoCache.bloom_filters = ExpiringDict(max_len=MongoCache.configuration.negative_cache_bloom_filters(),
+                                                max_age_seconds=MongoCache.configuration.negative_cache_timeout())
+
+    """
+        Remove a specific generic file from the cache, useful if its directory_id / filename changed as the cache is
+        indexed on them.
+    """
+    def invalidate(self, directory_id, filename):
+        MongoCache.cache.pop(str(directory_id) + '/' + filename, None)
+
+    """
+        Store a generic file document we received from another query (a directory listing for example) in the cache,
+        so that we do not need to load it again in find_one()
+    """
+    def add_document(self, document):
+        MongoCache.cache[str(document['directory_id']) + '/' + document['filename']] = document
+
+    """
+        Replace a generic file document in the cache, after an update_one(), only if we already have it. If it was
+        renamed in the meantime, we must not put it back under its old name.
+    """
+    def update_document(self, document):
+        key = str(document['directory_id']) + '/' + document['filename']
+        cached = MongoCache.cache.get(key)
+        if cached is not None and cached['_id'] == document['_id']:
+            MongoCache.cache[key] = document
+
+    """
+        Indicate that a generic file now exists with the given directory_id / filename on the current host, so we
+        cannot consider it as missing anymore.
+    """
+    def add_filename(self, directory_id, filename):
+        MongoCache.negative_cache.pop(str(directory_id) + '/' + filename, None)
+        with MongoCache.listings_lock:
+            for created in MongoCache.listings.get(str(directory_id), []):
+                created.add(filename)
+        bloom_filter = MongoCache.bloom_filters.get(str(directory_id))
+        if bloom_filter is not None:
+            bloom_filter.add(filename)
+
+    """
+        Indicate if we need to build a Bloom filter for the directories we list
+    """
+    def use_bloom_filters(self):
+        return MongoCache.configuration.negative_cache_bloom_filters() > 0 and MongoCache.configuration.negative_cache_timeout() > 0
+
+    """
+        Indicate that we start to list a directory to build its Bloom filter. Return the set of filenames created in
+        the directory until the end of the listing, as the listing might not see them.
+    """
+    def start_listing(self, directory_id):
+        created = set()
+        with MongoCache.listings_lock:
+            MongoCache.listings.setdefault(str(directory_id), []).append(created)
+        return created
+
+    """
+        Indicate that a listing started with start_listing() is over (finished or not)
+    """
+    def end_listing(self, directory_id, created):
+        with MongoCache.listings_lock:
+            listings = MongoCache.listings.get(str(directory_id), [])
+            if created in listings:
+                listings.remove(created)
+            if len(listings) == 0:
+                MongoCache.listings.pop(str(directory_id), None)
+
+    """
+        Keep a Bloom filter of every filename of a directory, once we listed it entirely. The filenames created since
+        the start of the listing (given by start_listing()) are added to it, as the listing might have missed them.
+    """
+    def add_bloom_filter(self, directory_id, filenames, created=None):
+        if not self.use_bloom_filters() or len(filenames) > MongoCache.BLOOM_FILTER_MAX_ELEMENTS:
+            if created is not None:
+                self.end_listing(directory_id, created)
+            return
+
+        bloom_filter = BloomFilter(capacity=2 * len(filenames) + 64, error_rate=MongoCache.BLOOM_FILTER_ERROR_RATE)
+        for filename in filenames:
+            bloom_filter.add(filename)
+        # A filename created from now on is either in "created", or added to the installed filter by add_filename()
+        with MongoCache.listings_lock:
+            if created is not None:
+                self.end_listing(directory_id, created)
+                for filename in created:
+                    bloom_filter.add(filename)
+            MongoCache.bloom_filters[str(directory_id)] = bloom_filter
+
+    """
+        Indicate if we are sure that no generic file exists with the given directory_id / filename, without contacting
+        MongoDB.
+    """
+    def is_missing(self, directory_id, filename):
+        if str(directory_id) + '/' + filename in MongoCache.negative_cache:
+            return True
+
+        bloom_filter = MongoCache.bloom_filters.get(str(directory_id))
+        return bloom_filter is not None and filename not in bloom_filter
 
     """
         Establish a connection to mongodb
@@ -103,13 +222,28 @@ class MongoCache:
 
         # If we were disconnected from MongoDB, it would be wise to reset the cache
         self.reset_cache()
+        MongoCache.data_cache.clear()
 
     """
         Create an index
     """
     @retry_connection
-    def create_index(self, coll, index):
-        return self.database[coll].create_index(index)
+    def create_index(self, coll, index, unique=False, **options):
+        return self.database[coll].create_index(index, unique=unique, **options)
+
+    """
+        Return the existing indexes of a collection, see pymongo index_information()
+    """
+    @retry_connection
+    def index_information(self, coll):
+        return self.database[coll].index_information()
+
+    """
+        Drop an index by its name
+    """
+    @retry_connection
+    def drop_index(self, coll, name):
+        return self.database[coll].drop_index(name)
 
     """
         Get the objects to connect to the correct database and collections
@@ -118,11 +252,28 @@ class MongoCache:
         self.instance = MongoCache.instance
         self.database = MongoCache.instance[MongoCache.configuration.mongo_database()]
 
-        # We use gridfs only to store the files. Even if we have a lot of small files, the overhead should
-        # still be small.
-        # Documentation: https://api.mongodb.com/python/current/api/gridfs/index.html
-        gridfs_collection = MongoCache.configuration.mongo_prefix() + 'files'
-        self.gridfs = gridfs.GridFS(self.database, gridfs_collection)
+        # The data can be written with a faster write concern than the metadata, a fsync confirms it afterwards
+        self.data_write_concern = WriteConcern(w=MongoCache.configuration.durability_data_write_acknowledgement(),
+                                               j=MongoCache.configuration.durability_data_write_j())
+        self.fsync_write_concern = WriteConcern(w=MongoCache.configuration.durability_fsync_write_acknowledgement(),
+                                                j=MongoCache.configuration.durability_fsync_write_j())
+        # On a sharded cluster, the write of a fsync only confirms the previous writes of its own shard, and the data
+        # of a file can be on any shard. So the data is directly written with the write concern of a fsync.
+        self.sharded = self.instance.is_mongos
+        if self.sharded:
+            self.data_write_concern = self.fsync_write_concern
+
+    """
+        Return a collection to write in it, with the write concern of the data for the collections of the data
+        (chunks, payloads, extents), or the one of a fsync if asked. The other collections use the default write
+        concern of the connection.
+    """
+    def collection(self, coll, fsync=False):
+        if fsync:
+            return self.database.get_collection(coll, write_concern=self.fsync_write_concern)
+        if coll.endswith(('.chunks', '.payloads', '.extents')):
+            return self.database.get_collection(coll, write_concern=self.data_write_concern)
+        return self.database[coll]
 
     """
         Simply retrieve any document
@@ -156,10 +307,17 @@ class MongoCache:
                     # The document might be deleted as the clean up could occur just 1ms afterwards when we access some attributes
                     print('Exception while using the cache, it might happen some times (normally there should not be any impact): ' + str(e))
 
-            # Key not found in cache, we try to load the object and store it before returning it (only if the document exists)
+            # Key not found in cache, but we might already know that the document does not exist
+            if self.is_missing(query['directory_id'], query['filename']):
+                return None
+
+            # We try to load the object and store it before returning it
             res = self.database[coll].find_one(query)
             if res is not None:
                 MongoCache.cache[key] = res
+            elif len(query) == 2:
+                # We can only be sure that the document does not exist if there is no other criteria in the query
+                MongoCache.negative_cache[key] = True
             return res
 
         return self.database[coll].find_one(query)
@@ -169,20 +327,100 @@ class MongoCache:
         It needs to be handle on the caller side to avoid any problem.
     """
     @retry_connection
-    def find(self, coll, query, projection=None):
-        # We need a small data cache for some blocks
-        if len(query) == 2 and 'files_id' in query and 'n' in query and '$gte' in query['n'] and '$lte' in query['n']:
-            key = str(query['files_id']) + '/' + str(query['n']['$gte']) + '/' + str(query['n']['$lte'])
-            if key in MongoCache.data_cache:
-                # Be careful: the clean up could occur just 1ms afterwards when we access some attributes
-                return MongoCache.data_cache[key]
+    def find(self, coll, query, projection=None, sort=None, limit=0):
+        return self.database[coll].find(query, projection, no_cursor_timeout=True, sort=sort, limit=limit)
+
+    """
+        Return the data of the chunks of a file between starting_chunk and ending_chunk (included), as a dictionary
+        {n: data}. A chunk which does not exist in MongoDB is missing from the dictionary. The version is any value
+        changing when the file is modified, so we never use the cached data of a previous version.
+    """
+    @retry_connection
+    def find_chunks(self, coll, files_id, starting_chunk, ending_chunk, version):
+        chunks = {}
+        missing = []
+        for n in range(starting_chunk, ending_chunk + 1):
+            data = MongoCache.data_cache.get(files_id, n, version)
+            if data is None:
+                missing.append(n)
+            else:
+                chunks[n] = data
+
+        if len(missing) == 0:
+            return chunks
+
+        ranges = self.chunk_ranges(missing)
+        if MongoCache.chunks_executor is None or len(ranges) == 1:
+            results = [self.find_chunk_range(coll, files_id, missing[0], missing[-1])]
+        else:
+            futures = [MongoCache.chunks_executor.submit(self.find_chunk_range, coll, files_id, start, end) for start, end in ranges]
+            results = [future.result() for future in futures]
+
+        for result in results:
+            for chunk in result:
+                if chunk['n'] not in chunks:
+                    MongoCache.data_cache.put(files_id, chunk['n'], version, chunk['data'])
+                    chunks[chunk['n']] = chunk['data']
+
+        return chunks
 
-            # Data not found in cache, we need to store it
-            raw = list(self.database[coll].find(query, projection, no_cursor_timeout=True))
-            MongoCache.data_cache[key] = raw
-            return raw
+    """
+        Split the sorted list of missing chunks into ranges (start, end) of consecutive chunks, with at most
+        "parallel_reads.chunks_per_query" chunks by range.
+    """
+    def chunk_ranges(self, missing):
+        chunks_per_query = MongoCache.configuration.parallel_reads_chunks_per_query()
+        ranges = []
+        for n in missing:
+            if len(ranges) > 0 and ranges[-1][1] == n - 1 and n - ranges[-1][0] < chunks_per_query:
+                ranges[-1] = (ranges[-1][0], n)
+            else:
+                ranges.append((n, n))
+        return ranges
+
+    """
+        Load a range of chunks of a file (both included), without using the data cache. Their data is decompressed.
+    """
+    @retry_connection
+    def find_chunk_range(self, coll, files_id, starting_chunk, ending_chunk):
+        query = {'files_id': files_id, 'n': {'$gte': starting_chunk, '$lte': ending_chunk}}
+        return self.decode_chunks(coll, list(self.database[coll].find(query, no_cursor_timeout=True)))
+
+    """
+        Set the decompressed data of some chunks loaded from the given collection. A deduplicated chunk only has the
+        hash of its data, which is loaded from the "payloads" collection, with a single query for every chunk.
+    """
+    @retry_connection
+    def decode_chunks(self, coll, chunks):
+        hashes = list(set(chunk['hash'] for chunk in chunks if 'hash' in chunk))
+        payloads = {}
+        if len(hashes) > 0:
+            payloads_coll = coll[0:-len('chunks')] + 'payloads'
+            for payload in self.database[payloads_coll].find({'_id': {'$in': hashes}}, no_cursor_timeout=True):
+                payloads[payload['_id']] = payload
+
+        for chunk in chunks:
+            source = chunk
+            if 'hash' in chunk:
+                source = payloads.get(chunk['hash'])
+                if source is None:
+                    raise IOError('Missing payload ' + chunk['hash'] + ' for the chunk ' + str(chunk['n']) + ' of the file ' + str(chunk['files_id']))
+            chunk['data'] = ChunkCodec.decode(source.get('codec'), source['data'])
+        return chunks
+
+    """
+        A simple count
+    """
+    @retry_connection
+    def count(self, coll, query):
+        return self.database[coll].count(query)
 
-        return self.database[coll].find(query, projection, no_cursor_timeout=True)
+    """
+        A simple aggregate, allowed to use the disk as it is only used for maintenance
+    """
+    @retry_connection
+    def aggregate(self, coll, pipeline):
+        return self.database[coll].aggregate(pipeline, allowDiskUse=True)
 
     """
         A FindOneAndUpdate which always return the document after modification
@@ -195,11 +433,19 @@ class MongoCache:
             key = str(result['directory_id']) + '/' + str(result['filename'])
             MongoCache.cache[key] = result
         elif coll.endswith('.chunks') and result is not None:
-            # We simply reset the data cache to avoid complicating things if we update a document.
-            self.reset_cache()
+            # Only the modified chunk is obsolete
+            MongoCache.data_cache.invalidate(result['files_id'], result['n'])
 
         return result
 
+    """
+        A simple update_one, without getting the document back. The cache of a generic file must be updated
+        separately, with update_document(). With fsync, it waits for the write concern of a fsync.
+    """
+    @retry_connection
+    def update_one(self, coll, query, update, fsync=False):
+        return self.collection(coll, fsync).update_one(query, update)
+
     """
         A simple insert_one
     """
@@ -212,31 +458,35 @@ class MongoCache:
     """
     @retry_connection
     def insert_many(self, coll, documents):
-        return self.database[coll].insert_many(documents, ordered=False, bypass_document_validation=True)
+        return self.collection(coll).insert_many(documents, ordered=False, bypass_document_validation=True)
 
-    """ 
-        A simple delete_many
+    """
+        A simple unordered bulk_write
     """
     @retry_connection
-    def delete_many(self, coll, query):
-        self.reset_cache()
-        return self.database[coll].delete_many(query)
+    def bulk_write(self, coll, requests):
+        return self.collection(coll).bulk_write(requests, ordered=False)
 
     """
-        Create a new file with gridfs directly. Save it directly
+        A simple delete_one. The cache is not reset, the cached document of a deleted generic file must be removed
+        separately, with invalidate().
     """
     @retry_connection
-    def gridfs_new_file(self, file):
-        f = self.gridfs.new_file(**file)
-        f.close()
+    def delete_one(self, coll, query):
+        return self.collection(coll).delete_one(query)
 
-    """
-        Delete a file in gridfs
+    """ 
+        A simple delete_many
     """
     @retry_connection
-    def gridfs_delete(self, _id):
-        self.reset_cache()
-        return self.gridfs.delete(_id)
+    def delete_many(self, coll, query):
+        if coll.endswith('.chunks') and 'files_id' in query:
+            # Only the chunks of that file are concerned
+            MongoCache.data_cache.invalidate(query['files_id'])
+        elif coll.endswith('.files'):
+            # The other collections (payloads, extents) are never cached
+            self.reset_cache()
+        return self.collection(coll).delete_many(query)
 
     """
         The drop command is only used for development normally
@@ -244,4 +494,5 @@ class MongoCache:
     @retry_connection
     def drop(self, coll):
         self.reset_cache()
+        MongoCache.data_cache.clear()
         return self.database[coll].drop()
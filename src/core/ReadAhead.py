@@ -0,0 +1,92 @@
+#!/usr/lib/mongofs/environment/bin/python
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from expiringdict import ExpiringDict
+
+"""
+    Detect files read sequentially (cat, cp, streaming, ...) and load their next chunks in background threads, so the
+    reads do not need to wait for MongoDB at every chunk boundary.
+    The number of chunks read in advance starts at 1 and doubles at every sequential read, up to a maximum depending on
+    the memory we are allowed to use. A read elsewhere in the file resets it, and cancels the pending loads.
+"""
+class ReadAhead:
+    # Maximum distance (in bytes) between two reads to still consider them as sequential, as FUSE can send a few
+    # reads in parallel, and not exactly in order.
+    SEQUENTIAL_WINDOW = 1024 * 1024
+
+    def __init__(self, fetch, max_chunks, max_bytes, threads):
+        self.fetch = fetch
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.executor = None
+        self.streams = ExpiringDict(max_len=1000, max_age_seconds=60)
+        self.lock = threading.Lock()
+
+    """
+        Indicate if the read-ahead is activated
+    """
+    def enabled(self):
+        return self.max_chunks > 0 and self.threads > 0
+
+    """
+        Maximum number of chunks we can read in advance for a file, without using more than the allowed memory.
+    """
+    def max_depth(self, file):
+        return max(1, min(self.max_chunks, self.max_bytes // file.chunkSize))
+
+    """
+        Wait for the background loads of the given chunks of a file, to avoid loading them twice.
+    """
+    def wait(self, file, starting_chunk, ending_chunk):
+        if not self.enabled():
+            return
+
+        with self.lock:
+            stream = self.streams.get(file._id)
+            futures = [] if stream is None else [future for start, end, future in stream['loads']
+                                                  if start <= ending_chunk and end >= starting_chunk]
+        concurrent.futures.wait(futures)
+
+    """
+        Register a read on a file, and load its next chunks in background if it is read sequentially.
+    """
+    def read(self, file, offset, size):
+        if not self.enabled():
+            return
+
+        chunk_size = file.chunkSize
+        with self.lock:
+            # A new file read from its beginning is considered as sequential
+            stream = self.streams.get(file._id)
+            if stream is None:
+                stream = {'next_offset': 0, 'depth': 0, 'loaded_until': -1, 'loads': []}
+            if abs(offset - stream['next_offset']) <= ReadAhead.SEQUENTIAL_WINDOW:
+                stream['depth'] = min(max(1, stream['depth'] * 2), self.max_depth(file))
+            else:
+                for start, end, future in stream['loads']:
+                    future.cancel()
+                stream = {'next_offset': 0, 'depth': 0, 'loaded_until': -1, 'loads': []}
+
+            stream['next_offset'] = max(stream['next_offset'], offset + size)
+            stream['loads'] = [load for load in stream['loads'] if not load[2].done()]
+            self.streams[file._id] = stream
+
+            if stream['depth'] == 0 or file.length == 0:
+                return
+
+            current_chunk = (offset + size - 1) // chunk_size
+            last_chunk = (file.length - 1) // chunk_size
+            starting_chunk = max(current_chunk + 1, stream['loaded_until'] + 1)
+            ending_chunk = min(current_chunk + stream['depth'], last_chunk)
+            if starting_chunk > ending_chunk:
+                return
+
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads)
+            for n in range(starting_chunk, ending_chunk + 1):
+                future = self.executor.submit(self.fetch, file, n, n)
+                stream['loads'].append((n, n, future))
+            stream['loaded_until'] = ending_chunk
+
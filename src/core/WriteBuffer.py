@@ -0,0 +1,256 @@
+#!/usr/lib/mongofs/environment/bin/python
+import errno
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fuse import FuseOSError
+
+from src.core.ExtentMap import ExtentMap
+
+"""
+    Write-back buffer of the data written to the files. The writes of every file are kept in memory in an ExtentMap,
+    and written to MongoDB by background threads when a chunk is full, when the data is older than the flush interval,
+    or when a flush is explicitly asked (close, fsync, ...). The total size of the data not yet written is limited:
+    above it, the writers wait for the background threads to write some data.
+    Until the data is in MongoDB, the reads of the current host get it from the buffer. If a write fails, its data
+    stays in the buffer to be written again, and the next explicit flush (fsync, close, ...) fails with EIO if it
+    cannot write it either.
+"""
+class WriteBuffer:
+    def __init__(self, write, max_bytes, flush_interval, threads, reload=None):
+        # Function writing the dirty chunks of a file: write(file, {n: [(start, data), ...]}, length)
+        self.write = write
+        # Function updating an instance of a file with its current document before we write it: reload(file)
+        self.reload = reload
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.threads = threads
+        self.files = {}
+        self.dirty_bytes = 0
+        self.executor = None
+        self.flusher = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    """
+        Indicate if the data is written in background, otherwise every write is directly sent to MongoDB.
+    """
+    def enabled(self):
+        return self.max_bytes > 0 and self.threads > 0
+
+    """
+        Add some data written to a file
+    """
+    def add(self, file, data, offset):
+        if len(data) == 0:
+            return
+
+        if not self.enabled():
+            extents = ExtentMap()
+            extents.add(offset, data)
+            self.write(file, extents.chunks(file.chunkSize), max(file.length, offset + len(data)))
+            return
+
+        with self.condition:
+            while self.dirty_bytes > 0 and self.dirty_bytes + len(data) > self.max_bytes:
+                for file_id in self.files:
+                    self.schedule(file_id, everything=True)
+                self.condition.wait()
+
+            entry = self.files.get(file._id)
+            if entry is None:
+                entry = {'file': file, 'extents': ExtentMap(), 'flushing': ExtentMap(), 'length': file.length,
+                         'flushed_length': file.length, 'deadline': time.time() + self.flush_interval,
+                         'scheduled': False, 'everything': False, 'flush_lock': threading.Lock()}
+                self.files[file._id] = entry
+            elif entry['extents'].size == 0:
+                # The previous data was written, the new one can wait for the whole interval
+                entry['deadline'] = time.time() + self.flush_interval
+            entry['length'] = max(entry['length'], offset + len(data))
+
+            size = entry['extents'].size
+            entry['extents'].add(offset, data)
+            self.dirty_bytes += entry['extents'].size - size
+
+            # The full chunks can be written directly
+            chunk_size = file.chunkSize
+            if offset // chunk_size != (offset + len(data)) // chunk_size:
+                self.schedule(file._id, everything=False)
+            self.start_flusher()
+
+    """
+        Ask the background threads to write the full chunks of a file, or all its chunks. The lock must already be
+        taken.
+    """
+    def schedule(self, file_id, everything):
+        entry = self.files[file_id]
+        entry['everything'] = entry['everything'] or everything
+        if entry['scheduled']:
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        entry['scheduled'] = True
+        self.executor.submit(self.run, file_id)
+
+    """
+        Background job writing the chunks of a file
+    """
+    def run(self, file_id):
+        with self.lock:
+            entry = self.files.get(file_id)
+            if entry is None:
+                return
+            everything = entry['everything']
+            entry['scheduled'] = False
+            entry['everything'] = False
+
+        try:
+            self.flush_file(file_id, everything=everything)
+        except Exception:
+            # The data stays in the buffer, the next explicit flush fails if it cannot write it either
+            pass
+
+    """
+        Background thread asking to write the files whose data is older than the flush interval
+    """
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+
+        def flusher():
+            while True:
+                time.sleep(max(min(self.flush_interval, 1), 0.05))
+                with self.lock:
+                    now = time.time()
+                    for file_id, entry in self.files.items():
+                        if entry['deadline'] <= now and entry['extents'].size > 0:
+                            self.schedule(file_id, everything=True)
+
+        self.flusher = threading.Thread(target=flusher, daemon=True)
+        self.flusher.start()
+
+    """
+        Write the dirty data of a file to MongoDB, only the full chunks, or everything. Every chunk is only written
+        once. The writes of a file are done one after the other, in the order of the flushes. The file is reloaded
+        before being written, as the instance we have might be older than its document. If the write fails, the data
+        is put back in the buffer, and the error is raised.
+    """
+    def flush_file(self, file_id, everything, file=None):
+        with self.lock:
+            entry = self.files.get(file_id)
+        if entry is None:
+            return
+
+        with entry['flush_lock']:
+            with self.lock:
+                if file is not None:
+                    entry['file'] = file
+                file = entry['file']
+                chunk_size = file.chunkSize
+                if everything:
+                    flushing = entry['extents']
+                    entry['extents'] = ExtentMap()
+                    length = entry['length']
+                else:
+                    flushing = ExtentMap()
+                    for n in entry['extents'].full_chunks(chunk_size):
+                        for position, data in entry['extents'].remove(n * chunk_size, (n + 1) * chunk_size):
+                            flushing.add(position, data)
+                    length = min(max(entry['flushed_length'], flushing.end()), entry['length'])
+                # Until the write is done, the reads still need that data
+                entry['flushing'] = flushing
+
+            try:
+                if flushing.size > 0 or length != entry['flushed_length']:
+                    if self.reload is not None:
+                        self.reload(file)
+                    self.write(file, flushing.chunks(file.chunkSize), length)
+            except Exception:
+                with self.condition:
+                    # The data written since then is more recent than the one we could not write
+                    flushing_size = flushing.size
+                    extents_size = entry['extents'].size
+                    for position, data in entry['extents'].extents:
+                        flushing.add(position, data)
+                    entry['extents'] = flushing
+                    entry['flushing'] = ExtentMap()
+                    self.dirty_bytes += flushing.size - extents_size - flushing_size
+                    self.condition.notify_all()
+                raise
+
+            with self.condition:
+                entry['flushing'] = ExtentMap()
+                entry['flushed_length'] = length
+                if everything:
+                    # The flusher must not write the file again before the end of a new interval
+                    entry['deadline'] = time.time() + self.flush_interval
+                self.dirty_bytes -= flushing.size
+                if entry['extents'].size == 0 and entry['length'] == length and self.files.get(file_id) is entry:
+                    del self.files[file_id]
+                self.condition.notify_all()
+
+    """
+        Write all the dirty data of a file to MongoDB, and wait for it. The given file instance is updated with the
+        new length. Raise EIO if the data cannot be written.
+    """
+    def flush(self, file):
+        try:
+            self.flush_file(file._id, everything=True, file=file)
+        except FuseOSError:
+            raise
+        except Exception:
+            raise FuseOSError(errno.EIO)
+
+    """
+        Write all the dirty data of every file, before umounting for example. Raise the first error, once we tried to
+        write every file.
+    """
+    def flush_all(self):
+        with self.lock:
+            file_ids = list(self.files.keys())
+        error = None
+        for file_id in file_ids:
+            try:
+                self.flush_file(file_id, everything=True)
+            except Exception as e:
+                # We still try to write the other files
+                error = error or e
+        if error is not None:
+            raise error
+
+    """
+        Forget the dirty data of a file, as it is deleted
+    """
+    def discard(self, file):
+        with self.lock:
+            entry = self.files.get(file._id)
+        if entry is None:
+            return
+
+        with entry['flush_lock']:
+            with self.condition:
+                self.dirty_bytes -= entry['extents'].size
+                entry['extents'] = ExtentMap()
+                if self.files.get(file._id) is entry:
+                    del self.files[file._id]
+                self.condition.notify_all()
+
+    """
+        Return the length of a file including the data not yet written, or None if we do not have any for it.
+    """
+    def length(self, file):
+        with self.lock:
+            entry = self.files.get(file._id)
+            return None if entry is None else entry['length']
+
+    """
+        Return the length of a file including the data not yet written (or None if we do not have any), and the data
+        not yet written between offset and offset + size, as a list of (position, bytes), the most recent last.
+    """
+    def read(self, file, offset, size):
+        with self.lock:
+            entry = self.files.get(file._id)
+            if entry is None:
+                return None, []
+            return entry['length'], entry['flushing'].read(offset, size) + entry['extents'].read(offset, size)
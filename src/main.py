@@ -1,6 +1,7 @@
 #!/usr/lib/mongofs/environment/bin/python
 
 import logging
+import json
 import time
 import os
 import errno
@@ -8,7 +9,8 @@ import fcntl
 from ctypes import *
 
 from sys import argv, exit
-from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from expiringdict import ExpiringDict
+from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, c_stat, set_st_attrs
 
 from src.core.Configuration import Configuration
 from src.core.GenericFile import GenericFile
@@ -23,11 +25,19 @@ class MongoFS(LoggingMixIn, Operations):
     # This is useful to be able to umount if there is an error to access MongoDB for example
     mounting_point = None
 
+    # Special attribute of a directory giving its number of files, without listing it
+    ENTRIES_XATTR = 'user.mongofs.entries'
+    # Special attribute of the root directory giving the statistics of the data cache
+    DATA_CACHE_XATTR = 'user.mongofs.data_cache'
+
     def __init__(self):
         self.configuration = Configuration()
         self.mongo = Mongo()
         self.files = {}
 
+        # Filename of the last entry given by readdir() for a (path, offset), to resume a listing efficiently
+        self.readdir_positions = ExpiringDict(max_len=10000, max_age_seconds=60)
+
         # Additional setup
         GenericFile.mongo = self.mongo
         GenericFile.configuration = self.configuration
@@ -142,14 +152,34 @@ class MongoFS(LoggingMixIn, Operations):
         self.mongo.remove_generic_file(generic_file=directory)
 
     """
-        List files inside a directory
+        List files inside a directory. This is a generator, so we never need to keep the whole directory in memory.
+        FUSE can stop the listing when its buffer is full, and call us again with the offset of the next entry. The
+        offset of an entry is simply its position in the listing ('.' and '..' included), and we remember the filename
+        at each offset to continue the listing directly from it.
     """
-    def readdir(self, path, fh):
-        files = self.mongo.list_generic_files_in_directory(filepath=path)
+    def readdir(self, path, fh, offset=0):
+        attributes = self.configuration.readdir_attributes()
+        after = None
+        if offset < 2:
+            for name in ['.', '..'][offset:]:
+                offset += 1
+                yield name, None, offset
+        else:
+            after = self.readdir_positions.get((path, offset))
+
+        # If we do not know the filename at that offset anymore, we need to start from the beginning
+        skip = offset - 2 if after is None else 0
+        for elem in self.mongo.iterate_generic_files_in_directory(filepath=path, after=after):
+            if skip > 0:
+                skip -= 1
+                continue
 
-        # We need to only keep final filename
-        filenames = [file.filename for file in files]
-        return ['.', '..'] + filenames
+            offset += 1
+            self.readdir_positions[(path, offset)] = elem['filename']
+            attrs = None
+            if attributes and 'metadata' in elem:
+                attrs = self.attributes(self.mongo.load_generic_file(elem))
+            yield elem['filename'], attrs, offset
 
     """
         Write data to a file, from a specific offset. Returns the written data size
@@ -173,8 +203,26 @@ class MongoFS(LoggingMixIn, Operations):
         gf = self.mongo.get_generic_file(filepath=path)
         if gf is None:
             raise FuseOSError(errno.ENOENT)
+        return self.attributes(gf)
 
+    """
+        Return the attributes of a generic file, as expected by fusepy
+    """
+    def attributes(self, gf):
         metadata = gf.metadata
+
+        # The size must include the data written by the current host, not yet sent to MongoDB
+        length = self.mongo.write_buffer.length(gf) if gf.is_file() else None
+        if length is not None and length != metadata['st_size']:
+            metadata = dict(metadata)
+            metadata['st_size'] = length
+
+        # Same for the files created in a directory
+        links = self.mongo.directory_counters.pending(gf._id) if gf.is_dir() else 0
+        if links != 0:
+            metadata = dict(metadata)
+            metadata['st_nlink'] += links
+
         if gf.host != self.configuration.hostname():
             if metadata['st_uid'] != 0:
                 uid = self.mongo.get_userid(gf.uname)
@@ -217,6 +265,11 @@ class MongoFS(LoggingMixIn, Operations):
     """
     def getxattr(self, path, name, position=0):
         gf = self.mongo.get_generic_file(filepath=path)
+        if name == MongoFS.ENTRIES_XATTR and gf.is_dir():
+            return str(self.mongo.count_generic_files_in_directory(directory=gf)).encode('utf-8')
+        elif name == MongoFS.DATA_CACHE_XATTR and path == '/':
+            return json.dumps(self.mongo.cache.data_cache.stats()).encode('utf-8')
+
         try:
             return gf.attrs[name]
         except KeyError:
@@ -275,6 +328,48 @@ class MongoFS(LoggingMixIn, Operations):
         self.mongo.flush_data_to_write(file=file)
         return None
 
+    """
+        Flush data to MongoDB, and wait until it is durable (see "durability" in the configuration)
+    """
+    def fsync(self, path, datasync, fh):
+        file = self.mongo.get_generic_file(filepath=path)
+        self.mongo.fsync(generic_file=file)
+        return None
+
+    """
+        Wait until the creations / deletions of files in a directory are durable. A write on the directory with the
+        write concern of a fsync confirms every previous write.
+    """
+    def fsyncdir(self, path, datasync, fh):
+        directory = self.mongo.get_generic_file(filepath=path)
+        self.mongo.fsync(generic_file=directory)
+        return None
+
+    """
+        Write the data of every file, and the counters of the directories, before umounting
+    """
+    def destroy(self, path):
+        self.mongo.write_buffer.flush_all()
+        self.mongo.directory_counters.flush()
+
+
+"""
+    fusepy does not give the offset received from FUSE to readdir(), so we would need to list a whole directory every
+    time FUSE asks for the next entries. We simply give that offset as an additional parameter to readdir().
+"""
+class MongoFUSE(FUSE):
+    def readdir(self, path, buf, filler, offset, fip):
+        for name, attrs, next_offset in self.operations('readdir', self._decode_optional_path(path), fip.contents.fh, offset):
+            st = None
+            if attrs:
+                st = c_stat()
+                set_st_attrs(st, attrs)
+
+            if filler(buf, name.encode(self.encoding), st, next_offset) != 0:
+                break
+
+        return 0
+
 
 if __name__ == '__main__':
     if len(argv) < 2:
@@ -320,8 +415,8 @@ if __name__ == '__main__':
     configuration = Configuration()
     if configuration.is_development():
         logging.basicConfig(level=logging.DEBUG)
-        fuse = FUSE(MongoFS(), mounting_point, foreground=True, nothreads=True, allow_other=allow_other, **fuse_options)
+        fuse = MongoFUSE(MongoFS(), mounting_point, foreground=True, nothreads=True, allow_other=allow_other, **fuse_options)
     else:
         logging.basicConfig(level=logging.ERROR)
-        fuse = FUSE(MongoFS(), mounting_point, foreground=False,
+        fuse = MongoFUSE(MongoFS(), mounting_point, foreground=False,
                     nothreads=False, allow_other=allow_other, **fuse_options)
@@ -34,6 +34,8 @@ class Utils:
             self.files_coll.delete_one({'directory_id': None, 'filename': ''})
             self.files_coll.insert_one(root_raw)
             self.root_id = root_raw['_id']
+            # The previous root directory is pinned in the directory cache
+            self.mongo.directory_cache.clear()
 
         with open('test/resources/data/file.json', 'r') as f:
             self.file_raw = json_util.loads(f.read())
@@ -60,18 +62,26 @@ class Utils:
 
     def insert_file(self):
         self.files_coll.insert_one(self.file_raw)
+        self.add_filename(self.file_raw)
+
+    def add_filename(self, raw):
+        # The documents are inserted as if they were created by the current host, so they cannot be considered missing
+        self.mongo.cache.add_filename(directory_id=raw['directory_id'], filename=raw['filename'])
 
     def insert_file_chunks(self):
         self.chunks_coll.insert_many(self.file_chunks_raw)
 
     def insert_directory(self):
         self.files_coll.insert_one(self.directory_raw)
+        self.add_filename(self.directory_raw)
 
     def insert_directory_file(self):
         self.files_coll.insert_one(self.directory_file_raw)
+        self.add_filename(self.directory_file_raw)
 
     def insert_symbolic_link(self):
         self.files_coll.insert_one(self.symbolic_link_raw)
+        self.add_filename(self.symbolic_link_raw)
 
     def read_file_chunks(self, flush=True):
         # To avoid cache problems, we flush the content before
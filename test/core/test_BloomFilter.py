@@ -0,0 +1,31 @@
+import unittest
+
+from src.core.BloomFilter import BloomFilter
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.obj = BloomFilter(capacity=1000, error_rate=0.01)
+
+    def test_add(self):
+        filenames = ['file-' + str(i) for i in range(0, 1000)]
+        for filename in filenames:
+            self.obj.add(filename)
+
+        # There is no false negative
+        for filename in filenames:
+            self.assertTrue(filename in self.obj)
+
+    def test_missing(self):
+        for i in range(0, 1000):
+            self.obj.add('file-' + str(i))
+
+        false_positives = len([i for i in range(0, 10000) if 'other-' + str(i) in self.obj])
+        self.assertLess(false_positives, 300)
+
+    def test_empty(self):
+        obj = BloomFilter(capacity=0, error_rate=0.01)
+        self.assertFalse('file' in obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+from src.core.ChunkCache import ChunkCache
+
+class TestChunkCache(unittest.TestCase):
+    def setUp(self):
+        self.obj = ChunkCache(max_bytes=10, timeout=60)
+
+    def test_get(self):
+        self.obj.put('file', 0, 1, b'abcd')
+        self.assertEqual(self.obj.get('file', 0, 1), b'abcd')
+        self.assertEqual(self.obj.get('file', 1, 1), None)
+        self.assertEqual(self.obj.stats()['hits'], 1)
+        self.assertEqual(self.obj.stats()['misses'], 1)
+
+    def test_get_other_version(self):
+        self.obj.put('file', 0, 1, b'abcd')
+        self.assertEqual(self.obj.get('file', 0, 2), None)
+        self.assertEqual(self.obj.stats()['bytes'], 0)
+
+    def test_put_same_chunk(self):
+        self.obj.put('file', 0, 1, b'abcd')
+        self.obj.put('file', 0, 2, b'efgh')
+        self.assertEqual(self.obj.get('file', 0, 2), b'efgh')
+        self.assertEqual(self.obj.stats()['bytes'], 4)
+
+    def test_eviction(self):
+        self.obj.put('file', 0, 1, b'abcd')
+        self.obj.put('file', 1, 1, b'efgh')
+        self.obj.get('file', 0, 1)
+        self.obj.put('file', 2, 1, b'ijkl')
+
+        # The least recently used chunk is evicted to stay below the maximum size
+        self.assertEqual(self.obj.get('file', 1, 1), None)
+        self.assertEqual(self.obj.get('file', 0, 1), b'abcd')
+        self.assertEqual(self.obj.stats()['bytes'], 8)
+
+    def test_put_too_big(self):
+        self.obj.put('file', 0, 1, b'a' * 11)
+        self.assertEqual(self.obj.get('file', 0, 1), None)
+
+    def test_invalidate(self):
+        self.obj.put('file', 0, 1, b'ab')
+        self.obj.put('file', 1, 1, b'cd')
+        self.obj.put('other', 0, 1, b'ef')
+
+        self.obj.invalidate('file', 0)
+        self.assertEqual(self.obj.get('file', 0, 1), None)
+        self.assertEqual(self.obj.get('file', 1, 1), b'cd')
+
+        self.obj.invalidate('file')
+        self.assertEqual(self.obj.get('file', 1, 1), None)
+        self.assertEqual(self.obj.get('other', 0, 1), b'ef')
+
+    def test_disabled(self):
+        obj = ChunkCache(max_bytes=10, timeout=0)
+        obj.put('file', 0, 1, b'ab')
+        self.assertEqual(obj.get('file', 0, 1), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import unittest
+
+from src.core.ChunkCodec import ChunkCodec
+
+class TestChunkCodec(unittest.TestCase):
+    def setUp(self):
+        self.obj = ChunkCodec(codec='zlib', level=6, threads=2)
+        self.text = b'Some logs which are easy to compress. ' * 1000
+
+    def test_encode(self):
+        for codec in ChunkCodec.available_codecs():
+            obj = ChunkCodec(codec=codec, level=6, threads=0)
+            used_codec, data = obj.encode(self.text)
+            self.assertEqual(used_codec, codec)
+            self.assertLess(len(data), len(self.text))
+            self.assertEqual(ChunkCodec.decode(used_codec, data), self.text)
+
+    def test_encode_incompressible(self):
+        data = os.urandom(64 * 1024)
+        self.assertTrue(ChunkCodec.is_incompressible(data))
+        self.assertEqual(self.obj.encode(data), (None, data))
+
+        # Not worth it for very small data
+        self.assertEqual(self.obj.encode(b'ab'), (None, b'ab'))
+
+    def test_encode_all(self):
+        chunks = {0: self.text, 1: b'ab', 2: self.text[1:]}
+        encoded = self.obj.encode_all(chunks)
+        self.assertEqual(sorted(encoded.keys()), [0, 1, 2])
+        self.assertEqual(encoded[1], (None, b'ab'))
+        for n in chunks:
+            self.assertEqual(ChunkCodec.decode(*encoded[n]), chunks[n])
+
+    def test_disabled(self):
+        obj = ChunkCodec(codec=None, level=6, threads=2)
+        self.assertEqual(obj.encode(self.text), (None, self.text))
+
+        # An unknown codec is simply ignored
+        obj = ChunkCodec(codec='unknown', level=6, threads=2)
+        self.assertEqual(obj.codec, None)
+
+    def test_decode_uncompressed(self):
+        self.assertEqual(ChunkCodec.decode(None, b'abc'), b'abc')
+        with self.assertRaises(ValueError):
+            ChunkCodec.decode('unknown', b'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
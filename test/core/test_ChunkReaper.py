@@ -0,0 +1,36 @@
+import unittest
+import threading
+
+from src.core.ChunkReaper import ChunkReaper
+
+class TestChunkReaper(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.event = threading.Event()
+        self.obj = ChunkReaper(reap=self.reap, chunks_per_second=100000, interval=60)
+
+    def reap(self, max_chunks):
+        self.batches.append(max_chunks)
+        if len(self.batches) == 2:
+            self.event.set()
+        return max_chunks if len(self.batches) == 1 else 0
+
+    def test_batch_size(self):
+        self.assertEqual(self.obj.batch_size(), ChunkReaper.MAX_BATCH)
+        self.assertEqual(ChunkReaper(reap=self.reap, chunks_per_second=10, interval=60).batch_size(), 10)
+        self.assertEqual(ChunkReaper(reap=self.reap, chunks_per_second=0.5, interval=60).batch_size(), 1)
+
+    def test_start(self):
+        # The batches follow each other while there are chunks to delete
+        self.obj.start()
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(self.batches, [ChunkReaper.MAX_BATCH, ChunkReaper.MAX_BATCH])
+
+    def test_disabled(self):
+        obj = ChunkReaper(reap=self.reap, chunks_per_second=0, interval=60)
+        self.assertFalse(obj.enabled())
+        obj.start()
+        self.assertEqual(obj.thread, None)
+
+if __name__ == '__main__':
+    unittest.main()
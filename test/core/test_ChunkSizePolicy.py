@@ -0,0 +1,46 @@
+import unittest
+
+from src.core.ChunkSizePolicy import ChunkSizePolicy
+
+class FakeFile:
+    def __init__(self):
+        self._id = 'file'
+        self.chunkSize = 1000
+        self.json = {}
+
+class TestChunkSizePolicy(unittest.TestCase):
+    def setUp(self):
+        self.obj = ChunkSizePolicy(default_chunk_size=1000, rules=[{'path': '*.db', 'chunk_size': 10}],
+                                   size_classes=[{'max_length': 100000, 'chunk_size': 500},
+                                                 {'max_length': 1000, 'chunk_size': 100}],
+                                   random_access_chunk_size=50)
+        self.file = FakeFile()
+
+    def test_chunk_size_new_file(self):
+        # We do not know the size of a new file, only the rules are used
+        self.assertEqual(self.obj.chunk_size('/a/file'), 1000)
+        self.assertEqual(self.obj.chunk_size('/a/data.db'), 10)
+
+    def test_chunk_size_existing_file(self):
+        self.assertEqual(self.obj.chunk_size('/file', length=800), 100)
+        self.assertEqual(self.obj.chunk_size('/file', length=5000), 500)
+        self.assertEqual(self.obj.chunk_size('/file', length=500000), 1000)
+        self.assertEqual(self.obj.chunk_size('/file', length=500000, random_access=True), 50)
+        self.assertEqual(self.obj.chunk_size('/data.db', length=500000, random_access=True), 10)
+
+    def test_record_access_sequential(self):
+        for i in range(0, 100):
+            self.assertFalse(self.obj.record_access(self.file, i * 100, 100))
+
+    def test_record_access_random(self):
+        detected = [self.obj.record_access(self.file, (i % 2) * 50000, 100) for i in range(0, 40)]
+        self.assertEqual(detected.count(True), 1)
+        self.assertEqual(detected.index(True), ChunkSizePolicy.RANDOM_ACCESSES)
+
+    def test_record_access_disabled(self):
+        self.obj.random_access_chunk_size = 0
+        detected = [self.obj.record_access(self.file, (i % 2) * 50000, 100) for i in range(0, 40)]
+        self.assertEqual(detected.count(True), 0)
+
+if __name__ == '__main__':
+    unittest.main()
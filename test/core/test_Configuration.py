@@ -42,14 +42,46 @@ class TestConfiguration(unittest.TestCase):
     def test_cache_timeout(self):
         self.assertEqual(self.obj.cache_timeout(), 2)
 
+    def test_directory_cache_timeout(self):
+        # Same as the cache of the generic files by default
+        self.assertEqual(self.obj.directory_cache_timeout(), 2)
+        self.obj.conf['directory_cache'] = {'timeout_s': 60}
+        self.assertEqual(self.obj.directory_cache_timeout(), 60)
+
     def test_cache_max_elements(self):
         self.assertEqual(self.obj.cache_max_elements(), 10000)
 
     def test_data_cache_timeout(self):
         self.assertEqual(self.obj.data_cache_timeout(), 2)
 
-    def test_data_cache_max_elements(self):
-        self.assertEqual(self.obj.data_cache_max_elements(), 50)
+    def test_data_cache_max_bytes(self):
+        self.assertEqual(self.obj.data_cache_max_bytes(), 67108864)
+
+    def test_data_cache_max_bytes_max_elements(self):
+        # Configuration written before data_cache.max_bytes
+        del self.obj.conf['data_cache']['max_bytes']
+        self.obj.conf['data_cache']['max_elements'] = 10
+        self.assertEqual(self.obj.data_cache_max_bytes(), 10 * self.obj.chunk_size())
+
+        del self.obj.conf['data_cache']['max_elements']
+        self.assertEqual(self.obj.data_cache_max_bytes(), 256 * 1024 * 1024)
+
+    def test_write_buffer_max_bytes(self):
+        self.assertEqual(self.obj.write_buffer_max_bytes(), 16777216)
+
+    def test_write_buffer_flush_interval(self):
+        self.assertEqual(self.obj.write_buffer_flush_interval(), 1)
+
+    def test_durability(self):
+        # By default, the data uses the same write concern as the metadata
+        self.assertEqual(self.obj.durability_data_write_acknowledgement(), 1)
+        self.assertEqual(self.obj.durability_data_write_j(), False)
+        self.assertEqual(self.obj.durability_fsync_write_acknowledgement(), 'majority')
+        self.assertEqual(self.obj.durability_fsync_write_j(), True)
+
+    def test_durability_unacknowledged(self):
+        self.obj.conf['durability'] = {'data_write_acknowledgement': 0}
+        self.assertRaises(ValueError, self.obj.durability_data_write_acknowledgement)
 
     def test_is_development(self):
         self.assertEqual(self.obj.is_development(), True)
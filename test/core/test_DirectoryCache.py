@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import patch
+
+from src.core.DirectoryCache import DirectoryCache
+
+class TestDirectoryCache(unittest.TestCase):
+    def setUp(self):
+        self.obj = DirectoryCache(max_elements=3, timeout=0)
+        self.obj.add(parent_id=None, name='', directory_id='root')
+        self.obj.add(parent_id='root', name='a', directory_id='a')
+        self.obj.add(parent_id='a', name='b', directory_id='b')
+
+    def test_resolve(self):
+        self.assertEqual(self.obj.resolve(['', 'a', 'b']), ('b', 3))
+
+    def test_resolve_partial(self):
+        self.assertEqual(self.obj.resolve(['', 'a', 'c', 'd']), ('a', 2))
+
+    def test_resolve_unknown_root(self):
+        self.obj.clear()
+        self.assertEqual(self.obj.resolve(['', 'a']), (None, 0))
+
+    def test_remove(self):
+        self.obj.remove(parent_id='root', name='a')
+        self.assertEqual(self.obj.resolve(['', 'a', 'b']), ('root', 1))
+
+    def test_invalidate(self):
+        # Only the edges added long enough ago are removed
+        self.assertFalse(self.obj.invalidate(['', 'a', 'b'], min_age=60))
+        self.assertEqual(self.obj.resolve(['', 'a', 'b']), ('b', 3))
+        self.assertTrue(self.obj.invalidate(['', 'a', 'b'], min_age=0))
+        self.assertEqual(self.obj.resolve(['', 'a', 'b']), ('root', 1))
+
+    def test_rename(self):
+        self.obj.rename(parent_id='root', name='a', destination_parent_id='root', destination_name='z', directory_id='a')
+        self.assertEqual(self.obj.resolve(['', 'a']), ('root', 1))
+        # The subtree of a renamed directory is still known
+        self.assertEqual(self.obj.resolve(['', 'z', 'b']), ('b', 3))
+
+    def test_lru_eviction_keeps_root(self):
+        self.obj.add(parent_id='b', name='c', directory_id='c')
+        self.obj.add(parent_id='c', name='d', directory_id='d')
+        self.obj.add(parent_id='d', name='e', directory_id='e')
+        # The oldest edges are evicted, but never the root
+        self.assertEqual(self.obj.resolve(['', 'a']), ('root', 1))
+        self.assertEqual(len(self.obj.edges), 3)
+
+    def test_timeout(self):
+        obj = DirectoryCache(max_elements=10, timeout=5)
+        obj.add(parent_id=None, name='', directory_id='root')
+        obj.add(parent_id='root', name='a', directory_id='a')
+        with patch('src.core.DirectoryCache.time.time') as mock_time:
+            mock_time.return_value = 10**12
+            self.assertEqual(obj.resolve(['', 'a']), ('root', 1))
+
+    def test_disabled(self):
+        obj = DirectoryCache(max_elements=0, timeout=0)
+        obj.add(parent_id=None, name='', directory_id='root')
+        self.assertEqual(obj.resolve(['']), (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
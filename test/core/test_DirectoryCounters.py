@@ -0,0 +1,55 @@
+import unittest
+
+from src.core.DirectoryCounters import DirectoryCounters
+
+class TestDirectoryCounters(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.fail = False
+        self.obj = DirectoryCounters(send=self.send, flush_interval=60)
+
+    def send(self, deltas):
+        if self.fail:
+            raise IOError('Disconnected')
+        self.sent.append(deltas)
+
+    def test_add(self):
+        self.obj.add('a', 1)
+        self.obj.add('a', 1)
+        self.obj.add('b', 1)
+        self.assertEqual(self.obj.pending('a'), 2)
+        self.assertEqual(self.sent, [])
+
+        self.obj.flush()
+        self.assertEqual(self.sent, [{'a': 2, 'b': 1}])
+        self.assertEqual(self.obj.pending('a'), 0)
+        self.obj.flush()
+        self.assertEqual(len(self.sent), 1)
+
+    def test_cancel(self):
+        self.obj.add('a', 1)
+        # Only the local increments can be cancelled, the rest must be sent by the caller
+        self.assertEqual(self.obj.cancel('a', 1), 0)
+        self.assertEqual(self.obj.cancel('a', 1), 1)
+        self.obj.add('a', 2)
+        self.assertEqual(self.obj.cancel('a', 3), 1)
+        self.obj.flush()
+        self.assertEqual(self.sent, [])
+
+    def test_flush_error(self):
+        self.obj.add('a', 1)
+        self.fail = True
+        with self.assertRaises(IOError):
+            self.obj.flush()
+        # The increments are kept for the next flush
+        self.obj.add('a', 1)
+        self.fail = False
+        self.obj.flush()
+        self.assertEqual(self.sent, [{'a': 2}])
+
+    def test_disabled(self):
+        self.assertTrue(self.obj.enabled())
+        self.assertFalse(DirectoryCounters(send=self.send, flush_interval=0).enabled())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import threading
+
+from src.core.ExtentCompactor import ExtentCompactor
+
+class FakeFile:
+    def __init__(self, extents):
+        self._id = 'file'
+        self.json = {'extents': extents}
+
+class TestExtentCompactor(unittest.TestCase):
+    def setUp(self):
+        self.compacted = []
+        self.event = threading.Event()
+        self.obj = ExtentCompactor(compact=self.compact, max_extents=10, threads=1)
+
+    def compact(self, file):
+        self.compacted.append(file._id)
+        self.event.set()
+
+    def test_notify_below_limit(self):
+        self.obj.notify(FakeFile(extents=9))
+        self.assertEqual(self.obj.executor, None)
+        self.assertEqual(self.compacted, [])
+
+    def test_notify(self):
+        self.obj.notify(FakeFile(extents=10))
+        self.assertTrue(self.event.wait(5))
+        self.assertEqual(self.compacted, ['file'])
+        self.assertEqual(self.obj.pending, set())
+
+    def test_disabled(self):
+        obj = ExtentCompactor(compact=self.compact, max_extents=0, threads=1)
+        obj.notify(FakeFile(extents=1000))
+        self.assertEqual(obj.executor, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from src.core.ExtentMap import ExtentMap
+
+class TestExtentMap(unittest.TestCase):
+    def setUp(self):
+        self.obj = ExtentMap()
+
+    def test_add(self):
+        self.obj.add(10, b'abc')
+        self.obj.add(0, b'xy')
+        self.assertEqual(self.obj.extents, [[0, bytearray(b'xy')], [10, bytearray(b'abc')]])
+        self.assertEqual(self.obj.size, 5)
+
+        # Adjacent extents are merged
+        self.obj.add(13, b'd')
+        self.assertEqual(self.obj.extents, [[0, bytearray(b'xy')], [10, bytearray(b'abcd')]])
+
+        # Overlapping extents are merged, the new data replacing the previous one
+        self.obj.add(1, b'0123456789XY')
+        self.assertEqual(self.obj.extents, [[0, bytearray(b'x0123456789XYd')]])
+        self.assertEqual(self.obj.starts, [0])
+        self.assertEqual(self.obj.size, 14)
+        self.assertEqual(self.obj.end(), 14)
+
+    def test_read(self):
+        self.obj.add(2, b'abc')
+        self.obj.add(8, b'def')
+        self.assertEqual(self.obj.read(0, 3), [(2, b'a')])
+        self.assertEqual(self.obj.read(3, 6), [(3, b'bc'), (8, b'd')])
+        self.assertEqual(self.obj.read(11, 5), [])
+
+    def test_remove(self):
+        self.obj.add(0, b'abcdefgh')
+        self.assertEqual(self.obj.remove(2, 4), [(2, b'cd')])
+        self.assertEqual(self.obj.extents, [[0, bytearray(b'ab')], [4, bytearray(b'efgh')]])
+        self.assertEqual(self.obj.starts, [0, 4])
+        self.assertEqual(self.obj.size, 6)
+
+    def test_chunks(self):
+        self.obj.add(3, b'abcdefg')
+        self.obj.add(12, b'h')
+        self.assertEqual(self.obj.full_chunks(4), [1])
+        self.assertEqual(self.obj.chunks(4), {0: [(3, b'a')], 1: [(0, b'bcde')], 2: [(0, b'fg')], 3: [(0, b'h')]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import threading
+import pymongo
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from src.core.GroupCommit import GroupCommit
+
+class FakeResult:
+    def __init__(self, requests):
+        self.upserted_ids = {}
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.obj = GroupCommit(bulk_write=self.bulk_write, window=0.2, max_operations=100)
+
+    def bulk_write(self, coll, requests):
+        with self.lock:
+            self.calls.append((coll, len(requests)))
+        duplicates = [i for i, request in enumerate(requests) if isinstance(request, pymongo.InsertOne) and request._doc.get('duplicate')]
+        if len(duplicates) > 0:
+            raise BulkWriteError({'writeErrors': [{'index': i, 'code': 11000, 'errmsg': 'E11000'} for i in duplicates],
+                                  'upserted': [], 'nMatched': 0})
+        return FakeResult(requests)
+
+    def test_submit_grouped(self):
+        # The writes of concurrent threads are sent together
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda i: self.obj.submit('files', [pymongo.InsertOne({'i': i})]), range(10)))
+        self.assertEqual([result['created'] for result in results], [1] * 10)
+        self.assertLess(len(self.calls), 10)
+        self.assertEqual(sum(size for coll, size in self.calls), 10)
+
+    def test_submit_full(self):
+        # A full batch does not wait for the window
+        obj = GroupCommit(bulk_write=self.bulk_write, window=60, max_operations=2)
+        result = obj.submit('chunks', [pymongo.InsertOne({'n': 0}), pymongo.InsertOne({'n': 1})])
+        self.assertEqual(result, {'created': 2})
+        self.assertEqual(self.calls, [('chunks', 2)])
+
+    def test_submit_collections(self):
+        # One bulk_write by collection
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(self.obj.submit, 'files', [pymongo.UpdateOne({'_id': 1}, {'$set': {'a': 1}})])
+            second = executor.submit(self.obj.submit, 'chunks', [pymongo.InsertOne({'n': 0})])
+            self.assertEqual(first.result(), {'created': 0})
+            self.assertEqual(second.result(), {'created': 1})
+        self.assertEqual(sorted(self.calls), [('chunks', 1), ('files', 1)])
+
+    def test_submit_error(self):
+        # Only the caller whose write failed receives the error
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            failed = executor.submit(self.obj.submit, 'files', [pymongo.InsertOne({'duplicate': True})])
+            succeeded = executor.submit(self.obj.submit, 'files', [pymongo.InsertOne({'i': 1})])
+            with self.assertRaises(DuplicateKeyError):
+                failed.result()
+            self.assertEqual(succeeded.result()['created'], 1)
+
+    def test_disabled(self):
+        self.assertTrue(self.obj.enabled())
+        self.assertFalse(GroupCommit(bulk_write=self.bulk_write, window=0, max_operations=100).enabled())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
 import unittest
-from unittest.mock import patch
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, PropertyMock
 from bson import json_util
 from fuse import FuseOSError
 
 from src.core.Configuration import Configuration
 from src.core.Mongo import Mongo
+from src.core.MongoCache import MongoCache
+from src.core.ChunkCodec import ChunkCodec
 from src.core.GenericFile import GenericFile
 from src.core.File import File
 from src.core.Directory import Directory
@@ -51,12 +56,142 @@ class TestMongo(unittest.TestCase):
         gf = self.utils.files_coll.find_one({'directory_id':self.utils.file.directory_id,'filename':self.utils.file.filename},{'uploadDate':False})
         self.assertEqual(json_util.dumps(gf, sort_keys=True), json_util.dumps(self.utils.file_raw, sort_keys=True))
 
+    def test_create_generic_file_exists(self):
+        self.assertTrue(self.obj.unique_filenames)
+        self.utils.insert_file()
+        with self.assertRaises(FuseOSError):
+            GenericFile.new_generic_file(filepath=self.utils.file.filepath, mode=0o644, file_type=GenericFile.FILE_TYPE)
+        self.assertEqual(self.utils.files_coll.count({'filename': self.utils.file.filename}), 1)
+
+        # The same insert done twice (retried after a disconnection) is not an error
+        self.obj.create_generic_file(generic_file=self.utils.file)
+
+    def test_create_filename_index_duplicates(self):
+        # File systems created by older versions may have two files with the same name in a directory
+        self.utils.files_coll.drop_indexes()
+        self.utils.files_coll.create_index([('directory_id', 1), ('filename', 1)])
+        self.utils.insert_file()
+        duplicate = dict(self.utils.file_raw)
+        del duplicate['_id']
+        self.utils.files_coll.insert_one(duplicate)
+
+        # The previous index is kept, and the files with the same name are logged
+        with patch.object(self.obj.cache, 'drop_index') as mock_drop_index, patch.object(Mongo.logger, 'warning') as mock_warning:
+            self.assertFalse(self.obj.create_filename_index())
+            self.assertEqual(mock_drop_index.call_count, 0)
+            self.assertIn(self.utils.file.filename, mock_warning.call_args[0][0])
+        self.assertIn('directory_id_1_filename_1', self.utils.files_coll.index_information())
+
+        # Without duplicates, the previous index is dropped before the unique one is built on the same keys
+        self.utils.files_coll.delete_one({'_id': duplicate['_id']})
+        with patch.object(self.obj.cache, 'create_index', wraps=self.obj.cache.create_index) as mock_create_index:
+            self.assertTrue(self.obj.create_filename_index())
+            self.assertEqual(mock_create_index.call_args[1], {'unique': True, 'background': True})
+        indexes = self.utils.files_coll.index_information()
+        self.assertTrue(indexes['directory_id_1_filename_1']['unique'])
+        self.assertTrue(self.obj.create_filename_index())
+
+    def test_create_generic_file_group_commit(self):
+        self.obj.group_commit.window = 0.01
+        GenericFile.new_generic_file(filepath='/grouped', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        with self.assertRaises(FuseOSError):
+            GenericFile.new_generic_file(filepath='/grouped', mode=0o644, file_type=GenericFile.FILE_TYPE)
+
+        # The document is the same as the one inserted by gridfs, and can be written as usual
+        file = self.obj.get_generic_file(filepath='/grouped')
+        self.assertEqual(file.json['md5'], 'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertIn('uploadDate', file.json)
+        self.obj.add_data(file=file, data=b'Hello', offset=0, use_cache=False)
+        file.metadata['st_mtime'] = 42
+        file.basic_save()
+        self.obj.cache.reset_cache()
+        file = self.obj.get_generic_file(filepath='/grouped')
+        self.assertEqual(file.length, 5)
+        self.assertEqual(file.metadata['st_mtime'], 42)
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=5), b'Hello')
+
     def test_remove_generic_file(self):
         self.utils.insert_file()
         self.obj.remove_generic_file(generic_file=self.utils.file)
         gf = self.utils.files_coll.find_one({'filename': self.utils.file.filename})
         self.assertEqual(gf, None)
 
+    def test_remove_generic_file_chunks(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+
+        # Only the cached document of the deleted file is removed
+        with patch.object(self.obj.cache, 'reset_cache') as mock_reset_cache:
+            self.obj.remove_generic_file(generic_file=self.utils.file)
+            self.assertEqual(mock_reset_cache.call_count, 0)
+        self.assertEqual(self.obj.get_generic_file(filepath=self.utils.file.filepath), None)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': self.utils.file._id}), 0)
+
+    def test_remove_generic_file_later(self):
+        self.obj.chunk_reaper.chunks_per_second = 100
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        chunks = self.utils.chunks_coll.count({'files_id': self.utils.file._id})
+        tombstones_coll = self.utils.database[self.obj.tombstones_coll]
+
+        # The document is directly deleted, the chunks are left to the reaper
+        with patch.object(self.obj.chunk_reaper, 'start') as mock_start:
+            self.obj.remove_generic_file(generic_file=self.utils.file)
+            self.assertEqual(mock_start.call_count, 1)
+        self.assertEqual(self.obj.get_generic_file(filepath=self.utils.file.filepath), None)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': self.utils.file._id}), chunks)
+        self.assertEqual(tombstones_coll.count(), 1)
+
+        # The recent tombstones are not reaped yet
+        self.assertEqual(self.obj.reap_tombstones(max_chunks=1), 0)
+        with patch.object(Mongo, 'TOMBSTONE_DELAY', -1):
+            self.assertEqual(self.obj.reap_tombstones(max_chunks=1), 1)
+            self.assertEqual(tombstones_coll.count(), 1)
+            self.assertEqual(self.obj.reap_all_tombstones(), chunks - 1)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': self.utils.file._id}), 0)
+        self.assertEqual(tombstones_coll.count(), 0)
+
+    def test_reap_tombstone_existing_file(self):
+        # We crashed between the insertion of the tombstone and the deletion of the document
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        chunks = self.utils.chunks_coll.count({'files_id': self.utils.file._id})
+        tombstones_coll = self.utils.database[self.obj.tombstones_coll]
+        tombstones_coll.insert_one({'files_id': self.utils.file._id, 'chunks_id': self.utils.file._id, 'extents': False, 'date': 0})
+
+        self.assertEqual(self.obj.reap_all_tombstones(), 0)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': self.utils.file._id}), chunks)
+        self.assertEqual(tombstones_coll.count(), 0)
+
+    def test_reap_tombstone_rechunked_file(self):
+        Mongo.configuration.conf['mongo']['deduplication'] = True
+        Mongo.configuration.conf['cache']['timeout_s'] = 0
+        self.obj.chunk_reaper.chunks_per_second = 100
+        GenericFile.new_generic_file(filepath='/big', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/big')
+        self.obj.add_data(file=file, data=bytes(range(0, 256)) * 1000, offset=0, use_cache=False)
+        self.obj.chunk_size_policy.rules = [{'path': '/big', 'chunk_size': 100000}]
+        self.assertEqual(self.obj.rechunk_files(), 1)
+        file = self.obj.get_generic_file(filepath='/big')
+
+        # A previous chunk left with the id of the file (by a host still using the previous chunk size)
+        chunk = self.utils.chunks_coll.find_one({'files_id': file.json['chunks_id']})
+        del chunk['_id']
+        chunk['files_id'] = file._id
+        self.utils.chunks_coll.insert_one(chunk)
+        payloads_coll = self.utils.database[self.obj.payloads_coll]
+        payloads_coll.update_one({'_id': chunk['hash']}, {'$inc': {'refs': 1}})
+
+        # The chunks stored with both ids are deleted, and their payloads released
+        with patch.object(self.obj.chunk_reaper, 'start'):
+            self.obj.remove_generic_file(generic_file=file)
+        tombstone = self.utils.database[self.obj.tombstones_coll].find_one()
+        self.assertEqual((tombstone['files_id'], tombstone['chunks_id']), (file._id, file.json['chunks_id']))
+        with patch.object(Mongo, 'TOMBSTONE_DELAY', -1):
+            self.obj.reap_all_tombstones()
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': {'$in': [file._id, file.json['chunks_id']]}}), 0)
+        self.assertEqual(payloads_coll.count(), 0)
+
     def test_remove_generic_file_directory_not_empty(self):
         # Try to delete the parent directory while a file still exist in it
         self.utils.insert_directory()
@@ -75,6 +210,67 @@ class TestMongo(unittest.TestCase):
         self.obj.remove_generic_file(generic_file=self.utils.directory)
         self.assertTrue(True)
 
+    def test_directory_counter(self):
+        directory = GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        GenericFile.new_generic_file(filepath='/a/file-1', mode=0o755, file_type=GenericFile.FILE_TYPE)
+        GenericFile.new_generic_file(filepath='/a/file-2', mode=0o755, file_type=GenericFile.FILE_TYPE)
+        GenericFile.new_generic_file(filepath='/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+
+        self.obj.get_generic_file(filepath='/a/file-2').rename_to(initial_filepath='/a/file-2', destination_filepath='/b/file-2')
+        self.obj.remove_generic_file(generic_file=self.obj.get_generic_file(filepath='/b/file-2'))
+
+        directory = self.obj.get_generic_file(filepath='/a')
+        self.assertEqual(self.obj.count_generic_files_in_directory(directory=directory), 1)
+        self.assertEqual(directory.metadata['st_nlink'], 3)
+        self.assertEqual(self.obj.count_generic_files_in_directory(directory=self.obj.get_generic_file(filepath='/b')), 0)
+
+    def test_remove_generic_file_directory_counter(self):
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        GenericFile.new_generic_file(filepath='/a/file', mode=0o755, file_type=GenericFile.FILE_TYPE)
+
+        # The counter is enough to know that the directory is not empty
+        with patch.object(self.obj.cache, 'find_one', wraps=self.obj.cache.find_one) as mock_find_one:
+            with self.assertRaises(FuseOSError):
+                self.obj.remove_generic_file(generic_file=self.obj.get_generic_file(filepath='/a'))
+            self.assertFalse(any('filename' not in call[0][1] for call in mock_find_one.call_args_list))
+
+        self.obj.remove_generic_file(generic_file=self.obj.get_generic_file(filepath='/a/file'))
+        self.obj.remove_generic_file(generic_file=self.obj.get_generic_file(filepath='/a'))
+        self.assertEqual(self.obj.get_generic_file(filepath='/a'), None)
+
+    def test_directory_counter_delayed(self):
+        self.obj.directory_counters.flush_interval = 60
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        GenericFile.new_generic_file(filepath='/a/file-1', mode=0o755, file_type=GenericFile.FILE_TYPE)
+        GenericFile.new_generic_file(filepath='/a/file-2', mode=0o755, file_type=GenericFile.FILE_TYPE)
+
+        # The increments are not sent yet, but the current host already sees them
+        self.assertEqual(self.utils.files_coll.find_one({'filename': 'a'})['children'], 0)
+        directory = self.obj.get_generic_file(filepath='/a')
+        self.assertEqual(self.obj.count_generic_files_in_directory(directory=directory), 2)
+        self.assertFalse(self.obj.is_directory_empty(directory))
+
+        # Removing a file created by the current host only cancels its increment
+        with patch.object(self.obj.cache, 'find_one_and_update') as mock_find_one_and_update:
+            self.obj.remove_generic_file(generic_file=self.obj.get_generic_file(filepath='/a/file-2'))
+            self.assertEqual(mock_find_one_and_update.call_count, 0)
+
+        self.obj.directory_counters.flush()
+        directory = self.utils.files_coll.find_one({'filename': 'a'})
+        self.assertEqual(directory['children'], 1)
+        self.assertEqual(directory['metadata']['st_nlink'], 3)
+        self.assertEqual(self.obj.directory_counters.pending(directory['_id']), 0)
+
+    def test_repair_directory_counters(self):
+        self.utils.insert_directory()
+        self.utils.insert_directory_file()
+        self.assertEqual(self.obj.repair_directory_counters(), 2)
+
+        directory = self.utils.files_coll.find_one({'_id': self.utils.directory._id})
+        self.assertEqual(directory['children'], 1)
+        self.assertEqual(directory['metadata']['st_nlink'], 3)
+        self.assertEqual(self.obj.repair_directory_counters(), 0)
+
     def test_list_generic_files_in_directory(self):
         self.utils.insert_directory()
         self.utils.insert_file()
@@ -83,6 +279,38 @@ class TestMongo(unittest.TestCase):
         files = self.obj.list_generic_files_in_directory(filepath='/')
         self.assertEqual(len(files), 3)
 
+    def test_list_generic_files_in_directory_cached(self):
+        self.utils.insert_file()
+        self.obj.list_generic_files_in_directory(filepath='/')
+
+        # The documents loaded by the listing are directly used afterwards
+        self.utils.files_coll.update_one({'_id': self.utils.file._id}, {'$set': {'metadata.st_size': 1234}})
+        gf = self.obj.get_generic_file(filepath=self.utils.file.filepath)
+        self.assertEqual(gf.metadata['st_size'], self.utils.file.metadata['st_size'])
+
+    def test_iterate_generic_files_in_directory(self):
+        self.utils.insert_directory()
+        self.utils.insert_file()
+        self.utils.insert_symbolic_link()
+
+        filenames = [elem['filename'] for elem in self.obj.iterate_generic_files_in_directory(filepath='/')]
+        self.assertEqual(filenames, sorted([self.utils.directory.filename, self.utils.file.filename, self.utils.symbolic_link.filename]))
+
+        # Resume the listing after the first filename
+        resumed = [elem['filename'] for elem in self.obj.iterate_generic_files_in_directory(filepath='/', after=filenames[0])]
+        self.assertEqual(resumed, filenames[1:])
+
+    def test_iterate_generic_files_in_directory_big(self):
+        Mongo.configuration.conf['cache']['max_elements'] = 2
+        for i in range(0, 5):
+            GenericFile.new_generic_file(filepath='/file-' + str(i), mode=0o755, file_type=GenericFile.FILE_TYPE)
+
+        # Once we loaded as many documents as the cache can keep, we only load the filename and type
+        elems = list(self.obj.iterate_generic_files_in_directory(filepath='/'))
+        self.assertEqual([elem['filename'] for elem in elems], ['file-' + str(i) for i in range(0, 5)])
+        self.assertTrue('metadata' in elems[1])
+        self.assertFalse('metadata' in elems[2])
+
     def test_generic_file_exists(self):
         self.assertFalse(self.obj.generic_file_exists(self.utils.file.filepath))
         self.utils.insert_file()
@@ -171,6 +399,142 @@ class TestMongo(unittest.TestCase):
         gf = self.obj.get_generic_file(filepath=self.utils.file.filepath)
         self.assertEqual(gf, None)
 
+    def test_get_last_directory_id_for_filepath(self):
+        self.utils.insert_directory()
+        self.utils.insert_directory_file()
+        directory_id = self.obj.get_last_directory_id_for_filepath(filepath=self.utils.directory_file.filepath)
+        self.assertEqual(directory_id, self.utils.directory._id)
+
+    def test_get_last_directory_id_for_filepath_cached(self):
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        GenericFile.new_generic_file(filepath='/a/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        directory = GenericFile.new_generic_file(filepath='/a/b/c', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+
+        # Every directory created by the current host is known, so we do not need to contact MongoDB
+        with patch.object(self.obj.cache, 'find_one') as mock_find_one:
+            directory_id = self.obj.get_last_directory_id_for_filepath(filepath='/a/b/c/file')
+            self.assertEqual(mock_find_one.call_count, 0)
+        self.assertEqual(directory_id, directory._id)
+
+    def test_get_last_directory_id_for_filepath_after_rename(self):
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        directory = GenericFile.new_generic_file(filepath='/a/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        self.obj.get_generic_file(filepath='/a').rename_to(initial_filepath='/a', destination_filepath='/z')
+
+        self.assertEqual(self.obj.get_last_directory_id_for_filepath(filepath='/a/b/file'), None)
+        self.assertEqual(self.obj.get_last_directory_id_for_filepath(filepath='/z/b/file'), directory._id)
+
+    def test_get_generic_file_directory_recreated(self):
+        # Another host deletes a directory we know, and creates it again
+        old = GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        self.assertEqual(self.obj.get_last_directory_id_for_filepath(filepath='/a/g'), old._id)
+        new = dict(self.utils.files_coll.find_one({'_id': old._id}))
+        self.utils.files_coll.delete_one({'_id': old._id})
+        del new['_id']
+        self.utils.files_coll.insert_one(new)
+        self.obj.cache.reset_cache()
+
+        # Creating a file loads the new directory, so it replaces the old one
+        GenericFile.new_generic_file(filepath='/a/g', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        self.assertEqual(self.obj.get_generic_file(filepath='/a/g').directory_id, new['_id'])
+
+        # A file created by the other host is found once the old directory is old enough to be checked again
+        self.obj.directory_cache.add(parent_id=self.utils.root_id, name='a', directory_id=old._id)
+        file = dict(self.utils.files_coll.find_one({'filename': 'g'}), filename='h')
+        del file['_id']
+        self.utils.files_coll.insert_one(file)
+        with patch.object(Configuration, 'cache_timeout', return_value=0):
+            self.assertIsInstance(self.obj.get_generic_file(filepath='/a/h'), File)
+            self.assertIsNone(self.obj.get_generic_file(filepath='/a/missing'))
+
+    def test_get_last_directory_id_for_filepath_materialized(self):
+        Mongo.configuration.conf['mongo']['materialized_paths'] = True
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        GenericFile.new_generic_file(filepath='/a/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        directory = GenericFile.new_generic_file(filepath='/a/b/c', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        self.obj.directory_cache.clear()
+
+        with patch.object(self.obj.cache, 'find', wraps=self.obj.cache.find) as mock_find:
+            with patch.object(self.obj.cache, 'find_one', wraps=self.obj.cache.find_one) as mock_find_one:
+                directory_id = self.obj.get_last_directory_id_for_filepath(filepath='/a/b/c/file')
+                self.assertEqual(mock_find.call_count, 1)
+                self.assertEqual(mock_find_one.call_count, 0)
+        self.assertEqual(directory_id, directory._id)
+
+    def test_get_last_directory_id_for_filepath_materialized_stale(self):
+        # A path left by an interrupted rename is not trusted, we follow the hierarchy instead
+        Mongo.configuration.conf['mongo']['materialized_paths'] = True
+        self.obj.create_indexes()
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        moved = GenericFile.new_generic_file(filepath='/a/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        target = GenericFile.new_generic_file(filepath='/c', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        self.utils.files_coll.update_one({'_id': moved._id}, {'$set': {'directory_id': target._id}})
+        self.obj.directory_cache.clear()
+
+        self.assertIsNone(self.obj.get_last_directory_id_for_filepath(filepath='/a/b/file'))
+        self.assertEqual(self.obj.get_last_directory_id_for_filepath(filepath='/c/b/file'), moved._id)
+
+        # A new directory can take the stale path
+        directory = GenericFile.new_generic_file(filepath='/a/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        self.assertEqual(self.utils.files_coll.find_one({'path': '/a/b'})['_id'], directory._id)
+        self.assertNotIn('path', self.utils.files_coll.find_one({'_id': moved._id}))
+
+    def test_rename_materialized_paths(self):
+        Mongo.configuration.conf['mongo']['materialized_paths'] = True
+        GenericFile.new_generic_file(filepath='/a', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        GenericFile.new_generic_file(filepath='/a/b', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        file = GenericFile.new_generic_file(filepath='/a/b/file', mode=0o755, file_type=GenericFile.FILE_TYPE)
+        GenericFile.new_generic_file(filepath='/ab', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+
+        self.obj.get_generic_file(filepath='/a').rename_to(initial_filepath='/a', destination_filepath='/z')
+        self.assertEqual(self.utils.files_coll.find_one({'_id': file._id})['path'], '/z/b/file')
+        self.assertNotEqual(self.utils.files_coll.find_one({'path': '/z'}), None)
+        self.assertNotEqual(self.utils.files_coll.find_one({'path': '/ab'}), None)
+
+    def test_backfill_materialized_paths(self):
+        self.utils.insert_directory()
+        self.utils.insert_directory_file()
+        self.assertEqual(self.obj.backfill_materialized_paths(), 3)
+
+        directory_file = self.utils.files_coll.find_one({'_id': self.utils.directory_file._id})
+        self.assertEqual(directory_file['path'], self.utils.directory_file.filepath)
+        self.assertEqual(self.obj.backfill_materialized_paths(), 0)
+
+    def test_get_generic_file_missing_cached(self):
+        self.assertEqual(self.obj.get_generic_file(filepath=self.utils.file.filepath), None)
+
+        # We remember that the file was missing, as long as it is not created by the current host
+        self.utils.files_coll.insert_one(self.utils.file_raw)
+        self.assertEqual(self.obj.get_generic_file(filepath=self.utils.file.filepath), None)
+
+        self.obj.cache.add_filename(directory_id=self.utils.file.directory_id, filename=self.utils.file.filename)
+        self.assertIsInstance(self.obj.get_generic_file(filepath=self.utils.file.filepath), File)
+
+    def test_get_generic_file_missing_bloom_filter(self):
+        self.utils.insert_directory()
+        self.obj.list_generic_files_in_directory(filepath='/')
+
+        # The directory was listed without the file, so we know it is missing
+        self.utils.files_coll.insert_one(self.utils.file_raw)
+        self.assertEqual(self.obj.get_generic_file(filepath=self.utils.file.filepath), None)
+        self.assertIsInstance(self.obj.get_generic_file(filepath=self.utils.directory.filepath), Directory)
+
+        # Creating a file on the current host updates the Bloom filter
+        GenericFile.new_generic_file(filepath='/new-file', mode=0o755, file_type=GenericFile.FILE_TYPE)
+        self.assertIsInstance(self.obj.get_generic_file(filepath='/new-file'), File)
+
+    def test_get_generic_file_bloom_filter_created_during_listing(self):
+        self.utils.insert_directory()
+        listing = self.obj.iterate_generic_files_in_directory(filepath='/')
+        next(listing)
+
+        # The listing does not see the file created in the meantime, but its Bloom filter must contain it
+        GenericFile.new_generic_file(filepath='/zz-new-file', mode=0o755, file_type=GenericFile.FILE_TYPE)
+        self.obj.cache.invalidate(directory_id=self.utils.root_id, filename='zz-new-file')
+        list(listing)
+        self.assertIsInstance(self.obj.get_generic_file(filepath='/zz-new-file'), File)
+        self.assertEqual(self.obj.cache.listings, {})
+
     def test_add_nlink_directory(self):
         # By default, a directory has 2 st_nlink. And by default, the "/" directory always exists.
         self.obj.add_nlink_directory(directory_id=self.utils.root_id, value=4)
@@ -194,6 +558,60 @@ class TestMongo(unittest.TestCase):
         data = self.obj.read_data(file=self.utils.file, offset=3, size=8)
         self.assertEqual(data, message[3:3+8])
 
+    def test_read_data_chunk_boundary(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+
+        # Reading exactly 2 chunks must not load a third one
+        with patch.object(self.obj.cache, 'find_chunks', wraps=self.obj.cache.find_chunks) as mock_find_chunks:
+            data = self.obj.read_data(file=self.utils.file, offset=4, size=8)
+            self.assertEqual(mock_find_chunks.call_args_list[0][0][2:4], (1, 2))
+        self.assertEqual(data, message[4:12])
+
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=len(message), size=8), b'')
+
+    def test_read_data_cached(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4096), message)
+
+        # The chunks are now read from the cache
+        self.utils.chunks_coll.update_many({'files_id': self.utils.file._id}, {'$set': {'data': b'....'}})
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4096), message)
+
+        # Only the updated chunk is invalidated
+        self.obj.add_data(file=self.utils.file, data=b'abcd', offset=4, use_cache=False)
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=12), message[0:4] + b'abcd' + message[8:12])
+
+    def test_read_data_read_ahead(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+
+        # A sequential read loads the next chunk in advance
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4), message[0:4])
+        self.obj.read_ahead.wait(self.utils.file, 0, 2)
+        self.utils.chunks_coll.update_many({'files_id': self.utils.file._id}, {'$set': {'data': b'....'}})
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=4, size=4), message[4:8])
+
+    def test_read_data_parallel(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+
+        # Every chunk is loaded by its own query, and the data is reassembled in order
+        self.obj.read_ahead.max_chunks = 0
+        with patch.object(MongoCache, 'chunks_executor', ThreadPoolExecutor(max_workers=2)):
+            with patch.object(self.obj.cache, 'find_chunk_range', wraps=self.obj.cache.find_chunk_range) as mock_find_chunk_range:
+                self.assertEqual(self.obj.read_data(file=self.utils.file, offset=2, size=4096), message[2:])
+                self.assertEqual(mock_find_chunk_range.call_count, len(self.utils.file_chunks_raw))
+
+    def test_chunk_ranges(self):
+        with patch.object(Configuration, 'parallel_reads_chunks_per_query', return_value=2):
+            self.assertEqual(self.obj.cache.chunk_ranges([0, 1, 2, 4, 6, 7]), [(0, 1), (2, 2), (4, 4), (6, 7)])
+
     def test_add_data_append(self):
         self.utils.insert_file()
         self.utils.insert_file_chunks()
@@ -203,6 +621,370 @@ class TestMongo(unittest.TestCase):
         modified_message = self.utils.read_file_chunks()
         self.assertEqual(modified_message, message+b'test')
 
+    def test_add_data_buffered(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+
+        # The data is kept in memory, but a read of the current host must already see it
+        self.obj.add_data(file=self.utils.file, data=b'test', offset=len(message) - 1)
+        self.assertEqual(self.utils.read_file_chunks(flush=False), message)
+        self.assertEqual(self.obj.write_buffer.length(self.utils.file), len(message) + 3)
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4096), message[0:-1] + b'test')
+        self.assertEqual(self.utils.read_file_chunks(flush=False), message)
+
+        # Scattered writes, even after the end of the file
+        self.obj.add_data(file=self.utils.file, data=b'ab', offset=1)
+        self.obj.add_data(file=self.utils.file, data=b'cd', offset=len(message) + 5)
+        expected = message[0:1] + b'ab' + message[3:-1] + b'test' + b'\0\0' + b'cd'
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4096), expected)
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=2, size=3), expected[2:5])
+
+        self.obj.flush_data_to_write(self.utils.file)
+        self.assertEqual(self.obj.write_buffer.length(self.utils.file), None)
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4096), expected)
+
+    def test_write_chunks(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+
+        # The chunks are sent in one bulk_write, and no document is loaded back
+        with patch.object(self.obj.cache, 'bulk_write', wraps=self.obj.cache.bulk_write) as mock_bulk_write:
+            with patch.object(self.obj.cache, 'find_one_and_update', wraps=self.obj.cache.find_one_and_update) as mock_find_one_and_update:
+                self.obj.write_chunks(file=self.utils.file, chunks={1: [(0, b'abcd')], 2: [(1, b'e')], 20: [(2, b'f')]}, length=83)
+                self.assertEqual(mock_bulk_write.call_count, 1)
+                self.assertEqual(mock_find_one_and_update.call_count, 0)
+
+        self.assertEqual(self.utils.file.length, 83)
+        file = self.obj.get_generic_file(filepath='/' + self.utils.file.filename)
+        self.assertEqual(file.length, 83)
+        self.assertEqual(file.metadata['st_size'], 83)
+        data = self.obj.read_data(file=file, offset=0, size=4096)
+        self.assertEqual(data[0:12], message[0:4] + b'abcd' + message[8:9] + b'e' + message[10:12])
+
+        # The length never decreases, another flush might have written data further
+        self.obj.write_chunks(file=self.utils.file, chunks={0: [(0, b'z')]}, length=10)
+        self.assertEqual(self.utils.files_coll.find_one({'_id': self.utils.file._id})['length'], 83)
+
+    def test_write_chunks_concurrent(self):
+        # Two flushes from instances loaded at the same time only add the chunks they created
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        first = self.obj.get_generic_file(filepath='/' + self.utils.file.filename)
+        second = self.obj.get_generic_file(filepath='/' + self.utils.file.filename)
+        self.obj.write_chunks(file=first, chunks={30: [(0, b'abcd')]}, length=124)
+        self.obj.write_chunks(file=second, chunks={31: [(0, b'efgh')], 32: [(0, b'ijkl')]}, length=132)
+
+        chunks = self.utils.chunks_coll.count({'files_id': self.utils.file._id})
+        self.assertEqual(self.utils.files_coll.find_one({'_id': self.utils.file._id})['allocated_chunks'], chunks)
+
+        # Same for a truncate
+        self.obj.truncate(file=first, length=120)
+        self.assertEqual(self.utils.files_coll.find_one({'_id': self.utils.file._id})['allocated_chunks'], chunks - 3)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': self.utils.file._id}), chunks - 3)
+
+    def test_add_data_compressed(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+
+        # Old uncompressed chunks stay readable
+        self.obj.codec = ChunkCodec(codec='zlib', level=6, threads=2)
+        self.obj.cache.data_cache.clear()
+        self.assertEqual(self.obj.read_data(file=self.utils.file, offset=0, size=4096), message)
+
+        # The chunks we write are compressed
+        GenericFile.new_generic_file(filepath='/compressed', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/compressed')
+        text = b'Some logs which are easy to compress. ' * 10000
+        self.obj.add_data(file=file, data=text, offset=0, use_cache=False)
+        chunks = list(self.utils.chunks_coll.find({'files_id': file._id}))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual([chunk['codec'] for chunk in chunks], ['zlib', 'zlib'])
+        self.assertLess(sum(len(chunk['data']) for chunk in chunks), len(text) / 10)
+
+        self.obj.cache.data_cache.clear()
+        file = self.obj.get_generic_file(filepath='/compressed')
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(text)), text)
+
+        # Truncating the last chunk keeps it readable
+        self.obj.truncate(file=file, length=file.chunkSize + 10)
+        self.obj.cache.data_cache.clear()
+        file = self.obj.get_generic_file(filepath='/compressed')
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(text)), text[0:file.chunkSize + 10])
+
+    def test_add_data_deduplicated(self):
+        Mongo.configuration.conf['mongo']['deduplication'] = True
+        payloads_coll = self.obj.cache.database[self.obj.payloads_coll]
+        text = b'A layer shared by several images. ' * 20000
+
+        files = []
+        for name in ['/copy-1', '/copy-2']:
+            GenericFile.new_generic_file(filepath=name, mode=0o644, file_type=GenericFile.FILE_TYPE)
+            file = self.obj.get_generic_file(filepath=name)
+            self.obj.add_data(file=file, data=text, offset=0, use_cache=False)
+            files.append(file)
+
+        # Both copies reference the same payloads, the second one did not send them again
+        chunks = list(self.utils.chunks_coll.find({'files_id': files[1]._id}))
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all('hash' in chunk and 'data' not in chunk for chunk in chunks))
+        self.assertEqual(payloads_coll.count(), 3)
+        self.assertEqual(sorted(payload['refs'] for payload in payloads_coll.find()), [2, 2, 2])
+
+        self.obj.cache.data_cache.clear()
+        file = self.obj.get_generic_file(filepath='/copy-2')
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(text)), text)
+
+        # Modifying a chunk releases its previous payload, truncating too
+        self.obj.add_data(file=file, data=b'other', offset=10, use_cache=False)
+        self.obj.truncate(file=file, length=file.chunkSize + 10)
+        self.assertEqual(sorted(payload['refs'] for payload in payloads_coll.find()), [1, 1, 1, 1, 1])
+
+        self.obj.cache.data_cache.clear()
+        file = self.obj.get_generic_file(filepath='/copy-2')
+        expected = text[0:10] + b'other' + text[15:file.chunkSize + 10]
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(text)), expected)
+
+        # The payloads are deleted with the last file referencing them
+        self.obj.remove_generic_file(generic_file=files[0])
+        self.assertEqual(payloads_coll.count(), 2)
+        self.obj.remove_generic_file(generic_file=file)
+        self.assertEqual(payloads_coll.count(), 0)
+
+    def test_add_data_inline(self):
+        Mongo.configuration.conf['inline_data'] = {'max_bytes': 4096}
+        GenericFile.new_generic_file(filepath='/small', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/small')
+        self.obj.add_data(file=file, data=b'Hello', offset=0, use_cache=False)
+        self.obj.add_data(file=file, data=b'world', offset=10, use_cache=False)
+
+        # The data is in the document, reading it does not need any other query
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 0)
+        file = self.obj.get_generic_file(filepath='/small')
+        self.assertEqual(file.json['data'], b'Hello\x00\x00\x00\x00\x00world')
+        with patch.object(self.obj.cache, 'find_chunk_range') as mock_find_chunk_range:
+            self.assertEqual(self.obj.read_data(file=file, offset=0, size=100), b'Hello\x00\x00\x00\x00\x00world')
+            self.assertEqual(mock_find_chunk_range.call_count, 0)
+
+        self.obj.truncate(file=file, length=5)
+        file = self.obj.get_generic_file(filepath='/small')
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=100), b'Hello')
+
+        # Above the limit, the data is moved to the chunks
+        data = b'x' * 5000
+        self.obj.add_data(file=file, data=data, offset=5, use_cache=False)
+        file = self.obj.get_generic_file(filepath='/small')
+        self.assertNotIn('data', file.json)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 1)
+        self.obj.cache.data_cache.clear()
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=10000), b'Hello' + data)
+
+    def test_write_chunks_inline_stale(self):
+        # Flushes done with instances loaded before the data was put in the document, or moved out of it
+        Mongo.configuration.conf['inline_data'] = {'max_bytes': 4096}
+        GenericFile.new_generic_file(filepath='/small', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        empty = self.obj.get_generic_file(filepath='/small')
+        self.obj.write_chunks(file=self.obj.get_generic_file(filepath='/small'), chunks={0: [(0, b'Hello')]}, length=5)
+        small = self.obj.get_generic_file(filepath='/small')
+
+        data = b'x' * 5000
+        self.obj.write_chunks(file=empty, chunks={0: [(5, data)]}, length=5005)
+        self.obj.write_chunks(file=small, chunks={0: [(0, b'J')]}, length=5)
+
+        file = self.obj.get_generic_file(filepath='/small')
+        self.assertNotIn('data', file.json)
+        self.assertEqual(file.json['allocated_chunks'], 1)
+        self.obj.cache.data_cache.clear()
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=10000), b'Jello' + data)
+
+    def test_write_chunks_inline_group_commit(self):
+        # The conditional update moving the data out of the document does not go through the group commit, which
+        # cannot tell if it matched
+        Mongo.configuration.conf['inline_data'] = {'max_bytes': 4096}
+        self.obj.group_commit.window = 0.01
+        GenericFile.new_generic_file(filepath='/small', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/small')
+        self.obj.add_data(file=file, data=b'Hello', offset=0, use_cache=False)
+
+        data = b'x' * 5000
+        with patch.object(self.obj.group_commit, 'submit', wraps=self.obj.group_commit.submit) as mock_submit:
+            self.obj.write_chunks(file=file, chunks={0: [(5, data)]}, length=5005)
+            self.assertEqual([call for call in mock_submit.call_args_list if call[0][0] == self.obj.files_coll], [])
+        file = self.obj.get_generic_file(filepath='/small')
+        self.assertNotIn('data', file.json)
+        self.assertEqual(file.json['allocated_chunks'], 1)
+        self.obj.cache.data_cache.clear()
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=10000), b'Hello' + data)
+
+    def test_rechunk_files(self):
+        Mongo.configuration.conf['cache']['timeout_s'] = 0
+        GenericFile.new_generic_file(filepath='/big', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/big')
+        data = bytes(range(0, 256)) * 1000
+        self.obj.add_data(file=file, data=data, offset=0, use_cache=False)
+        self.obj.add_data(file=file, data=data, offset=800000, use_cache=False)
+        expected = data + bytes(800000 - len(data)) + data
+
+        # Nothing to do while the files follow the policy
+        self.assertEqual(self.obj.rechunk_files(), 0)
+
+        self.obj.chunk_size_policy.rules = [{'path': '/big', 'chunk_size': 100000}]
+        self.assertEqual(self.obj.rechunk_files(), 1)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 0)
+        stale_file = file
+        file = self.obj.get_generic_file(filepath='/big')
+        self.assertEqual(file.chunkSize, 100000)
+        # The hole in the middle of the file is kept (the previous chunk 3 started with zeros, up to 800000)
+        numbers = sorted(chunk['n'] for chunk in self.utils.chunks_coll.find({'files_id': file.json['chunks_id']}))
+        self.assertEqual(numbers, [0, 1, 2, 7, 8, 9, 10])
+        self.obj.cache.data_cache.clear()
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(expected)), expected)
+
+        # A host still using the previous chunk size writes its data again with the new one
+        self.obj.add_data(file=stale_file, data=b'late', offset=10, use_cache=False)
+        self.assertEqual(stale_file.chunkSize, 100000)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 0)
+        file = self.obj.get_generic_file(filepath='/big')
+        self.obj.cache.data_cache.clear()
+        expected = expected[0:10] + b'late' + expected[14:]
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(expected)), expected)
+
+        self.obj.remove_generic_file(generic_file=file)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file.json['chunks_id']}), 0)
+
+    def test_rechunk_file_modified(self):
+        GenericFile.new_generic_file(filepath='/big', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/big')
+        self.obj.add_data(file=file, data=b'x' * 300000, offset=0, use_cache=False)
+        file = self.obj.get_generic_file(filepath='/big')
+        self.obj.add_data(file=file, data=b'y', offset=0, use_cache=False)
+
+        # The file was modified after we loaded it, we keep its chunks
+        stale_file = self.obj.load_generic_file(dict(file.json, length=300000, metadata=dict(file.metadata, st_mtime=0)))
+        self.assertEqual(self.obj.rechunk_file(stale_file, 100000), None)
+        self.assertEqual(self.utils.chunks_coll.count(), 2)
+        self.assertEqual(self.obj.get_generic_file(filepath='/big').chunkSize, 262144)
+
+    def test_add_data_log_structured(self):
+        self.obj.compactor.max_extents = 0
+        directory = GenericFile.new_generic_file(filepath='/logs', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        directory.attrs[GenericFile.LOG_STRUCTURED_XATTR] = b'1'
+        directory.basic_save()
+        GenericFile.new_generic_file(filepath='/logs/app.log', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/logs/app.log')
+        self.assertTrue(file.is_log_structured())
+
+        # Every flush only inserts the new data, the chunks are not rewritten
+        lines = [('line ' + str(i) + '\n').encode('utf-8') for i in range(0, 20)]
+        offset = 0
+        for line in lines:
+            self.obj.add_data(file=file, data=line, offset=offset, use_cache=False)
+            offset += len(line)
+        extents_coll = self.obj.cache.database[self.obj.extents_coll]
+        self.assertEqual(extents_coll.count({'files_id': file._id}), 20)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 0)
+
+        file = self.obj.get_generic_file(filepath='/logs/app.log')
+        self.assertEqual(file.json['extents'], 20)
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=offset), b''.join(lines))
+
+        # The extents are folded into the chunks
+        self.obj.add_data(file=file, data=b'LINE', offset=0, use_cache=False)
+        self.obj.compact_extents(file)
+        self.assertEqual(file.json['extents'], 0)
+        self.assertEqual(extents_coll.count({'files_id': file._id}), 0)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 1)
+        expected = b'LINE' + b''.join(lines)[4:]
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=offset), expected)
+
+        # Without the special attribute, the remaining extents are compacted before the chunks are modified
+        self.obj.add_data(file=file, data=b'end\n', offset=offset, use_cache=False)
+        file.attrs = {}
+        file.basic_save()
+        self.obj.add_data(file=file, data=b'l', offset=0, use_cache=False)
+        self.assertEqual(extents_coll.count({'files_id': file._id}), 0)
+        file = self.obj.get_generic_file(filepath='/logs/app.log')
+        self.obj.cache.data_cache.clear()
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=offset + 4), b'l' + expected[1:] + b'end\n')
+
+    def test_compact_extents_concurrent(self):
+        self.obj.compactor.max_extents = 0
+        directory = GenericFile.new_generic_file(filepath='/logs', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        directory.attrs[GenericFile.LOG_STRUCTURED_XATTR] = b'1'
+        directory.basic_save()
+        GenericFile.new_generic_file(filepath='/logs/app.log', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/logs/app.log')
+        extents_coll = self.obj.cache.database[self.obj.extents_coll]
+
+        # Two compactions at once, in the same mount then as two mounts (only the lease on the document is shared)
+        save_chunks = self.obj.save_chunks
+        def slow_save_chunks(*args, **kwargs):
+            time.sleep(0.05)
+            return save_chunks(*args, **kwargs)
+        data = b''
+        for locks in [Mongo.compaction_locks, [contextlib.nullcontext()]]:
+            for i in range(0, 10):
+                line = ('line ' + str(i) + '\n').encode('utf-8')
+                self.obj.add_data(file=file, data=line, offset=len(data), use_cache=False)
+                data += line
+            files = [self.obj.get_generic_file(filepath='/logs/app.log') for i in range(0, 2)]
+            with patch.object(Mongo, 'compaction_locks', locks), patch.object(self.obj, 'save_chunks', side_effect=slow_save_chunks):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    for future in [executor.submit(self.obj.compact_extents, f) for f in files]:
+                        future.result()
+
+            json = self.utils.files_coll.find_one({'_id': file._id})
+            self.assertEqual(json['extents'], 0)
+            self.assertNotIn('compaction_lease', json)
+            self.assertEqual(json['allocated_chunks'], self.utils.chunks_coll.count({'files_id': file._id}))
+            self.assertEqual(extents_coll.count({'files_id': file._id}), 0)
+            self.obj.cache.data_cache.clear()
+            file = self.obj.get_generic_file(filepath='/logs/app.log')
+            self.assertEqual(self.obj.read_data(file=file, offset=0, size=len(data)), data)
+
+    def test_compact_extents_expired_lease(self):
+        self.obj.compactor.max_extents = 0
+        directory = GenericFile.new_generic_file(filepath='/logs', mode=0o755, file_type=GenericFile.DIRECTORY_TYPE)
+        directory.attrs[GenericFile.LOG_STRUCTURED_XATTR] = b'1'
+        directory.basic_save()
+        GenericFile.new_generic_file(filepath='/logs/app.log', mode=0o644, file_type=GenericFile.FILE_TYPE)
+        file = self.obj.get_generic_file(filepath='/logs/app.log')
+        self.obj.add_data(file=file, data=b'test', offset=0, use_cache=False)
+
+        # The lease of a mount which crashed during a compaction is taken over once expired
+        self.utils.files_coll.update_one({'_id': file._id}, {'$set': {'compaction_lease': time.time() - 1}})
+        self.obj.compact_extents(file)
+        self.assertEqual(file.json['extents'], 0)
+        self.assertNotIn('compaction_lease', self.utils.files_coll.find_one({'_id': file._id}))
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=4), b'test')
+
+    def test_fsync(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+        self.obj.add_data(file=self.utils.file, data=b'test', offset=0)
+
+        # The buffered data is written, then confirmed with the write concern of a fsync
+        with patch.object(self.obj.cache, 'update_one', wraps=self.obj.cache.update_one) as mock_update_one:
+            self.obj.fsync(generic_file=self.utils.file)
+            self.assertEqual(mock_update_one.call_args_list[-1][1], {'fsync': True})
+        self.assertEqual(self.utils.read_file_chunks(flush=False), b'test' + message[4:])
+        self.assertNotEqual(self.utils.files_coll.find_one({'_id': self.utils.file._id}).get('fsync_time'), None)
+
+    def test_fsync_sharded(self):
+        client = type(self.obj.cache.instance)
+        with patch.object(client, 'is_mongos', new_callable=PropertyMock, return_value=False):
+            self.obj.cache.load_internal()
+        self.assertIsNot(self.obj.cache.data_write_concern, self.obj.cache.fsync_write_concern)
+
+        # A fsync cannot confirm the writes of the other shards, so the data is directly written with its write concern
+        with patch.object(client, 'is_mongos', new_callable=PropertyMock, return_value=True):
+            self.obj.cache.load_internal()
+        self.assertTrue(self.obj.cache.sharded)
+        self.assertIs(self.obj.cache.data_write_concern, self.obj.cache.fsync_write_concern)
+
     def test_add_data_replace(self):
         self.utils.insert_file()
         self.utils.insert_file_chunks()
@@ -239,6 +1021,37 @@ class TestMongo(unittest.TestCase):
         modified_message = self.utils.read_file_chunks()
         self.assertEqual(modified_message, message[0:0])
 
+    def test_truncate_extend(self):
+        self.utils.insert_file()
+        self.utils.insert_file_chunks()
+        message = self.utils.read_file_chunks()
+        chunks = self.utils.chunks_coll.count({'files_id': self.utils.file._id})
+
+        # Extending a file only changes its metadata, the new part is a hole read as zeros
+        self.obj.truncate(file=self.utils.file, length=len(message) + 100)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': self.utils.file._id}), chunks)
+        file = self.obj.get_generic_file(filepath=self.utils.file.filepath)
+        self.assertEqual(file.length, len(message) + 100)
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=4096), message + bytes(100))
+
+        # Shrinking it again, even if its last chunk does not exist
+        self.obj.truncate(file=file, length=len(message) + 50)
+        file = self.obj.get_generic_file(filepath=self.utils.file.filepath)
+        self.assertEqual(self.obj.read_data(file=file, offset=0, size=4096), message + bytes(50))
+
+    def test_sparse_file(self):
+        self.utils.insert_file()
+        file = self.obj.get_generic_file(filepath=self.utils.file.filepath)
+
+        # Only the chunks we write are created, and the number of blocks only counts them
+        self.obj.add_data(file=file, data=b'ab', offset=4 * 1000 + 1, use_cache=False)
+        self.assertEqual(self.utils.chunks_coll.count({'files_id': file._id}), 1)
+        file = self.obj.get_generic_file(filepath=self.utils.file.filepath)
+        self.assertEqual(file.length, 4003)
+        self.assertEqual(file.json['allocated_chunks'], 1)
+        self.assertEqual(file.metadata['st_blocks'], GenericFile.size_to_blocks(4))
+        self.assertEqual(self.obj.read_data(file=file, offset=3990, size=100), bytes(11) + b'ab')
+
     def test_rename_generic_file_to(self):
         self.utils.insert_file()
         self.utils.insert_file_chunks()
@@ -0,0 +1,69 @@
+import unittest
+import threading
+
+from src.core.ReadAhead import ReadAhead
+
+class FakeFile:
+    def __init__(self):
+        self._id = 'file'
+        self.chunkSize = 10
+        self.length = 10 * 1024 * 1024
+
+class TestReadAhead(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.lock = threading.Lock()
+        self.obj = ReadAhead(fetch=self.fetch, max_chunks=4, max_bytes=1000, threads=2)
+        self.file = FakeFile()
+
+    def fetch(self, file, starting_chunk, ending_chunk):
+        with self.lock:
+            self.loaded.extend(range(starting_chunk, ending_chunk + 1))
+
+    def wait(self):
+        self.obj.wait(self.file, 0, 100)
+
+    def test_sequential(self):
+        self.obj.read(self.file, 0, 10)
+        self.wait()
+        self.assertEqual(sorted(self.loaded), [1])
+
+        # The number of chunks loaded in advance doubles at every sequential read
+        self.obj.read(self.file, 10, 10)
+        self.wait()
+        self.assertEqual(sorted(self.loaded), [1, 2, 3])
+
+        self.obj.read(self.file, 20, 10)
+        self.obj.read(self.file, 30, 10)
+        self.wait()
+        self.assertEqual(sorted(self.loaded), [1, 2, 3, 4, 5, 6, 7])
+
+    def test_random(self):
+        self.obj.read(self.file, 5 * 1024 * 1024, 10)
+        self.obj.read(self.file, 2 * 1024 * 1024, 10)
+        self.wait()
+        self.assertEqual(self.loaded, [])
+
+    def test_max_bytes(self):
+        obj = ReadAhead(fetch=self.fetch, max_chunks=4, max_bytes=20, threads=2)
+        for i in range(0, 5):
+            obj.read(self.file, i * 10, 10)
+        obj.wait(self.file, 0, 100)
+        self.assertEqual(sorted(self.loaded), [1, 2, 3, 4, 5, 6])
+
+    def test_end_of_file(self):
+        self.file.length = 25
+        for i in range(0, 3):
+            self.obj.read(self.file, i * 10, 10)
+        self.wait()
+        self.assertEqual(sorted(self.loaded), [1, 2])
+
+    def test_disabled(self):
+        obj = ReadAhead(fetch=self.fetch, max_chunks=0, max_bytes=1000, threads=2)
+        obj.read(self.file, 0, 10)
+        obj.read(self.file, 10, 10)
+        self.assertEqual(obj.executor, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
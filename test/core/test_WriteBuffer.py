@@ -0,0 +1,155 @@
+import unittest
+import threading
+import time
+from fuse import FuseOSError
+
+from src.core.WriteBuffer import WriteBuffer
+
+class FakeFile:
+    def __init__(self, _id='file', chunk_size=4):
+        self._id = _id
+        self.chunkSize = chunk_size
+        self.length = 0
+
+class TestWriteBuffer(unittest.TestCase):
+    def setUp(self):
+        self.writes = []
+        self.lock = threading.Lock()
+        self.obj = WriteBuffer(write=self.write, max_bytes=1000, flush_interval=60, threads=2)
+        self.file = FakeFile()
+
+    def write(self, file, chunks, length):
+        with self.lock:
+            self.writes.append((chunks, length))
+
+    def wait_writes(self, count):
+        st = time.time()
+        while len(self.writes) < count and time.time() - st < 5:
+            time.sleep(0.01)
+
+    def test_flush(self):
+        self.obj.add(self.file, b'ab', 0)
+        self.obj.add(self.file, b'c', 2)
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.obj.length(self.file), 3)
+
+        self.obj.flush(self.file)
+        self.assertEqual(self.writes, [({0: [(0, b'abc')]}, 3)])
+        self.assertEqual(self.obj.length(self.file), None)
+        self.assertEqual(self.obj.dirty_bytes, 0)
+
+    def test_overwrite(self):
+        self.obj.add(self.file, b'bc', 1)
+        self.obj.add(self.file, b'a', 0)
+        self.obj.add(self.file, b'X', 1)
+        self.obj.flush(self.file)
+        self.assertEqual(self.writes, [({0: [(0, b'aXc')]}, 3)])
+
+    def test_full_chunk(self):
+        # A full chunk is written in background, without waiting for a flush
+        self.obj.add(self.file, b'abcdef', 0)
+        self.wait_writes(1)
+        self.assertEqual(self.writes, [({0: [(0, b'abcd')]}, 4)])
+
+        self.obj.flush(self.file)
+        self.assertEqual(self.writes[1], ({1: [(0, b'ef')]}, 6))
+
+    def test_not_contiguous(self):
+        # Every chunk is written once, with all its dirty ranges
+        file = FakeFile(chunk_size=100)
+        self.obj.add(file, b'a', 0)
+        self.obj.add(file, b'c', 2)
+        self.obj.add(file, b'e', 4)
+        self.assertEqual(self.writes, [])
+        self.obj.flush(file)
+        self.assertEqual(self.writes, [({0: [(0, b'a'), (2, b'c'), (4, b'e')]}, 5)])
+
+    def test_read(self):
+        self.obj.add(self.file, b'ab', 1)
+        self.obj.add(self.file, b'X', 5)
+        self.assertEqual(self.obj.read(self.file, 0, 3), (6, [(1, b'ab')]))
+        self.assertEqual(self.obj.read(self.file, 2, 10), (6, [(2, b'b'), (5, b'X')]))
+        self.assertEqual(self.obj.read(FakeFile(_id='other'), 0, 3), (None, []))
+
+    def test_flush_interval(self):
+        obj = WriteBuffer(write=self.write, max_bytes=1000, flush_interval=0.1, threads=2)
+        obj.add(self.file, b'ab', 0)
+        self.wait_writes(1)
+        self.assertEqual(self.writes, [({0: [(0, b'ab')]}, 2)])
+
+    def test_flush_interval_reset(self):
+        # A file written continuously is not written again at every tick of the flusher
+        def write(file, chunks, length):
+            self.write(file, chunks, length)
+            if len(self.writes) == 1:
+                obj.add(self.file, b'c', 2)
+        obj = WriteBuffer(write=write, max_bytes=1000, flush_interval=0.5, threads=2)
+        obj.add(self.file, b'ab', 0)
+        self.wait_writes(1)
+        time.sleep(0.05)
+        self.assertGreater(obj.files[self.file._id]['deadline'], time.time())
+        self.wait_writes(2)
+        self.assertEqual(self.writes[1], ({0: [(2, b'c')]}, 3))
+
+    def test_max_bytes(self):
+        obj = WriteBuffer(write=self.write, max_bytes=4, flush_interval=60, threads=2)
+        file = FakeFile(chunk_size=100)
+        obj.add(file, b'ab', 0)
+        obj.add(file, b'cd', 2)
+        self.assertEqual(self.writes, [])
+
+        # We need to wait for the previous data to be written
+        obj.add(file, b'ef', 4)
+        self.assertEqual(self.writes, [({0: [(0, b'abcd')]}, 4)])
+        self.assertEqual(obj.dirty_bytes, 2)
+
+    def test_disabled(self):
+        obj = WriteBuffer(write=self.write, max_bytes=0, flush_interval=60, threads=2)
+        obj.add(self.file, b'abcde', 2)
+        self.assertEqual(self.writes, [({0: [(2, b'ab')], 1: [(0, b'cde')]}, 7)])
+
+    def test_discard(self):
+        self.obj.add(self.file, b'ab', 0)
+        self.obj.discard(self.file)
+        self.obj.flush(self.file)
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.obj.dirty_bytes, 0)
+
+    def test_write_error(self):
+        # The data we could not write stays in the buffer, and the next flush fails if it cannot write it either
+        failures = [IOError('disconnected'), IOError('disconnected')]
+        def write(file, chunks, length):
+            if len(failures) > 0:
+                raise failures.pop()
+            self.write(file, chunks, length)
+        obj = WriteBuffer(write=write, max_bytes=1000, flush_interval=60, threads=2)
+
+        obj.add(self.file, b'abcdef', 0)
+        st = time.time()
+        while (len(failures) > 1 or obj.files[self.file._id]['flushing'].size > 0) and time.time() - st < 5:
+            time.sleep(0.01)
+        obj.add(self.file, b'X', 1)
+        self.assertEqual(obj.read(self.file, 0, 10), (6, [(0, b'aXcdef')]))
+
+        self.assertRaises(FuseOSError, obj.flush, self.file)
+        self.assertEqual(obj.dirty_bytes, 6)
+        self.assertEqual(obj.length(self.file), 6)
+
+        obj.flush(self.file)
+        self.assertEqual(self.writes, [({0: [(0, b'aXcd')], 1: [(0, b'ef')]}, 6)])
+        self.assertEqual(obj.dirty_bytes, 0)
+        self.assertEqual(obj.length(self.file), None)
+
+    def test_reload(self):
+        # The file is reloaded before its data is written, whatever the instance we received
+        reloaded = []
+        obj = WriteBuffer(write=self.write, max_bytes=1000, flush_interval=60, threads=2, reload=reloaded.append)
+        obj.add(self.file, b'ab', 0)
+        obj.add(FakeFile(), b'c', 2)
+        obj.flush(self.file)
+        self.assertEqual(reloaded, [self.file])
+        self.assertEqual(self.writes, [({0: [(0, b'abc')]}, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()